@@ -4,9 +4,6 @@ import time
 from influential_users.application.message_logger import MessageLogger
 from influential_users.application.network_analysis import NetworkAnalysis
 from influential_users.application.youtube_api import YoutubeAPI
-import dash
-import dash_core_components as dcc
-import dash_html_components as html
 
 
 def main():
@@ -54,6 +51,11 @@ def main():
     execution_time = time.strftime("%H:%M:%S", time.gmtime(end_time - start_time))
     logger.debug("Execution time: " + execution_time)
 
+    # dash is imported only to serve the figure, the crawl and rank steps do not need it
+    import dash
+    import dash_core_components as dcc
+    import dash_html_components as html
+
     app = dash.Dash()
     app.layout = html.Div([
         dcc.Graph(figure=fig)
@@ -0,0 +1,981 @@
+import asyncio
+import functools
+import threading
+from datetime import datetime
+
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import errors, IndexModel, ReturnDocument, UpdateOne
+
+from influential_users.application.message_logger import MessageLogger
+from influential_users.application.mongo_client import MONGODB_URI, get_client_options
+from influential_users.application.mongodb import (
+    CHANGE_STREAM_AWAIT_MS, DUPLICATE_KEY_ERROR, INDEXES, INTERACTIONS_STREAM_PIPELINE, STATISTICS_TIMESERIES,
+    WARM_BATCH_SIZE, growth_rates_pipeline, interaction_backfill_pipeline, interaction_edges_pipeline,
+    interaction_operations, network_edges_pipeline, upsert_operations
+)
+from influential_users.application.seen_filter import SeenFilter
+from influential_users.application.storage import (
+    AGGREGATION_BATCH_SIZE, CHANNEL_ENTITY, CHANNELS_COLLECTION, COMMENTS_COLLECTION, DATABASE_NAME,
+    EDGES_BACKFILL_MIGRATION, EDGES_COLLECTION, GROWTH_WINDOW, MAX_TOKEN_ATTEMPTS, MIGRATION_BATCH_SIZE,
+    MIGRATIONS_COLLECTION, PLAYLISTS_COLLECTION, REPLIES_COLLECTION,
+    SEARCH_RESULTS_COLLECTION, SEEN_COLLECTIONS, STATISTICS_COLLECTION, StorageBackend, TOKEN_DEAD, TOKEN_LEASE_SECONDS,
+    TOKEN_LEASED, TOKEN_PENDING, TOKENS_COLLECTION, VIDEO_ENTITY, VIDEOS_COLLECTION, create_interaction,
+    create_statistics_snapshot, register_exit_flush, token_lease_filter, token_lease_update, unregister_exit_flush
+)
+
+DEFAULT_MAX_IN_FLIGHT = 64  # the number of writes sent to the server and not yet acknowledged
+DEFAULT_READ_BATCH_SIZE = 1000  # the number of documents fetched per round trip by the synchronous readers
+
+
+class AsyncMongoDB:
+    """
+    Asyncio variant of the MongoDB storage backend, on the motor driver: the same methods, as coroutines. The
+    inserts and updates are sent without waiting for the server, up to max_in_flight writes at a time, so the
+    crawler keeps calling the api while the previous pages are written. The writes of a document are applied in
+    the order they were made, the reads wait for the writes in flight
+    """
+
+    """ Init """
+
+    def __init__(self, database_name=DATABASE_NAME, seen_filters=True, max_in_flight=DEFAULT_MAX_IN_FLIGHT, uri=None):
+        """
+        Init method for creating the database client - connect() must be awaited before the first operation
+        :param database_name: the name of the database
+        :param seen_filters: if True, the ids of the channels, playlists and videos are loaded by connect() and
+        kept in memory, so the inserts of known documents are skipped without a round trip and the
+        new ones are sent in the background
+        :param max_in_flight: the maximum number of writes sent and not yet acknowledged - a new write waits for a
+        free slot
+        :param uri: the connection string (MONGODB_URI by default)
+        """
+
+        # logging module
+        ml = MessageLogger('async_mongodb')
+        self.logger = ml.get_logger()
+
+        self.__mongo_client = AsyncIOMotorClient(uri or MONGODB_URI, **get_client_options())
+        self.__db = self.__mongo_client[database_name]  # database: DATABASE_NAME by default
+        self.__search_results_col = self.__db[SEARCH_RESULTS_COLLECTION]  # collection: SEARCH_RESULTS_COLLECTION
+        self.__channels_col = self.__db[CHANNELS_COLLECTION]  # collection: CHANNELS_COLLECTION
+        self.__playlists_col = self.__db[PLAYLISTS_COLLECTION]  # collection: PLAYLISTS_COLLECTION
+        self.__videos_col = self.__db[VIDEOS_COLLECTION]  # collection: VIDEOS_COLLECTION
+        self.__comments_col = self.__db[COMMENTS_COLLECTION]  # collection: COMMENTS_COLLECTION
+        self.__replies_col = self.__db[REPLIES_COLLECTION]  # collection: REPLIES_COLLECTION
+        self.__statistics_col = self.__db[STATISTICS_COLLECTION]  # collection: STATISTICS_COLLECTION
+        self.__tokens_col = self.__db[TOKENS_COLLECTION]  # collection: TOKENS_COLLECTION
+        self.__seen_filters = seen_filters
+        self.__seen = {}  # collection name -> SeenFilter with the stored ids
+
+        self.__window = asyncio.Semaphore(max_in_flight)  # a slot per write in flight
+        self.__in_flight = set()  # the tasks of the writes in flight
+        self.__last_writes = {}  # (collection name, document id) -> task of the last write of the document
+
+    async def connect(self):
+        """
+        Checks the deployment, creates the statistics collection and the indexes and loads the seen filters
+        :raise pymongo.errors.ConnectionFailure: if the deployment cannot be reached
+        """
+        try:
+            await self.__mongo_client.admin.command('ping')
+        except errors.ConnectionFailure as e:
+            self.logger.critical("MongoDB database: " + str(e))
+            raise
+
+        await self.__create_statistics_collection()
+        await self.__create_indexes()
+        if self.__seen_filters:
+            await self.__warm_seen_filters()
+
+    async def __create_statistics_collection(self):
+        """
+        Creates the statistics collection as a time series collection (requires MongoDB 5.0) - on older servers
+        the snapshots go to a regular collection
+        """
+        if STATISTICS_COLLECTION in await self.__db.list_collection_names():
+            return
+
+        try:
+            await self.__db.create_collection(STATISTICS_COLLECTION, timeseries=STATISTICS_TIMESERIES)
+        except errors.CollectionInvalid:
+            pass  # created by another instance in the meantime
+        except errors.OperationFailure as e:
+            self.logger.warning("Time series collections are not supported, using a regular collection: " + str(e))
+
+    async def __create_indexes(self):
+        """
+        Creates the declared indexes - the indexes that already exist are left unchanged
+        """
+        for name, indexes in INDEXES.items():
+            try:
+                await self.__db[name].create_indexes([IndexModel(keys) for keys in indexes])
+            except errors.OperationFailure as e:
+                self.logger.error("Index creation failed for " + name + ": " + str(e))
+
+    async def __warm_seen_filters(self):
+        """
+        Loads the stored ids of the collections in the seen filters - the query is covered by the _id index
+        """
+        for name in SEEN_COLLECTIONS:
+            seen = SeenFilter()
+            async for document in self.__db[name].find({}, {'_id': 1}).batch_size(WARM_BATCH_SIZE):
+                seen.add(document['_id'])
+            self.__seen[name] = seen
+            self.logger.info("Seen filter of " + name + ": " + str(len(seen)) + " ids")
+
+    async def __find(self, collection, query, projection=None, batch_size=None):
+        """
+        Queries a collection - the writes in flight are applied first
+        :param collection: the collection
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip (the server default by default)
+        :return: a motor cursor, iterated with async for
+        """
+        await self.flush()
+        cursor = collection.find(query, projection)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    async def is_known(self, collection_name, document_id):
+        """
+        Checks if a document was stored or sent, without a round trip to the database while the filter is exact.
+        Once the filter holds many ids, a known id is confirmed with a query, since a bloom filter can report a new
+        id as seen
+        :param collection_name: the name of the collection (CHANNELS_COLLECTION, VIDEOS_COLLECTION, ...)
+        :param document_id: the id of the document
+        :return: True if the document is known, False if it is not or the filters are disabled
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is None or document_id not in seen:
+            return False
+        if seen.is_exact():
+            return True
+        await self.flush()
+        return await self.__db[collection_name].find_one({'_id': document_id}, {'_id': 1}) is not None
+
+    async def __submit(self, collection, document_id, write):
+        """
+        Sends a write in the background once a slot of the window is free. A write of a document starts after the
+        previous write of the same document is acknowledged
+        :param collection: the collection
+        :param document_id: the id of the written document or None if the write is not ordered
+        :param write: callable returning the awaitable of the write
+        """
+        await self.__window.acquire()
+        key = (collection.name, document_id) if document_id is not None else None
+        previous = self.__last_writes.get(key) if key else None
+
+        task = asyncio.ensure_future(self.__run_write(previous, write))
+        self.__in_flight.add(task)
+        task.add_done_callback(self.__in_flight.discard)
+        if key:
+            self.__last_writes[key] = task
+            task.add_done_callback(functools.partial(self.__forget_write, key))
+
+    def __forget_write(self, key, task):
+        """
+        Removes the acknowledged write of a document, unless a newer write of the document was sent
+        :param key: (collection name, document id)
+        :param task: the acknowledged task
+        """
+        if self.__last_writes.get(key) is task:
+            del self.__last_writes[key]
+
+    async def __run_write(self, previous, write):
+        """
+        Executes a write after the previous write of its document and frees its slot - the errors are logged
+        :param previous: the task of the previous write of the document or None
+        :param write: callable returning the awaitable of the write
+        """
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            await write()
+        except errors.DuplicateKeyError as e:
+            self.logger.info("Duplicate key: " + str(e))
+        except errors.BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    self.logger.info("Duplicate key: " + str(error.get('errmsg')))
+                else:
+                    self.logger.error("Bulk write error: " + str(error))
+        except errors.PyMongoError as e:
+            self.logger.error("Write failed: " + str(e))
+        finally:
+            self.__window.release()
+
+    async def __insert_new(self, collection, data, interaction=None):
+        """
+        Inserts a document unless the exact seen filter of the collection holds its id. A miss of the filter is a
+        new id, so the insert is sent in the background like the comments, which have no filter. Without the filters
+        or on a positive of a bloom filter, which can be false, the answer of the server is awaited to know if the id
+        was stored
+        :param collection: the collection
+        :param data: the document
+        :param interaction: optional interaction counted in the edges collection if the document is inserted
+        :return: True if the document was inserted or sent, False if it was already stored or on error
+        """
+        seen = self.__seen.get(collection.name)
+        if seen is not None and not seen.add(data['_id']):
+            if seen.is_exact():
+                return False
+        elif seen is not None or collection.name not in SEEN_COLLECTIONS:
+            await self.__submit(collection, data['_id'],
+                                functools.partial(self.__insert_counted, collection, data, interaction))
+            return True
+
+        await self.flush()
+        try:
+            await collection.insert_one(data)
+        except errors.DuplicateKeyError as e:
+            self.logger.info("Duplicate key: " + str(e))
+            return False
+        except errors.BulkWriteError as e:
+            self.logger.error("Bulk write error: " + str(e))
+            self.__forget_seen(collection.name, data['_id'])
+            return False
+        except errors.PyMongoError:
+            self.__forget_seen(collection.name, data['_id'])
+            raise
+        if interaction:
+            await self.insert_interactions([interaction])
+        return True
+
+    async def __insert_counted(self, collection, data, interaction):
+        """
+        Inserts a document and counts its interaction once the insert is acknowledged - a duplicate key is raised
+        before the interaction is counted. The id of a document that was not written for another reason is removed
+        from the seen filter
+        :param collection: the collection
+        :param data: the document
+        :param interaction: optional interaction of the document
+        """
+        try:
+            await collection.insert_one(data)
+        except errors.DuplicateKeyError:
+            raise
+        except errors.PyMongoError:
+            self.__forget_seen(collection.name, data['_id'])
+            raise
+        if interaction:
+            await self.__count_interactions([interaction])
+
+    def __forget_seen(self, collection_name, document_id):
+        """
+        Removes the id of a document that was not written from the seen filter of a collection, so it is not
+        skipped when it is inserted again
+        :param collection_name: the name of the collection
+        :param document_id: the id
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is not None:
+            seen.discard(document_id)
+
+    async def __upsert_counted(self, collection, documents, interactions):
+        """
+        Inserts or updates documents by id and counts the interactions of the documents that were inserted, also
+        when some of the upserts failed
+        :param collection: the collection
+        :param documents: list of documents with an _id
+        :param interactions: list of the interactions of the documents
+        """
+        upserted = set()
+        try:
+            result = await collection.bulk_write(upsert_operations(documents), ordered=False)
+            upserted = set(result.upserted_ids.values())
+        except errors.BulkWriteError as e:
+            upserted = {upsert['_id'] for upsert in e.details.get('upserted', [])}
+            raise
+        finally:
+            await self.__count_interactions([interaction for document, interaction in zip(documents, interactions)
+                                             if document['_id'] in upserted])
+
+    async def __count_interactions(self, interactions):
+        """
+        Counts interactions in the edges collection from a write in flight, without taking another slot
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+        for name, operations in interaction_operations(interactions).items():
+            if operations:
+                await self.__db[name].bulk_write(operations, ordered=False)
+
+    async def __update(self, collection, document_id, update):
+        """
+        Sends the update of a document in the background
+        :param collection: the collection
+        :param document_id: the id of the document
+        :param update: the update operators
+        """
+        await self.__submit(collection, document_id,
+                            functools.partial(collection.update_one, {'_id': document_id}, update))
+
+    async def __bulk_write(self, collection, operations):
+        """
+        Sends an unordered bulk write in the background - the duplicate keys are skipped operation by operation
+        :param collection: the collection
+        :param operations: list of write operations
+        """
+        if operations:
+            await self.__submit(collection, None, functools.partial(collection.bulk_write, operations, ordered=False))
+
+    async def flush(self):
+        """
+        Waits until the writes in flight are acknowledged
+        """
+        while self.__in_flight:
+            await asyncio.wait(list(self.__in_flight))
+
+    async def close(self):
+        """
+        Waits for the writes in flight and closes the client
+        """
+        await self.flush()
+        self.__mongo_client.close()
+
+    async def drop_database(self):
+        """
+        Removes all the collections of the database
+        """
+        await self.flush()
+        await self.__mongo_client.drop_database(self.__db.name)
+        self.__seen = {name: SeenFilter() for name in self.__seen}
+        await self.__create_statistics_collection()
+        await self.__create_indexes()
+
+    """ Search Results """
+
+    async def insert_search_results(self, query):
+        """
+        Stores search results
+        :param query: list of search result documents
+        """
+        await self.__submit(self.__search_results_col, None, functools.partial(
+            self.__search_results_col.insert_many, query, ordered=False))
+
+    async def get_search_results(self, query, projection=None, batch_size=None):
+        """
+        Returns the search results matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: motor cursor
+        """
+        return await self.__find(self.__search_results_col, query, projection, batch_size)
+
+    """ Channels """
+
+    async def insert_channel(self, data):
+        """
+        Stores a channel
+        :param data: the channel document
+        :return: True if the channel was inserted, False if it was already stored
+        """
+        return await self.__insert_new(self.__channels_col, data)
+
+    async def insert_channel_statistics(self, channel_id, statistics):
+        """
+        Stores a snapshot of the statistics of a channel and keeps the latest one on the channel document
+        :param channel_id: the id of the channel
+        :param statistics: dictionary with the counts of the channel
+        """
+        await self.insert_statistics_snapshot(CHANNEL_ENTITY, channel_id, statistics)
+        await self.__update(self.__channels_col, channel_id, {'$set': {'statistics': statistics}})
+
+    async def get_channel(self, query, projection=None, batch_size=None):
+        """
+        Returns the channels matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: motor cursor
+        """
+        return await self.__find(self.__channels_col, query, projection, batch_size)
+
+    """ Playlists """
+
+    async def insert_playlist(self, data):
+        """
+        Stores a playlist
+        :param data: the playlist document
+        :return: True if the playlist was inserted, False if it was already stored
+        """
+        return await self.__insert_new(self.__playlists_col, data)
+
+    """ Videos """
+
+    async def insert_video(self, data):
+        """
+        Stores a video
+        :param data: the video document
+        :return: True if the video was inserted, False if it was already stored
+        """
+        return await self.__insert_new(self.__videos_col, data)
+
+    async def get_video(self, query, projection=None, batch_size=None):
+        """
+        Returns the videos matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: motor cursor
+        """
+        return await self.__find(self.__videos_col, query, projection, batch_size)
+
+    async def set_comments_mark(self, video_id, mark):
+        """
+        Stores the newest comment thread retrieved for a video - the high-water mark of the delta comment crawl
+        :param video_id: the id of the video
+        :param mark: dictionary with the commentId and the publishedAt of the newest comment thread
+        """
+        await self.__update(self.__videos_col, video_id, {'$set': {'commentsMark': mark}})
+
+    async def get_comments_mark(self, video_id):
+        """
+        Returns the newest comment thread retrieved for a video
+        :param video_id: the id of the video
+        :return: dictionary with the commentId and the publishedAt or None if the video was never refreshed
+        """
+        await self.flush()
+        video = await self.__videos_col.find_one({'_id': video_id}, {'commentsMark': 1})
+        if video:
+            return video.get('commentsMark')
+        return None
+
+    async def insert_video_statistics(self, video_id, data):
+        """
+        Stores a snapshot of the statistics of a video and keeps the latest one on the video document
+        :param video_id: the id of the video
+        :param data: dictionary with the counts of the video
+        """
+        await self.insert_statistics_snapshot(VIDEO_ENTITY, video_id, data)
+        await self.__update(self.__videos_col, video_id, {'$set': {'statistics': data}})
+
+    """ Statistics """
+
+    async def insert_statistics_snapshot(self, entity_type, entity_id, statistics, timestamp=None):
+        """
+        Stores the statistics of a channel or a video at a moment in the statistics collection
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param statistics: dictionary with the counts - the api returns them as strings
+        :param timestamp: the moment of the snapshot (now by default)
+        """
+        snapshot = create_statistics_snapshot(entity_type, entity_id, statistics, timestamp)
+        await self.__submit(self.__statistics_col, None, functools.partial(self.__statistics_col.insert_one, snapshot))
+
+    async def get_statistics(self, entity_type, entity_id, since=None, batch_size=None):
+        """
+        Returns the snapshots of a channel or a video, oldest first
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param since: optional datetime of the oldest snapshot
+        :param batch_size: the number of snapshots returned per round trip
+        :return: motor cursor of snapshots
+        """
+        query = {'entity.type': entity_type, 'entity.id': entity_id}
+        if since is not None:
+            query['timestamp'] = {'$gte': since}
+        cursor = await self.__find(self.__statistics_col, query, {'_id': 0}, batch_size)
+        return cursor.sort('timestamp', pymongo.ASCENDING)
+
+    async def get_growth_rates(self, entity_type, metric, window=GROWTH_WINDOW, entity_ids=None, limit=None,
+                               batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes on the server how fast a count grows for each entity over a window
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param metric: the name of the count (subscriberCount, viewCount, ...)
+        :param window: timedelta of the window that ends now
+        :param entity_ids: optional list of entity ids - all the entities of the type by default
+        :param limit: optional number of fastest growing entities returned
+        :param batch_size: the number of results returned per round trip
+        :return: motor cursor of {'_id': entity id, 'first', 'last', 'growth', 'rate'} sorted by rate
+        """
+        await self.flush()
+        pipeline = growth_rates_pipeline(entity_type, metric, window, entity_ids, limit)
+        return self.__statistics_col.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    """ Comments """
+
+    async def insert_comment(self, data, source=None):
+        """
+        Stores a comment thread
+        :param data: the comment document
+        :param source: the id of the channel of the video, the source of the edge of the comment (no edge if None)
+        :return: True if the comment was inserted or sent, False if it was already stored
+        """
+        return await self.__insert_new(self.__comments_col, data, source and create_interaction(data, source))
+
+    async def get_comments(self, query, projection=None, batch_size=None):
+        """
+        Returns the comments matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: motor cursor
+        """
+        return await self.__find(self.__comments_col, query, projection, batch_size)
+
+    """ Replies """
+
+    async def insert_comment_reply(self, comment_id, reply, source=None):
+        """
+        Stores a reply of a comment thread
+        :param comment_id: the id of the comment thread
+        :param reply: the reply document
+        :param source: the id of the author of the comment thread (no edge if None)
+        """
+        await self.insert_comment_replies(comment_id, [reply], source)
+
+    async def insert_comment_replies(self, comment_id, replies, source=None):
+        """
+        Stores the replies of a comment thread in the replies collection, keyed by reply id with the id of the
+        thread as parentId - only the replies that the upserts insert are counted in the edges collection
+        :param comment_id: the id of the comment thread
+        :param replies: list of reply documents
+        :param source: the id of the author of the comment thread, the source of the edges of the replies (no edges
+        if None)
+        """
+        documents = [dict(reply, parentId=comment_id) for reply in replies]
+        if not source:
+            await self.__bulk_write(self.__replies_col, upsert_operations(documents))
+        elif documents:
+            interactions = [create_interaction(document, source) for document in documents]
+            await self.__submit(self.__replies_col, None,
+                                functools.partial(self.__upsert_counted, self.__replies_col, documents, interactions))
+
+    async def get_replies(self, query, projection=None, batch_size=None):
+        """
+        Returns the replies matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: motor cursor
+        """
+        return await self.__find(self.__replies_col, query, projection, batch_size)
+
+    async def migrate_replies(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Moves the replies embedded in the comments by the previous versions to the replies collection
+        :param batch_size: the number of comments migrated per bulk write
+        :return: the number of migrated comments
+        """
+        await self.flush()
+        comments = self.__comments_col.find({'replies': {'$exists': True}}, {'videoId': 1, 'replies': 1})
+        batches = []
+        async for comment in comments.batch_size(batch_size):
+            if not batches or len(batches[-1]) >= batch_size:
+                batches.append([])
+            batches[-1].append(comment)
+
+        migrated = 0
+        for batch in batches:
+            replies = [dict(reply, parentId=comment['_id'], videoId=reply.get('videoId', comment.get('videoId')))
+                       for comment in batch for reply in comment['replies']]
+            await self.__bulk_write(self.__replies_col, upsert_operations(replies))
+            await self.__bulk_write(self.__comments_col, [
+                UpdateOne({'_id': comment['_id']}, {'$unset': {'replies': ""}}) for comment in batch
+            ])
+            migrated += len(batch)
+        await self.flush()
+
+        self.logger.info("Migrated the replies of " + str(migrated) + " comments")
+        return migrated
+
+    """ Users Network """
+
+    async def get_interaction_edges(self, video_channels, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes the weighted edges of the users network on the server (requires MongoDB 4.4)
+        :param video_channels: dictionary video id -> id of the channel of the video
+        :param batch_size: the number of edges returned per round trip
+        :return: motor cursor of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+        await self.flush()
+        pipeline = interaction_edges_pipeline(video_channels)
+        return self.__comments_col.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    async def insert_interactions(self, interactions):
+        """
+        Counts new interactions in the edges collection and stores the names of their authors, in the background
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+        for name, operations in interaction_operations(interactions).items():
+            await self.__bulk_write(self.__db[name], operations)
+
+    async def backfill_network_edges(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Counts the comments and replies stored by the previous versions in the edges collection, with a single
+        aggregation that groups them by video and by edge
+        :param batch_size: the number of edges written per bulk write
+        :return: the number of backfilled edges
+        """
+        await self.flush()
+        if await self.__db[EDGES_COLLECTION].find_one({}, {'_id': 1}) is not None:
+            self.logger.warning("The edges collection is not empty, the backfill would count its interactions twice")
+            return 0
+        try:
+            claim = await self.__db[MIGRATIONS_COLLECTION].update_one(
+                {'_id': EDGES_BACKFILL_MIGRATION}, {'$setOnInsert': {'started': datetime.utcnow()}}, upsert=True
+            )
+            claimed = claim.upserted_id is not None
+        except errors.DuplicateKeyError:
+            claimed = False  # inserted by a concurrent call
+        if not claimed:
+            self.logger.info("The edges were already backfilled")
+            return 0
+
+        backfilled = 0
+        cursor = self.__comments_col.aggregate(interaction_backfill_pipeline(), allowDiskUse=True,
+                                               batchSize=batch_size)
+        batch = []
+        async for edge in cursor:
+            batch.append(dict(edge['_id'], weight=edge['weight'], name=edge['name']))
+            if len(batch) >= batch_size:
+                await self.__count_interactions(batch)
+                backfilled += len(batch)
+                batch = []
+        if batch:
+            await self.__count_interactions(batch)
+            backfilled += len(batch)
+
+        await self.__db[MIGRATIONS_COLLECTION].update_one(
+            {'_id': EDGES_BACKFILL_MIGRATION}, {'$set': {'completed': datetime.utcnow(), 'edges': backfilled}}
+        )
+        self.logger.info("Backfilled " + str(backfilled) + " edges of the users network")
+        return backfilled
+
+    async def get_network_edges(self, video_ids, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Reads the weighted edges of the users network of some videos from the edges collection
+        :param video_ids: list of video ids
+        :param batch_size: the number of edges returned per round trip
+        :return: motor cursor of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+        await self.flush()
+        return self.__db[EDGES_COLLECTION].aggregate(network_edges_pipeline(video_ids), allowDiskUse=True,
+                                                     batchSize=batch_size)
+
+    def watch_interactions(self, max_await_time_ms=CHANGE_STREAM_AWAIT_MS):
+        """
+        Opens a change stream on the comments and replies inserted in the database (requires a replica set)
+        :param max_await_time_ms: the maximum time the server waits for a change before returning an empty batch
+        :return: the motor change stream, iterated with async for
+        """
+        return self.__db.watch(INTERACTIONS_STREAM_PIPELINE, max_await_time_ms=max_await_time_ms)
+
+    """ Tokens """
+
+    async def insert_token(self, data):
+        """
+        Adds a page token to the queue
+        :param data: the token document
+        """
+        data = dict(data)
+        data.setdefault('state', TOKEN_PENDING)
+        data.setdefault('attempts', 0)
+        await self.flush()
+        try:
+            await self.__tokens_col.insert_one(data)
+        except errors.DuplicateKeyError as e:
+            self.logger.info("Duplicate key: " + str(e))
+        except errors.BulkWriteError as e:
+            self.logger.error("Bulk write error: " + str(e))
+
+    async def get_tokens(self, query=None, projection=None, batch_size=None):
+        """
+        Returns the tokens matching a query
+        :param query: filter of the tokens (all the tokens by default)
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: motor cursor
+        """
+        return await self.__find(self.__tokens_col, query or {}, projection, batch_size)
+
+    async def set_token_priorities(self, priorities):
+        """
+        Sets the priorities used to choose the next token to lease
+        :param priorities: dictionary token id -> priority
+        """
+        if not priorities:
+            return
+        await self.__tokens_col.bulk_write(
+            [UpdateOne({'_id': token_id}, {'$set': {'priority': p}}) for token_id, p in priorities.items()],
+            ordered=False
+        )
+
+    async def lease_token(self, owner, token_types, lease_seconds=TOKEN_LEASE_SECONDS,
+                          max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Atomically takes the pending token with the highest priority, or one whose lease has expired. Tokens that
+        were leased too many times are moved to the dead state
+        :param owner: the id of the worker
+        :param token_types: the types of tokens that can be leased
+        :param lease_seconds: the duration of the lease
+        :param max_attempts: the number of leases after which a token is dead
+        :return: the token or None if there are no tokens left
+        """
+        while True:
+            now = datetime.utcnow()
+            token = await self.__tokens_col.find_one_and_update(
+                token_lease_filter(token_types, now),
+                token_lease_update(owner, now, lease_seconds),
+                sort=[('priority', pymongo.DESCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+
+            if token is None or token['attempts'] <= max_attempts:
+                return token
+
+            self.logger.warning("Token [" + str(token['_id']) + "] failed " + str(max_attempts) + " times")
+            await self.__tokens_col.update_one(
+                {'_id': token['_id'], 'leaseOwner': owner},
+                {'$set': {'state': TOKEN_DEAD}, '$unset': {'leaseExpires': ""}}
+            )
+
+    async def complete_token(self, token_id, owner):
+        """
+        Removes a processed token from the queue, if the worker still holds its lease
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        """
+        await self.__tokens_col.delete_one({'_id': token_id, 'leaseOwner': owner})
+
+    async def release_token(self, token_id, owner, failed=True, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Gives back a token that was not processed
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        :param failed: False if the token was not processed for lack of quota - the attempt is not counted
+        :param max_attempts: the number of failed attempts after which the token is dead
+        """
+        query = {'_id': token_id, 'leaseOwner': owner, 'state': TOKEN_LEASED}
+        if not failed:
+            await self.__tokens_col.update_one(query, {'$set': {'state': TOKEN_PENDING}, '$inc': {'attempts': -1},
+                                                       '$unset': {'leaseOwner': "", 'leaseExpires': ""}})
+            return
+
+        await self.__tokens_col.update_one(dict(query, attempts={'$gte': max_attempts}),
+                                           {'$set': {'state': TOKEN_DEAD}, '$unset': {'leaseExpires': ""}})
+        await self.__tokens_col.update_one(query, {'$set': {'state': TOKEN_PENDING},
+                                                   '$unset': {'leaseOwner': "", 'leaseExpires': ""}})
+
+    async def remove_token(self, token_id):
+        """
+        Removes a token from the queue
+        :param token_id: the id of the token
+        """
+        try:
+            await self.__tokens_col.delete_one({'_id': token_id})
+        except errors.InvalidId as e:
+            self.logger.error("Invalid id: " + str(e))
+
+
+class BackgroundMongoDB(StorageBackend):
+    """
+    Storage backend for the threaded crawler on top of AsyncMongoDB: the event loop of the driver runs in a
+    background thread and the methods wait only for their slot in the write window, so the api calls of the
+    crawler overlap the writes of the previous pages
+    """
+
+    def __init__(self, database_name=DATABASE_NAME, seen_filters=True, buffered=True,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, read_batch_size=DEFAULT_READ_BATCH_SIZE, uri=None):
+        """
+        Init method for starting the event loop and connecting to the database
+        :param database_name: the name of the database
+        :param seen_filters: if True, the ids of the stored documents are kept in memory (see AsyncMongoDB)
+        :param buffered: if False, every write is acknowledged before the method returns
+        :param max_in_flight: the maximum number of writes sent and not yet acknowledged
+        :param read_batch_size: the number of documents fetched per round trip when batch_size is not given
+        :param uri: the connection string (MONGODB_URI by default)
+        :raise pymongo.errors.ConnectionFailure: if the deployment cannot be reached
+        """
+
+        # logging module
+        ml = MessageLogger('async_mongodb')
+        self.logger = ml.get_logger()
+
+        self.__buffered = buffered
+        self.__read_batch_size = read_batch_size
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, name="async-mongodb", daemon=True)
+        self.__thread.start()
+
+        self.__db = self.__call(self.__open(database_name, seen_filters, max_in_flight, uri))
+        try:
+            self.__call(self.__db.connect())
+        except errors.ConnectionFailure:
+            self.close()  # stops the event loop thread
+            raise
+        register_exit_flush(self)
+
+    @staticmethod
+    async def __open(database_name, seen_filters, max_in_flight, uri):
+        """
+        Creates the async storage on the event loop of the background thread
+        :return: the AsyncMongoDB
+        """
+        return AsyncMongoDB(database_name, seen_filters, max_in_flight, uri)
+
+    def __call(self, coroutine):
+        """
+        Runs a coroutine on the event loop and waits for its result
+        :param coroutine: the coroutine
+        :return: the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.__loop).result()
+
+    def __write(self, coroutine):
+        """
+        Runs a write - the method returns once the write is sent, or once it is acknowledged in unbuffered mode
+        :param coroutine: the coroutine of the write
+        :return: the result of the coroutine
+        """
+        result = self.__call(coroutine)
+        if not self.__buffered:
+            self.flush()
+        return result
+
+    def __iterate(self, coroutine, batch_size=None):
+        """
+        Iterates a motor cursor from the calling thread, a batch per round trip
+        :param coroutine: the coroutine returning the cursor
+        :param batch_size: the number of documents fetched per round trip
+        :return: generator of documents
+        """
+        cursor = self.__call(coroutine)
+        while True:
+            documents = self.__call(cursor.to_list(batch_size or self.__read_batch_size))
+            if not documents:
+                return
+            yield from documents
+
+    def is_known(self, collection_name, document_id):
+        return self.__call(self.__db.is_known(collection_name, document_id))
+
+    def flush(self):
+        self.__call(self.__db.flush())
+
+    def close(self):
+        """
+        Waits for the writes in flight, closes the client and stops the event loop
+        """
+        self.__call(self.__db.close())
+        unregister_exit_flush(self)
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+    def drop_database(self):
+        self.__call(self.__db.drop_database())
+
+    """ Search Results """
+
+    def insert_search_results(self, query):
+        self.__write(self.__db.insert_search_results(query))
+
+    def get_search_results(self, query, projection=None, batch_size=None):
+        return self.__iterate(self.__db.get_search_results(query, projection, batch_size), batch_size)
+
+    """ Channels """
+
+    def insert_channel(self, data):
+        return self.__write(self.__db.insert_channel(data))
+
+    def insert_channel_statistics(self, channel_id, statistics):
+        self.__write(self.__db.insert_channel_statistics(channel_id, statistics))
+
+    def get_channel(self, query, projection=None, batch_size=None):
+        return self.__iterate(self.__db.get_channel(query, projection, batch_size), batch_size)
+
+    """ Playlists """
+
+    def insert_playlist(self, data):
+        return self.__write(self.__db.insert_playlist(data))
+
+    """ Videos """
+
+    def insert_video(self, data):
+        return self.__write(self.__db.insert_video(data))
+
+    def get_video(self, query, projection=None, batch_size=None):
+        return self.__iterate(self.__db.get_video(query, projection, batch_size), batch_size)
+
+    def set_comments_mark(self, video_id, mark):
+        self.__write(self.__db.set_comments_mark(video_id, mark))
+
+    def get_comments_mark(self, video_id):
+        return self.__call(self.__db.get_comments_mark(video_id))
+
+    def insert_video_statistics(self, video_id, data):
+        self.__write(self.__db.insert_video_statistics(video_id, data))
+
+    """ Statistics """
+
+    def insert_statistics_snapshot(self, entity_type, entity_id, statistics, timestamp=None):
+        self.__write(self.__db.insert_statistics_snapshot(entity_type, entity_id, statistics, timestamp))
+
+    def get_statistics(self, entity_type, entity_id, since=None, batch_size=None):
+        return self.__iterate(self.__db.get_statistics(entity_type, entity_id, since, batch_size), batch_size)
+
+    def get_growth_rates(self, entity_type, metric, window=GROWTH_WINDOW, entity_ids=None, limit=None,
+                         batch_size=AGGREGATION_BATCH_SIZE):
+        return self.__iterate(self.__db.get_growth_rates(entity_type, metric, window, entity_ids, limit, batch_size),
+                              batch_size)
+
+    """ Comments """
+
+    def insert_comment(self, data, source=None):
+        return self.__write(self.__db.insert_comment(data, source))
+
+    def get_comments(self, query, projection=None, batch_size=None):
+        return self.__iterate(self.__db.get_comments(query, projection, batch_size), batch_size)
+
+    """ Replies """
+
+    def insert_comment_replies(self, comment_id, replies, source=None):
+        self.__write(self.__db.insert_comment_replies(comment_id, replies, source))
+
+    def get_replies(self, query, projection=None, batch_size=None):
+        return self.__iterate(self.__db.get_replies(query, projection, batch_size), batch_size)
+
+    def migrate_replies(self, batch_size=MIGRATION_BATCH_SIZE):
+        return self.__call(self.__db.migrate_replies(batch_size))
+
+    """ Users Network """
+
+    def get_interaction_edges(self, video_channels, batch_size=AGGREGATION_BATCH_SIZE):
+        return self.__iterate(self.__db.get_interaction_edges(video_channels, batch_size), batch_size)
+
+    def insert_interactions(self, interactions):
+        self.__write(self.__db.insert_interactions(interactions))
+
+    def backfill_network_edges(self, batch_size=MIGRATION_BATCH_SIZE):
+        return self.__call(self.__db.backfill_network_edges(batch_size))
+
+    def get_network_edges(self, video_ids, batch_size=AGGREGATION_BATCH_SIZE):
+        return self.__iterate(self.__db.get_network_edges(video_ids, batch_size), batch_size)
+
+    """ Tokens """
+
+    def insert_token(self, data):
+        self.__call(self.__db.insert_token(data))
+
+    def get_tokens(self, query=None, projection=None, batch_size=None):
+        return self.__iterate(self.__db.get_tokens(query, projection, batch_size), batch_size)
+
+    def set_token_priorities(self, priorities):
+        self.__call(self.__db.set_token_priorities(priorities))
+
+    def lease_token(self, owner, token_types, lease_seconds=TOKEN_LEASE_SECONDS, max_attempts=MAX_TOKEN_ATTEMPTS):
+        return self.__call(self.__db.lease_token(owner, token_types, lease_seconds, max_attempts))
+
+    def complete_token(self, token_id, owner):
+        self.__call(self.__db.complete_token(token_id, owner))
+
+    def release_token(self, token_id, owner, failed=True, max_attempts=MAX_TOKEN_ATTEMPTS):
+        self.__call(self.__db.release_token(token_id, owner, failed, max_attempts))
+
+    def remove_token(self, token_id):
+        self.__call(self.__db.remove_token(token_id))
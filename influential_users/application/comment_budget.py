@@ -0,0 +1,87 @@
+import heapq
+import itertools
+import math
+
+COMMENTS_PER_PAGE = 100  # the maximum number of comment threads in a page
+LAST_PAGE_WEIGHT = 0.5  # weight of the last page in the estimate of the new authors of the next page
+
+
+class CommentBudget:
+    """
+    Spreads a total number of comment pages across videos. The next page always goes to the video whose next page
+    is expected to bring the most new authors - estimated from the comment count of the video at first, then from
+    the number of new authors found in its previous pages
+    """
+
+    def __init__(self, total_pages):
+        """
+        Class constructor
+        :param total_pages: the number of comment pages that can be requested
+        """
+        self.__remaining = total_pages
+        self.__heap = []  # (-expected new authors, insertion order, video id)
+        self.__order = itertools.count()
+        self.__expected = {}  # video id -> expected new authors of the next page
+        self.__pages_left = {}  # video id -> number of pages that were not requested yet
+
+    def add_video(self, video_id, comment_count):
+        """
+        Adds a video to the crawl
+        :param video_id: the id of the video
+        :param comment_count: the number of comments of the video from its statistics
+        """
+        comment_count = int(comment_count)
+        if comment_count <= 0 or video_id in self.__expected:
+            return
+
+        self.__expected[video_id] = min(comment_count, COMMENTS_PER_PAGE)
+        self.__pages_left[video_id] = math.ceil(comment_count / COMMENTS_PER_PAGE)
+        self.__push(video_id)
+
+    def next_video(self):
+        """
+        Takes a page from the budget for the video with the highest expected gain
+        :return: the id of the video or None if the budget is spent or all the pages were requested
+        """
+        if self.__remaining <= 0 or not self.__heap:
+            return None
+
+        _, _, video_id = heapq.heappop(self.__heap)
+        self.__remaining -= 1
+        self.__pages_left[video_id] -= 1
+        return video_id
+
+    def record_page(self, video_id, new_authors, has_more):
+        """
+        Updates the estimate of a video with the result of its last page
+        :param video_id: the id of the video
+        :param new_authors: the number of authors of the page that were not seen before
+        :param has_more: True if the video has more pages
+        """
+        self.__expected[video_id] = (LAST_PAGE_WEIGHT * new_authors +
+                                     (1 - LAST_PAGE_WEIGHT) * self.__expected[video_id])
+        if has_more:
+            self.__pages_left[video_id] = max(self.__pages_left[video_id], 1)
+            self.__push(video_id)
+
+    def get_remaining(self):
+        """
+        Returns the number of pages left in the budget
+        :return: the number of pages
+        """
+        return self.__remaining
+
+    def get_pending_videos(self):
+        """
+        Returns the videos that still have pages that were not requested
+        :return: list of video ids
+        """
+        return [video_id for _, _, video_id in self.__heap]
+
+    def __push(self, video_id):
+        """
+        Adds the next page of a video to the priority queue
+        :param video_id: the id of the video
+        """
+        if self.__pages_left[video_id] > 0:
+            heapq.heappush(self.__heap, (-self.__expected[video_id], next(self.__order), video_id))
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class CrawlExecutor:
+    """
+    Bounded thread pool used to crawl independent resources (channels, playlists, videos) in parallel.
+    Tasks can submit other tasks (a channel submits its playlists) and wait() blocks until all of them are done.
+    With a single worker the tasks are executed inline, in the order they are submitted
+    """
+
+    def __init__(self, max_workers=1):
+        """
+        Class constructor
+        :param max_workers: the maximum number of tasks that are executed at the same time
+        """
+        self.__pool = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+        self.__pending = 0
+        self.__condition = threading.Condition()
+        self.__stopped = threading.Event()
+        self.__errors = []
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules a task for execution. Tasks submitted after the executor was stopped are ignored
+        :param fn: the function that is called
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        """
+        if self.__stopped.is_set():
+            return
+
+        with self.__condition:
+            self.__pending += 1
+
+        if self.__pool is None:
+            self.__run(fn, args, kwargs)
+        else:
+            self.__pool.submit(self.__run, fn, args, kwargs)
+
+    def stop(self):
+        """
+        Stops the executor - the tasks that are already running are finished, the rest are dropped
+        """
+        self.__stopped.set()
+
+    def is_stopped(self):
+        """
+        Checks if the executor was stopped by one of the tasks
+        :return: True if the executor was stopped
+        """
+        return self.__stopped.is_set()
+
+    def wait(self):
+        """
+        Waits until all the submitted tasks (including the ones submitted by other tasks) are finished and
+        releases the worker threads. The first exception raised by a task is raised again
+        """
+        with self.__condition:
+            while self.__pending > 0:
+                self.__condition.wait()
+
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
+
+        if self.__errors:
+            raise self.__errors[0]
+
+    def __run(self, fn, args, kwargs):
+        """
+        Executes a task and keeps track of the number of unfinished tasks
+        :param fn: the function that is called
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+        """
+        try:
+            if not self.__stopped.is_set():
+                fn(*args, **kwargs)
+        except Exception as e:
+            self.__errors.append(e)
+            self.__stopped.set()
+        finally:
+            with self.__condition:
+                self.__pending -= 1
+                self.__condition.notify_all()
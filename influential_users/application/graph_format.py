@@ -0,0 +1,144 @@
+import os
+from array import array
+
+import networkx as nx
+import numpy as np
+
+NODES_SUFFIX = '.nodes.npy'  # the interned node ids, as fixed width bytes
+OFFSETS_SUFFIX = '.offsets.npy'  # int32, the edges of node i are at offsets[i]:offsets[i + 1]
+TARGETS_SUFFIX = '.targets.npy'  # int32, the index of the target of each edge
+WEIGHTS_SUFFIX = '.weights.npy'  # float32, the weight of each edge
+MAX_EDGES = np.iinfo(np.int32).max  # the offsets are int32
+
+
+class CsrGraph:
+    """
+    Weighted directed graph in compressed sparse row form: the node ids are interned in a table and the edges are
+    stored as int32 offsets and targets and float32 weights, sorted by source. The arrays are saved as .npy files
+    that are memory mapped when the graph is loaded, so a network of millions of edges opens without parsing or
+    copying, and is converted to networkx only when an algorithm needs it
+    """
+
+    def __init__(self, nodes, offsets, targets, weights):
+        """
+        Class constructor
+        :param nodes: array of the node ids (bytes), in index order
+        :param offsets: int32 array of len(nodes) + 1 offsets in targets and weights
+        :param targets: int32 array of the target index of each edge
+        :param weights: float32 array of the weight of each edge
+        """
+        self.nodes = nodes
+        self.offsets = offsets
+        self.targets = targets
+        self.weights = weights
+
+    @classmethod
+    def from_edges(cls, edges):
+        """
+        Builds the graph from a stream of edges - the ids are interned as they arrive, so only the indexes of the
+        edges are kept in memory
+        :param edges: iterable of (source id, target id, weight)
+        :return: the CsrGraph
+        :raise ValueError: if there are more edges than the int32 offsets can address
+        """
+        index = {}  # node id -> node index
+        sources = array('i')
+        targets = array('i')
+        weights = array('f')
+        for source, target, weight in edges:
+            sources.append(index.setdefault(source, len(index)))
+            targets.append(index.setdefault(target, len(index)))
+            weights.append(weight)
+        if len(sources) > MAX_EDGES:
+            raise ValueError("Too many edges for int32 offsets: " + str(len(sources)))
+
+        sources = np.frombuffer(sources, dtype=np.intc).astype(np.int32, copy=False)
+        order = np.argsort(sources, kind='stable')
+        offsets = np.zeros(len(index) + 1, dtype=np.int32)
+        np.cumsum(np.bincount(sources, minlength=len(index)), out=offsets[1:])
+
+        return cls(
+            np.array([node.encode('utf-8') for node in index], dtype=bytes),
+            offsets,
+            np.frombuffer(targets, dtype=np.intc).astype(np.int32, copy=False)[order],
+            np.frombuffer(weights, dtype=np.float32)[order]
+        )
+
+    @staticmethod
+    def exists(path):
+        """
+        Checks if a graph was saved
+        :param path: the path of the files without the suffixes
+        :return: True if all the arrays of the graph exist
+        """
+        return all(os.path.exists(path + suffix)
+                   for suffix in (NODES_SUFFIX, OFFSETS_SUFFIX, TARGETS_SUFFIX, WEIGHTS_SUFFIX))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Opens a saved graph
+        :param path: the path of the files without the suffixes
+        :param mmap: if True, the arrays are memory mapped read only instead of read in memory
+        :return: the CsrGraph
+        """
+        mode = 'r' if mmap else None
+        return cls(*(np.load(path + suffix, mmap_mode=mode)
+                     for suffix in (NODES_SUFFIX, OFFSETS_SUFFIX, TARGETS_SUFFIX, WEIGHTS_SUFFIX)))
+
+    def save(self, path):
+        """
+        Writes the arrays of the graph
+        :param path: the path of the files without the suffixes
+        """
+        np.save(path + NODES_SUFFIX, self.nodes)
+        np.save(path + OFFSETS_SUFFIX, self.offsets)
+        np.save(path + TARGETS_SUFFIX, self.targets)
+        np.save(path + WEIGHTS_SUFFIX, self.weights)
+
+    def number_of_nodes(self):
+        return len(self.nodes)
+
+    def number_of_edges(self):
+        return len(self.targets)
+
+    def node_id(self, node):
+        """
+        Returns the id of a node
+        :param node: the index of the node
+        :return: the id string
+        """
+        return self.nodes[node].decode('utf-8')
+
+    def neighbors(self, node):
+        """
+        Returns the edges of a node, without copying the arrays
+        :param node: the index of the node
+        :return: (array of the target indexes, array of the weights)
+        """
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return self.targets[start:end], self.weights[start:end]
+
+    def to_networkx(self, directed=False):
+        """
+        Converts the graph to networkx
+        :param directed: if False, the weights of the two directions of an edge are summed in an undirected graph
+        :return: the networkx Graph or DiGraph, with the ids as nodes and the weights as 'weight' edge attributes
+        """
+        graph = nx.DiGraph() if directed else nx.Graph()
+        ids = [node.decode('utf-8') for node in self.nodes]
+        graph.add_nodes_from(ids)
+
+        count = np.int64(len(ids))
+        sources = np.repeat(np.arange(len(ids), dtype=np.int64), np.diff(self.offsets))
+        targets = np.asarray(self.targets, dtype=np.int64)
+        if not directed:
+            # both directions of an edge get the same (lower, higher) key, so their weights are summed together
+            sources, targets = np.minimum(sources, targets), np.maximum(sources, targets)
+        keys, inverse = np.unique(sources * count + targets, return_inverse=True)
+        weights = np.bincount(inverse, weights=np.asarray(self.weights, dtype=np.float64), minlength=len(keys))
+        sources, targets = np.divmod(keys, count)
+
+        graph.add_weighted_edges_from(zip(map(ids.__getitem__, sources.tolist()),
+                                          map(ids.__getitem__, targets.tolist()), weights.tolist()))
+        return graph
@@ -0,0 +1,223 @@
+import threading
+
+import networkx as nx
+from pymongo import errors
+
+from influential_users.application.message_logger import MessageLogger
+from influential_users.application.storage import COMMENTS_COLLECTION, REPLIES_COLLECTION
+
+DEFAULT_BATCH_SIZE = 1000  # the number of comments and replies read per round trip when the graph is loaded
+PAGE_RANK_ALPHA = 0.9
+
+
+class GraphStream:
+    """
+    Users network kept up to date while the crawl runs. The edges of the stored comments and replies are loaded
+    once, then the comments and replies inserted afterwards are applied as they arrive on a MongoDB change stream,
+    so the rankings can be computed at any time without rebuilding the network. The change streams need a replica
+    set - a single node one is enough (mongod --replSet rs0, then rs.initiate() in the shell)
+    """
+
+    def __init__(self, db, video_channels=None, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        Class constructor
+        :param db: the MongoDB storage backend
+        :param video_channels: dictionary video id -> id of the channel of the video, for the network of a search
+        (all the crawled videos by default)
+        :param batch_size: the number of documents read per round trip when the graph is loaded
+        """
+        # logging module
+        ml = MessageLogger('graph_stream')
+        self.logger = ml.get_logger()
+
+        self.__db = db
+        self.__video_channels = dict(video_channels) if video_channels is not None else {}
+        self.__follow_all = video_channels is None
+        self.__batch_size = batch_size
+
+        self.__graph = nx.Graph()
+        self.__labels = {}  # node id -> name of the channel or the author
+        self.__lock = threading.Lock()  # guards the graph and the labels
+        self.__comment_authors = {}  # comment id -> author id, the source of the edges of the replies
+        self.__seen_replies = set()  # the ids of the applied replies
+        self.__pending = {}  # comment id -> replies received before their comment
+        self.__stop = threading.Event()
+        self.__thread = None
+        self.interactions = 0  # the number of comments and replies applied to the graph
+
+    def start(self):
+        """
+        Opens the change stream, loads the stored interactions and starts applying the new ones in a background
+        thread. The stream is opened first, so the interactions stored during the load are not missed
+        :return: True if the stream was started, False on error
+        """
+        if not hasattr(self.__db, 'watch_interactions'):
+            self.logger.error("Change streams need the MongoDB storage backend")
+            return False
+
+        try:
+            stream = self.__db.watch_interactions()
+        except errors.PyMongoError as e:
+            self.logger.error("Change stream not available (a replica set is needed): " + str(e))
+            return False
+
+        self.__load_channel_labels()
+        self.__load()
+        self.logger.info("Loaded " + str(self.interactions) + " interactions")
+
+        self.__stop.clear()
+        self.__thread = threading.Thread(target=self.__run, args=(stream,), name="graph-stream", daemon=True)
+        self.__thread.start()
+        return True
+
+    def stop(self):
+        """
+        Stops applying the new interactions - the graph keeps the applied ones
+        """
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.__thread = None
+
+    def get_graph(self):
+        """
+        Returns a copy of the current network
+        :return: the networkx Graph, with the number of interactions between two users as edge weight
+        """
+        with self.__lock:
+            return self.__graph.copy()
+
+    def get_labels(self):
+        """
+        Returns the names of the nodes
+        :return: dictionary node id -> name
+        """
+        with self.__lock:
+            return dict(self.__labels)
+
+    def compute_page_rank(self, top=5):
+        """
+        Ranks the users of the current network with page rank
+        :param top: the number of users returned
+        :return: list of (name, value) of the users with the highest values
+        """
+        graph = self.get_graph()
+        labels = self.get_labels()
+        if graph.number_of_nodes() == 0:
+            return []
+
+        rank = nx.pagerank(graph, alpha=PAGE_RANK_ALPHA)
+        return [(labels.get(node, node), rank[node]) for node in sorted(rank, key=rank.get, reverse=True)[:top]]
+
+    def __run(self, stream):
+        """
+        Applies the changes of the stream until the graph is stopped
+        :param stream: the change stream
+        """
+        try:
+            with stream:
+                while not self.__stop.is_set():
+                    change = stream.try_next()
+                    if change is None:
+                        continue
+                    if change['ns']['coll'] == COMMENTS_COLLECTION:
+                        self.__add_comment(change['fullDocument'])
+                    elif change['ns']['coll'] == REPLIES_COLLECTION:
+                        self.__add_reply(change['fullDocument'])
+        except errors.PyMongoError as e:
+            self.logger.error("Change stream stopped: " + str(e))
+
+    def __load(self):
+        """
+        Applies the comments and replies that are already stored
+        """
+        query = {}
+        if not self.__follow_all:
+            query = {'videoId': {'$in': list(self.__video_channels)}}
+        projection = {'videoId': 1, 'authorId': 1, 'authorName': 1}
+
+        for comment in self.__db.get_comments(query, projection, batch_size=self.__batch_size):
+            self.__add_comment(comment)
+        for reply in self.__db.get_replies(query, dict(projection, parentId=1), batch_size=self.__batch_size):
+            self.__add_reply(reply)
+
+    def __load_channel_labels(self):
+        """
+        Reads the names of the channels of the followed videos
+        """
+        if self.__follow_all:
+            return
+        channel_ids = list(set(self.__video_channels.values()))
+        for channel in self.__db.get_channel({'_id': {'$in': channel_ids}}, {'title': 1}):
+            self.__labels[channel['_id']] = channel['title']
+
+    def __get_channel(self, video_id):
+        """
+        Returns the channel of a video
+        :param video_id: the id of the video
+        :return: the id of the channel or None if the video is not followed
+        """
+        if not self.__follow_all:
+            return self.__video_channels.get(video_id)
+
+        if video_id not in self.__video_channels:
+            video = next(iter(self.__db.get_video({'_id': video_id}, {'channelId': 1})), None)
+            channel_id = video.get('channelId') if video else None
+            self.__video_channels[video_id] = channel_id
+            if channel_id and channel_id not in self.__labels:
+                channel = next(iter(self.__db.get_channel({'_id': channel_id}, {'title': 1})), None)
+                if channel:
+                    with self.__lock:
+                        self.__labels.setdefault(channel_id, channel['title'])
+        return self.__video_channels[video_id]
+
+    def __add_comment(self, comment):
+        """
+        Adds the edge from the channel of the video to the author of a comment, then the edges of the replies
+        that were waiting for the comment
+        :param comment: the comment document
+        """
+        channel_id = self.__get_channel(comment.get('videoId'))
+        if channel_id is None or comment['_id'] in self.__comment_authors:
+            return
+
+        author_id = comment.get('authorId')
+        self.__comment_authors[comment['_id']] = author_id
+        self.__add_edge(channel_id, author_id, comment.get('authorName'))
+        for reply in self.__pending.pop(comment['_id'], []):
+            self.__add_edge(author_id, reply.get('authorId'), reply.get('authorName'))
+
+    def __add_reply(self, reply):
+        """
+        Adds the edge from the author of a comment to the author of a reply - a reply received before its comment
+        waits for it
+        :param reply: the reply document
+        """
+        if self.__get_channel(reply.get('videoId')) is None or reply['_id'] in self.__seen_replies:
+            return
+        self.__seen_replies.add(reply['_id'])
+
+        parent_id = reply.get('parentId')
+        if parent_id not in self.__comment_authors:
+            self.__pending.setdefault(parent_id, []).append(reply)
+            return
+        self.__add_edge(self.__comment_authors[parent_id], reply.get('authorId'), reply.get('authorName'))
+
+    def __add_edge(self, source, target, name):
+        """
+        Adds an interaction to the graph
+        :param source: the id of the channel or the author that received the interaction
+        :param target: the id of the author of the interaction
+        :param name: the name of the author
+        """
+        if not source or not target:
+            return
+
+        with self.__lock:
+            if self.__graph.has_edge(source, target):
+                self.__graph[source][target]['weight'] += 1
+            else:
+                self.__graph.add_edge(source, target, weight=1)
+            if name:
+                self.__labels[target] = name
+            self.interactions += 1
@@ -0,0 +1,146 @@
+import threading
+from concurrent.futures import Future
+
+MAX_IDS_PER_REQUEST = 50  # the maximum number of ids accepted by the list endpoints of the youtube api
+
+
+class IdBatcher:
+    """
+    Coalesces the id lookups of a list endpoint (channels.list, videos.list) that accepts a limited number of
+    ids per request. The ids from all the callers are queued and requested in full chunks; each caller
+    receives a future with the results of its own ids
+    """
+
+    def __init__(self, fetch, batch_size=MAX_IDS_PER_REQUEST):
+        """
+        Class constructor
+        :param fetch: function that requests a list of ids and returns a dictionary id -> result (False on error)
+        :param batch_size: the number of ids sent in a request
+        """
+        self.__fetch = fetch
+        self.__batch_size = batch_size
+        self.__lock = threading.Lock()
+        self.__pending = []  # ids that were not requested yet, in the order they were added
+        self.__waiting = {}  # id -> the lookups that are waiting for it
+
+    def add(self, ids):
+        """
+        Queues the ids for lookup. Full chunks are requested right away, the rest when flush() is called
+        :param ids: list of ids
+        :return: a future with the dictionary id -> result of the given ids (False if a request failed)
+        """
+        lookup = _Lookup(ids)
+        if not lookup.remaining:
+            lookup.future.set_result({})
+            return lookup.future
+
+        with self.__lock:
+            for item_id in lookup.remaining:
+                if item_id not in self.__waiting:
+                    self.__waiting[item_id] = []
+                    self.__pending.append(item_id)
+                self.__waiting[item_id].append(lookup)
+            chunks = self.__take_chunks(full_only=True)
+
+        self.__request(chunks)
+
+        return lookup.future
+
+    def flush(self):
+        """
+        Requests all the queued ids, including the last incomplete chunk
+        """
+        with self.__lock:
+            chunks = self.__take_chunks(full_only=False)
+
+        self.__request(chunks)
+
+    def __take_chunks(self, full_only):
+        """
+        Removes the chunks that will be requested from the queue. Must be called with the lock acquired
+        :param full_only: if True, only the chunks with batch_size ids are taken
+        :return: the list of chunks
+        """
+        chunks = []
+        while len(self.__pending) >= self.__batch_size or (self.__pending and not full_only):
+            chunks.append(self.__pending[:self.__batch_size])
+            del self.__pending[:self.__batch_size]
+        return chunks
+
+    def __request(self, chunks):
+        """
+        Requests the chunks and dispatches the results to the lookups that are waiting for them. If a request
+        raises, the lookups waiting for its ids and for the ids of the next chunks receive the exception, and the
+        ids can be queued again
+        :param chunks: the list of chunks
+        :raise Exception: the exception raised by the fetch function
+        """
+        for index, chunk in enumerate(chunks):
+            try:
+                results = self.__fetch(chunk)
+            except Exception as e:
+                self.__fail([item_id for failed in chunks[index:] for item_id in failed], e)
+                raise
+
+            with self.__lock:
+                lookups = [(item_id, self.__waiting.pop(item_id, [])) for item_id in chunk]
+
+            for item_id, waiting in lookups:
+                for lookup in waiting:
+                    lookup.resolve(item_id, results)
+
+    def __fail(self, ids, exception):
+        """
+        Removes ids that will not be requested from the waiting lookups and sets the exception on their futures
+        :param ids: list of ids
+        :param exception: the exception of the request
+        """
+        with self.__lock:
+            lookups = {id(lookup): lookup for item_id in ids for lookup in self.__waiting.pop(item_id, [])}
+
+        for lookup in lookups.values():
+            lookup.fail(exception)
+
+
+class _Lookup:
+    """
+    The ids requested by a caller of the batcher and the future with their results
+    """
+
+    def __init__(self, ids):
+        self.remaining = set(ids)
+        self.results = {}
+        self.failed = False
+        self.future = Future()
+        self.__done = False
+        self.__lock = threading.Lock()
+
+    def resolve(self, item_id, results):
+        """
+        Stores the result of an id and completes the future when all the ids have been requested
+        :param item_id: the id
+        :param results: the results of the request that contained the id (False on error)
+        """
+        with self.__lock:
+            if results is False:
+                self.failed = True
+            elif item_id in results:
+                self.results[item_id] = results[item_id]
+            self.remaining.discard(item_id)
+            done = not self.remaining and not self.__done
+            self.__done = self.__done or done
+
+        if done:
+            self.future.set_result(False if self.failed else self.results)
+
+    def fail(self, exception):
+        """
+        Completes the future with the exception of a request, unless it was already completed
+        :param exception: the exception
+        """
+        with self.__lock:
+            done = not self.__done
+            self.__done = True
+
+        if done:
+            self.future.set_exception(exception)
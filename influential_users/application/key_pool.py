@@ -0,0 +1,123 @@
+import json
+import threading
+
+from influential_users.application.quota_scheduler import DEFAULT_DAILY_QUOTA, QuotaExhaustedError, QuotaScheduler
+
+DEFAULT_WORKERS_PER_KEY = 4  # the number of requests made at the same time with a key
+QUOTA_ERROR_REASONS = ['quotaExceeded', 'dailyLimitExceeded']
+
+
+def is_quota_error(error):
+    """
+    Checks if a http error of the youtube api was caused by the exhausted quota of the key
+    :param error: the HttpError
+    :return: True for quota errors
+    """
+    if error.resp.status != 403:
+        return False
+    try:
+        reasons = [details.get('reason') for details in json.loads(error.content)['error']['errors']]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(reason in QUOTA_ERROR_REASONS for reason in reasons)
+
+
+class ApiKey:
+    """
+    A developer key of the youtube api with its own quota and number of requests in progress
+    """
+
+    def __init__(self, key, daily_quota, workers):
+        """
+        Class constructor
+        :param key: the developer key
+        :param daily_quota: the number of quota units of the key per day
+        :param workers: the maximum number of requests in progress
+        """
+        self.key = key
+        self.quota = QuotaScheduler(daily_quota)
+        self.workers = workers
+        self.in_progress = 0
+        self.exhausted = False
+
+
+class KeyPool:
+    """
+    Pool of developer keys (one per google cloud project). Each request is made with the key that has the most
+    quota left and a free worker slot; a key that receives a quotaExceeded error is skipped until the pool is
+    created again
+    """
+
+    def __init__(self, keys, daily_quota=DEFAULT_DAILY_QUOTA, workers_per_key=DEFAULT_WORKERS_PER_KEY):
+        """
+        Class constructor
+        :param keys: list of developer keys
+        :param daily_quota: the number of quota units of each key per day
+        :param workers_per_key: the maximum number of requests in progress for each key
+        """
+        self.__keys = [ApiKey(key, daily_quota, workers_per_key) for key in keys]
+        self.__condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def get_keys(self):
+        """
+        Returns the developer keys of the pool
+        :return: list of keys
+        """
+        return [api_key.key for api_key in self.__keys]
+
+    def acquire(self, endpoint):
+        """
+        Takes a worker slot of the key with the most quota left that can make a request to the endpoint, waiting
+        if all of them are busy
+        :param endpoint: the name of the endpoint (search, channels, videos, ...)
+        :return: the ApiKey, must be given back with release()
+        :raise QuotaExhaustedError: if no key has enough quota for the request
+        """
+        with self.__condition:
+            while True:
+                candidates = [api_key for api_key in self.__keys
+                              if not api_key.exhausted and api_key.quota.can_afford(endpoint)]
+                if not candidates:
+                    raise QuotaExhaustedError("All the developer keys are exhausted")
+
+                free = [api_key for api_key in candidates if api_key.in_progress < api_key.workers]
+                if free:
+                    api_key = min(free, key=lambda k: sum(k.quota.get_used().values()))
+                    api_key.in_progress += 1
+                    return api_key
+
+                self.__condition.wait()
+
+    def release(self, api_key):
+        """
+        Gives back the worker slot of a key
+        :param api_key: the ApiKey returned by acquire()
+        """
+        with self.__condition:
+            api_key.in_progress -= 1
+            self.__condition.notify_all()
+
+    def mark_exhausted(self, api_key):
+        """
+        Stops using a key - called when the api reports that its quota is exceeded
+        :param api_key: the ApiKey
+        """
+        with self.__condition:
+            api_key.exhausted = True
+            self.__condition.notify_all()
+
+    def get_usage(self):
+        """
+        Returns the quota used by each key
+        :return: dictionary key suffix -> used units and exhausted state
+        """
+        with self.__condition:
+            return {
+                "..." + str(api_key.key)[-4:]: {
+                    'used': sum(api_key.quota.get_used().values()),
+                    'exhausted': api_key.exhausted
+                } for api_key in self.__keys
+            }
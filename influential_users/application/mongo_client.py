@@ -0,0 +1,92 @@
+import importlib.util
+import os
+import threading
+
+import pymongo
+from dotenv import load_dotenv
+
+load_dotenv()
+MONGODB_URI = os.getenv('MONGODB_URI', "mongodb://localhost:27017/")
+MONGODB_COMPRESSORS = os.getenv('MONGODB_COMPRESSORS', "zstd,snappy,zlib")  # in order of preference
+
+# client options that are set only when their variable is defined - the keyword arguments of MongoClient take
+# precedence over the uri, so the defaults are left to the uri and to pymongo
+MONGODB_ENV_OPTIONS = {
+    'MONGODB_MAX_POOL_SIZE': 'maxPoolSize',  # connections per server
+    'MONGODB_MIN_POOL_SIZE': 'minPoolSize',
+    'MONGODB_WRITE_CONCERN': 'w',  # number of nodes or "majority"
+    'MONGODB_READ_CONCERN': 'readConcernLevel',
+    'MONGODB_READ_PREFERENCE': 'readPreference',
+}
+
+# the python modules needed by the wire compressors - zlib is part of the standard library
+COMPRESSOR_MODULES = {
+    'zstd': 'zstandard',
+    'snappy': 'snappy',
+    'zlib': 'zlib',
+}
+
+_clients = {}  # uri -> MongoClient shared by the whole process
+_clients_lock = threading.Lock()
+
+
+def get_compressors(compressors=MONGODB_COMPRESSORS):
+    """
+    Returns the wire compressors that can be used - the ones whose module is not installed are skipped
+    :param compressors: comma separated compressors in order of preference
+    :return: comma separated compressors
+    """
+    available = [name for name in compressors.split(',')
+                 if name in COMPRESSOR_MODULES and importlib.util.find_spec(COMPRESSOR_MODULES[name])]
+    return ','.join(available)
+
+
+def get_client_options():
+    """
+    Returns the options of the clients, configured from the environment - shared by the pymongo and the motor clients
+    :return: dictionary of MongoClient keyword arguments
+    """
+    options = {}
+    for variable, option in MONGODB_ENV_OPTIONS.items():
+        value = os.getenv(variable)
+        if value:
+            options[option] = int(value) if value.isdigit() else value
+    compressors = get_compressors()
+    if compressors:
+        options['compressors'] = compressors
+    return options
+
+
+def get_client(uri=None):
+    """
+    Returns the client of a deployment, shared by all the MongoDB instances of the process so they use the same
+    connection pool. The client is created on first use, configured from the environment, and the deployment is
+    checked once with a ping
+    :param uri: the connection string (MONGODB_URI by default)
+    :return: the MongoClient
+    :raise pymongo.errors.ConnectionFailure: if the deployment cannot be reached
+    """
+    uri = uri or MONGODB_URI
+
+    with _clients_lock:
+        client = _clients.get(uri)
+        if client is None:
+            client = pymongo.MongoClient(uri, **get_client_options())
+            try:
+                client.admin.command('ping')
+            except pymongo.errors.PyMongoError:
+                client.close()
+                raise
+            _clients[uri] = client
+
+    return client
+
+
+def close_clients():
+    """
+    Closes the shared clients - the next call of get_client() creates a new one
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
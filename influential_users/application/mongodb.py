@@ -1,27 +1,246 @@
+import threading
+import time
+import weakref
+from datetime import datetime
+
 import pymongo
-from pymongo import errors
+from pymongo import errors, IndexModel, InsertOne, ReturnDocument, UpdateOne
 
 from influential_users.application.message_logger import MessageLogger
+from influential_users.application.mongo_client import get_client
+from influential_users.application.seen_filter import SeenFilter
+from influential_users.application.storage import (
+    AGGREGATION_BATCH_SIZE, AUTHORS_COLLECTION, CHANNEL_ENTITY, CHANNELS_COLLECTION, COMMENTS_COLLECTION,
+    DATABASE_NAME, DEFAULT_BUFFER_SIZE, DEFAULT_FLUSH_INTERVAL, EDGES_BACKFILL_MIGRATION, EDGES_COLLECTION,
+    GROWTH_WINDOW, MAX_TOKEN_ATTEMPTS, MIGRATION_BATCH_SIZE, MIGRATIONS_COLLECTION, PLAYLISTS_COLLECTION,
+    REPLIES_COLLECTION, SEARCH_RESULTS_COLLECTION, SEEN_COLLECTIONS, STATISTICS_COLLECTION, StorageBackend,
+    TOKEN_DEAD, TOKEN_LEASE_SECONDS, TOKEN_LEASED, TOKEN_PENDING, TOKENS_COLLECTION, VIDEO_ENTITY, VIDEOS_COLLECTION,
+    create_interaction, create_statistics_snapshot, interaction_updates, register_exit_flush, token_lease_filter,
+    token_lease_update, unregister_exit_flush
+)
+
+WARM_BATCH_SIZE = 10000  # the number of ids read per round trip when the seen filters are warmed
+STATISTICS_TIMESERIES = {  # the snapshots of an entity are stored in buckets, they are taken hours apart
+    'timeField': 'timestamp',
+    'metaField': 'entity',
+    'granularity': 'hours'
+}
+DUPLICATE_KEY_ERROR = 11000
+CHANGE_STREAM_AWAIT_MS = 1000  # the maximum time a change stream waits for a change before returning nothing
+
+# the change stream of the users network: the inserted comments and replies, with the fields of the edges only
+INTERACTIONS_STREAM_PIPELINE = [
+    {'$match': {'operationType': 'insert', 'ns.coll': {'$in': [COMMENTS_COLLECTION, REPLIES_COLLECTION]}}},
+    {'$project': {
+        'ns.coll': 1,
+        'fullDocument._id': 1,
+        'fullDocument.videoId': 1,
+        'fullDocument.parentId': 1,
+        'fullDocument.authorId': 1,
+        'fullDocument.authorName': 1
+    }},
+]
+
+# the indexes of the collections, created at startup: collection name -> list of index keys
+INDEXES = {
+    SEARCH_RESULTS_COLLECTION: [
+        [('keyword', pymongo.ASCENDING), ('search_type', pymongo.ASCENDING), ('order', pymongo.ASCENDING),
+         ('pageToken', pymongo.ASCENDING)],
+    ],
+    COMMENTS_COLLECTION: [
+        [('videoId', pymongo.ASCENDING)],
+    ],
+    REPLIES_COLLECTION: [
+        [('parentId', pymongo.ASCENDING)],
+        [('videoId', pymongo.ASCENDING)],
+    ],
+    STATISTICS_COLLECTION: [
+        [('entity.type', pymongo.ASCENDING), ('entity.id', pymongo.ASCENDING), ('timestamp', pymongo.ASCENDING)],
+    ],
+    TOKENS_COLLECTION: [
+        [('state', pymongo.ASCENDING), ('type', pymongo.ASCENDING), ('priority', pymongo.DESCENDING)],
+        [('leaseExpires', pymongo.ASCENDING)],
+    ],
+    EDGES_COLLECTION: [
+        [('videoId', pymongo.ASCENDING)],
+    ],
+}
+
+
+def upsert_operations(documents):
+    """
+    Creates the upserts of documents by id
+    :param documents: list of documents with an _id
+    :return: list of UpdateOne operations
+    """
+    return [
+        UpdateOne({'_id': document['_id']}, {'$set': {k: v for k, v in document.items() if k != '_id'}}, upsert=True)
+        for document in documents
+    ]
+
 
-DATABASE_NAME = "influential_users"
-SEARCH_RESULTS_COLLECTION = "search_results"
-CHANNELS_COLLECTION = "channels"
-PLAYLISTS_COLLECTION = "playlists"
-VIDEOS_COLLECTION = "videos"
-COMMENTS_COLLECTION = "comments"
-TOKENS_COLLECTION = "tokens"
+def interaction_edges_pipeline(video_channels):
+    """
+    Creates the aggregation of the weighted edges of the users network: an edge from the channel of a video to each
+    author that commented on it and an edge from the author of a comment to each author that replied to it. The
+    replies are joined with their comments by parentId and the edges are grouped by their ends, with the number of
+    interactions as weight (requires MongoDB 4.4 for $unionWith)
+    :param video_channels: dictionary video id -> id of the channel of the video
+    :return: the pipeline, run on the comments collection
+    """
+    video_ids = list(video_channels)
+    channel_ids = [video_channels[video_id] for video_id in video_ids]
 
+    comment_edges = [
+        {'$match': {'videoId': {'$in': video_ids}}},
+        {'$project': {
+            '_id': 0,
+            'source': {'$arrayElemAt': [channel_ids, {'$indexOfArray': [video_ids, '$videoId']}]},
+            'target': '$authorId',
+            'name': '$authorName'
+        }},
+    ]
+    reply_edges = [
+        {'$match': {'videoId': {'$in': video_ids}}},
+        {'$lookup': {'from': COMMENTS_COLLECTION, 'localField': 'parentId', 'foreignField': '_id',
+                     'as': 'parent'}},
+        {'$unwind': '$parent'},
+        {'$project': {'_id': 0, 'source': '$parent.authorId', 'target': '$authorId', 'name': '$authorName'}},
+    ]
+    pipeline = comment_edges + [
+        {'$unionWith': {'coll': REPLIES_COLLECTION, 'pipeline': reply_edges}},
+        {'$match': {'source': {'$nin': ["", None]}, 'target': {'$nin': ["", None]}}},
+        {'$group': {
+            '_id': {'source': '$source', 'target': '$target'},
+            'weight': {'$sum': 1},
+            'name': {'$last': '$name'}
+        }},
+    ]
+    return pipeline
 
-class MongoDB:
+
+def network_edges_pipeline(video_ids):
+    """
+    Creates the aggregation of the weighted edges of the users network of some videos from the edges collection:
+    the counts of the videos are summed by edge and the names of the targets are joined from the authors collection
+    :param video_ids: list of video ids
+    :return: the pipeline, run on the edges collection
     """
+    return [
+        {'$match': {'videoId': {'$in': list(video_ids)}}},
+        {'$group': {'_id': {'source': '$source', 'target': '$target'}, 'weight': {'$sum': '$weight'}}},
+        {'$lookup': {'from': AUTHORS_COLLECTION, 'localField': '_id.target', 'foreignField': '_id', 'as': 'author'}},
+        {'$project': {'weight': 1, 'name': {'$arrayElemAt': ['$author.name', 0]}}},
+    ]
+
+
+def interaction_backfill_pipeline():
+    """
+    Creates the aggregation of the interactions of all the stored comments and replies, grouped by video and by
+    edge: the comments are joined with the channels of their videos and the replies with the authors of their
+    comments (requires MongoDB 4.4 for $unionWith)
+    :return: the pipeline, run on the comments collection
+    """
+    return [
+        {'$lookup': {'from': VIDEOS_COLLECTION, 'localField': 'videoId', 'foreignField': '_id', 'as': 'video'}},
+        {'$project': {
+            '_id': 0,
+            'videoId': 1,
+            'source': {'$arrayElemAt': ['$video.channelId', 0]},
+            'target': '$authorId',
+            'name': '$authorName'
+        }},
+        {'$unionWith': {'coll': REPLIES_COLLECTION, 'pipeline': [
+            {'$lookup': {'from': COMMENTS_COLLECTION, 'localField': 'parentId', 'foreignField': '_id',
+                         'as': 'parent'}},
+            {'$unwind': '$parent'},
+            {'$project': {'_id': 0, 'videoId': 1, 'source': '$parent.authorId', 'target': '$authorId',
+                          'name': '$authorName'}},
+        ]}},
+        {'$match': {'source': {'$nin': ["", None]}, 'target': {'$nin': ["", None]}}},
+        {'$group': {
+            '_id': {'videoId': '$videoId', 'source': '$source', 'target': '$target'},
+            'weight': {'$sum': 1},
+            'name': {'$last': '$name'}
+        }},
+    ]
+
+
+def interaction_operations(interactions):
+    """
+    Creates the upserts that count a batch of interactions
+    :param interactions: list of interaction documents (see interaction_updates)
+    :return: dictionary collection name -> list of UpdateOne operations
+    """
+    return {
+        name: [UpdateOne({'_id': document_id}, update, upsert=True) for document_id, update in updates]
+        for name, updates in interaction_updates(interactions).items()
+    }
+
+
+def growth_rates_pipeline(entity_type, metric, window, entity_ids=None, limit=None):
+    """
+    Creates the aggregation of the growth rates of a count: the difference between the last and the first snapshot
+    in the window, divided by the number of days between them
+    :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+    :param metric: the name of the count (subscriberCount, viewCount, ...)
+    :param window: timedelta of the window that ends now
+    :param entity_ids: optional list of entity ids - all the entities of the type by default
+    :param limit: optional number of fastest growing entities returned
+    :return: the pipeline, run on the statistics collection
+    """
+    match = {'entity.type': entity_type, 'timestamp': {'$gte': datetime.utcnow() - window}}
+    if entity_ids is not None:
+        match['entity.id'] = {'$in': list(entity_ids)}
+
+    pipeline = [
+        {'$match': match},
+        {'$sort': {'entity.id': 1, 'timestamp': 1}},
+        {'$group': {
+            '_id': '$entity.id',
+            'first': {'$first': '$' + metric},
+            'last': {'$last': '$' + metric},
+            'start': {'$first': '$timestamp'},
+            'end': {'$last': '$timestamp'}
+        }},
+        {'$match': {'$expr': {'$gt': ['$end', '$start']}}},
+        {'$project': {
+            'first': 1,
+            'last': 1,
+            'growth': {'$subtract': ['$last', '$first']},
+            'rate': {'$divide': [
+                {'$subtract': ['$last', '$first']},
+                {'$divide': [{'$subtract': ['$end', '$start']}, 24 * 60 * 60 * 1000]}
+            ]}
+        }},
+        {'$sort': {'rate': -1}},
+    ]
+    if limit:
+        pipeline.append({'$limit': limit})
+    return pipeline
+
 
+class MongoDB(StorageBackend):
+    """
+    Storage backend on a MongoDB deployment
     """
 
     """ Init """
 
-    def __init__(self):
+    def __init__(self, database_name=DATABASE_NAME, seen_filters=True, buffered=False, buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, uri=None):
         """
         Init method for creating the database connection
+        :param database_name: the name of the database
+        :param seen_filters: if True, the ids of the channels, playlists and videos are loaded at startup and kept in
+        memory, so the inserts of known documents are skipped without a round trip
+        :param buffered: if True, the inserts and updates of the channels, playlists, videos and comments are queued
+        and written with unordered bulk writes - the queued writes are flushed before every read and at exit
+        :param buffer_size: the number of queued operations that triggers a flush
+        :param flush_interval: the maximum age in seconds of the queued operations - a background thread writes
+        them when they get older, also while nothing new is queued
+        :param uri: the connection string (MONGODB_URI by default) - the client of the uri is shared by the process
+        :raise pymongo.errors.ConnectionFailure: if the deployment cannot be reached
         """
 
         # logging module
@@ -30,18 +249,328 @@ class MongoDB:
 
         # connect to database
         try:
-            self.__mongo_client = pymongo.MongoClient("mongodb://localhost:27017/")
-            self.__mongo_client.server_info()
+            self.__mongo_client = get_client(uri)
         except errors.ConnectionFailure as e:
             self.logger.critical("MongoDB database: " + str(e))
-            exit(1)
-        self.__db = self.__mongo_client[DATABASE_NAME]  # database: DATABASE_NAME
+            raise
+        self.__db = self.__mongo_client[database_name]  # database: DATABASE_NAME by default
         self.__search_results_col = self.__db[SEARCH_RESULTS_COLLECTION]  # collection: SEARCH_RESULTS_COLLECTION
         self.__channels_col = self.__db[CHANNELS_COLLECTION]  # collection: CHANNELS_COLLECTION
         self.__playlists_col = self.__db[PLAYLISTS_COLLECTION]  # collection: PLAYLISTS_COLLECTION
         self.__videos_col = self.__db[VIDEOS_COLLECTION]  # collection: VIDEOS_COLLECTION
         self.__comments_col = self.__db[COMMENTS_COLLECTION]  # collection: COMMENTS_COLLECTION
+        self.__replies_col = self.__db[REPLIES_COLLECTION]  # collection: REPLIES_COLLECTION
+        self.__statistics_col = self.__db[STATISTICS_COLLECTION]  # collection: STATISTICS_COLLECTION
         self.__tokens_col = self.__db[TOKENS_COLLECTION]  # collection: TOKENS_COLLECTION
+        self.__create_statistics_collection()
+        self.__create_indexes()
+        self.__seen = {}  # collection name -> SeenFilter with the stored ids
+        if seen_filters:
+            self.__warm_seen_filters()
+
+        self.__buffered = buffered
+        self.__buffer_size = buffer_size
+        self.__flush_interval = flush_interval
+        self.__buffers = {}  # collection name -> queued write operations
+        self.__queued = 0  # the number of queued write operations
+        self.__last_flush = time.monotonic()
+        self.__buffer_lock = threading.Lock()
+        self.__flush_lock = threading.Lock()  # the batches are written one at a time, in the order they were queued
+        self.__closed = threading.Event()
+        self.__flusher = None
+        if buffered:
+            register_exit_flush(self)
+            self.__flusher = threading.Thread(target=self.__flush_periodically, args=(weakref.ref(self), self.__closed),
+                                              name="mongodb-flush", daemon=True)
+            self.__flusher.start()
+
+    def __create_statistics_collection(self):
+        """
+        Creates the statistics collection as a time series collection, so the snapshots of an entity are stored
+        in compressed buckets (requires MongoDB 5.0) - on older servers the snapshots go to a regular collection
+        """
+        if STATISTICS_COLLECTION in self.__db.list_collection_names():
+            return
+
+        try:
+            self.__db.create_collection(STATISTICS_COLLECTION, timeseries=STATISTICS_TIMESERIES)
+        except errors.CollectionInvalid:
+            pass  # created by another instance in the meantime
+        except errors.OperationFailure as e:
+            self.logger.warning("Time series collections are not supported, using a regular collection: " + str(e))
+
+    def __create_indexes(self):
+        """
+        Creates the declared indexes - the indexes that already exist are left unchanged
+        """
+        for name, indexes in INDEXES.items():
+            try:
+                self.__db[name].create_indexes([IndexModel(keys) for keys in indexes])
+            except errors.OperationFailure as e:
+                self.logger.error("Index creation failed for " + name + ": " + str(e))
+
+    def __find(self, collection, query, projection=None, batch_size=None):
+        """
+        Queries a collection in a single round trip - the queued writes are flushed first
+        :param collection: the collection
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip (the server default by default)
+        :return: a lazily evaluated cursor
+        """
+        self.flush()
+        cursor = collection.find(query, projection)
+        if batch_size:
+            cursor = cursor.batch_size(batch_size)
+        return cursor
+
+    def __warm_seen_filters(self):
+        """
+        Loads the stored ids of the collections in the seen filters - the query is covered by the _id index
+        """
+        for name in SEEN_COLLECTIONS:
+            seen = SeenFilter()
+            for document in self.__db[name].find({}, {'_id': 1}).batch_size(WARM_BATCH_SIZE):
+                seen.add(document['_id'])
+            self.__seen[name] = seen
+            self.logger.info("Seen filter of " + name + ": " + str(len(seen)) + " ids")
+
+    def is_known(self, collection_name, document_id):
+        """
+        Checks if a document was stored, without a round trip to the database while the filter is exact. Once the
+        filter holds many ids, a known id is confirmed with a query, since a bloom filter can report a new id as seen
+        :param collection_name: the name of the collection (CHANNELS_COLLECTION, VIDEOS_COLLECTION, ...)
+        :param document_id: the id of the document
+        :return: True if the document is known, False if it is not or the filters are disabled
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is None or document_id not in seen:
+            return False
+        return seen.is_exact() or self.__db[collection_name].find_one({'_id': document_id}, {'_id': 1}) is not None
+
+    def __insert_new(self, collection, data, interaction=None):
+        """
+        Inserts a document unless the exact seen filter of the collection holds its id. A miss of the filter is a
+        new id, so the insert is queued in buffered mode - a positive of a bloom filter can be false, so the queued
+        writes are flushed, the insert is sent and the database decides with a duplicate key error
+        :param collection: the collection
+        :param data: the document
+        :param interaction: optional interaction counted in the edges collection if the document is inserted
+        :return: True if the document was inserted or queued, False if it was already stored or on error
+        """
+        seen = self.__seen.get(collection.name)
+        if seen is not None and not seen.add(data['_id']):
+            if seen.is_exact():
+                return False
+            self.flush()
+        elif self.__buffered:
+            self.__enqueue(collection, InsertOne(data), data['_id'], interaction)
+            return True
+
+        try:
+            collection.insert_one(data)
+        except errors.DuplicateKeyError as e:
+            self.logger.info("Duplicate key: " + str(e))
+            return False
+        except errors.BulkWriteError as e:
+            self.logger.error("Bulk write error: " + str(e))
+            self.__forget_seen(collection.name, [data['_id']])
+            return False
+        except errors.PyMongoError:
+            self.__forget_seen(collection.name, [data['_id']])
+            raise
+
+        if interaction:
+            self.__count_interactions([interaction])
+        return True
+
+    def __forget_seen(self, collection_name, document_ids):
+        """
+        Removes the ids of documents that were not written from the seen filter of a collection, so they are not
+        skipped when they are inserted again
+        :param collection_name: the name of the collection
+        :param document_ids: list of ids
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is not None:
+            for document_id in document_ids:
+                seen.discard(document_id)
+
+    def __update(self, collection, query, update):
+        """
+        Updates a document, or queues the update in buffered mode
+        :param collection: the collection
+        :param query: the filter of the document
+        :param update: the update operators
+        """
+        if self.__buffered:
+            self.__enqueue(collection, UpdateOne(query, update))
+            return
+
+        try:
+            collection.update_one(query, update)
+        except errors.DuplicateKeyError as e:
+            self.logger.info("Duplicate key: " + str(e))
+        except errors.BulkWriteError as e:
+            self.logger.error("Bulk write error: " + str(e))
+
+    def __upsert_many(self, collection, documents, interactions=None):
+        """
+        Inserts or updates documents by id in a single bulk write, or queues the upserts in buffered mode
+        :param collection: the collection
+        :param documents: list of documents with an _id
+        :param interactions: optional list of the interactions of the documents, counted in the edges collection
+        for the documents that are inserted
+        """
+        operations = upsert_operations(documents)
+        interactions = interactions or [None] * len(documents)
+        if self.__buffered:
+            for operation, document, interaction in zip(operations, documents, interactions):
+                self.__enqueue(collection, operation, document['_id'], interaction)
+        elif operations:
+            upserted = self.__bulk_write(collection, operations)[1]
+            self.__count_interactions([interaction for document, interaction in zip(documents, interactions)
+                                       if interaction and document['_id'] in upserted])
+
+    def __bulk_write(self, collection, operations):
+        """
+        Executes an unordered bulk write - the duplicate keys are skipped operation by operation
+        :param collection: the collection
+        :param operations: list of write operations
+        :return: (dictionary index -> error code of the failed operations, set of the ids of the upserted documents)
+        """
+        try:
+            result = collection.bulk_write(operations, ordered=False)
+        except errors.BulkWriteError as e:
+            failed = {}
+            for error in e.details.get('writeErrors', []):
+                failed[error.get('index')] = error.get('code')
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    self.logger.info("Duplicate key: " + str(error.get('errmsg')))
+                else:
+                    self.logger.error("Bulk write error: " + str(error))
+            return failed, {upsert['_id'] for upsert in e.details.get('upserted', [])}
+
+        return {}, set(result.upserted_ids.values())
+
+    def __count_interactions(self, interactions):
+        """
+        Counts the interactions of newly stored documents in the edges collection, without queueing them
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+        for name, operations in interaction_operations(interactions).items():
+            if operations:
+                self.__bulk_write(self.__db[name], operations)
+
+    def __enqueue(self, collection, operation, document_id=None, interaction=None):
+        """
+        Queues a write operation and flushes the queues when they are full or old
+        :param collection: the collection
+        :param operation: the InsertOne or UpdateOne operation
+        :param document_id: the id of the document written by the operation, if it has an interaction
+        :param interaction: optional interaction counted in the edges collection if the operation inserts the
+        document
+        """
+        with self.__buffer_lock:
+            self.__buffers.setdefault(collection.name, []).append((operation, document_id, interaction))
+            self.__queued += 1
+            due = (self.__queued >= self.__buffer_size or
+                   time.monotonic() - self.__last_flush >= self.__flush_interval)
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the queued operations with an unordered bulk write per collection. The inserts of a batch are
+        applied before its updates, so an update queued after the insert of its document finds it. Duplicate
+        keys are skipped operation by operation, and the interactions are counted for the documents that were
+        inserted by the batch. The ids of the inserts that failed for another reason are removed from the seen
+        filters
+        """
+        with self.__flush_lock:
+            with self.__buffer_lock:
+                buffers = self.__buffers
+                self.__buffers = {}
+                self.__queued = 0
+                self.__last_flush = time.monotonic()
+
+            interactions = []
+            batches = list(buffers.items())
+            for position, (name, entries) in enumerate(batches):
+                try:
+                    failed, upserted = self.__bulk_write(self.__db[name], [operation for operation, _, _ in entries])
+                except errors.PyMongoError:
+                    for lost_name, lost_entries in batches[position:]:
+                        self.__forget_seen(lost_name, [document_id for operation, document_id, _ in lost_entries
+                                                       if isinstance(operation, InsertOne)])
+                    self.__count_interactions(interactions)
+                    raise
+                self.__forget_seen(name, [document_id for index, (operation, document_id, _) in enumerate(entries)
+                                          if isinstance(operation, InsertOne) and
+                                          failed.get(index, DUPLICATE_KEY_ERROR) != DUPLICATE_KEY_ERROR])
+                for index, (operation, document_id, interaction) in enumerate(entries):
+                    if not interaction:
+                        continue
+                    if document_id in upserted:
+                        upserted.discard(document_id)  # a document queued twice is upserted by the first write
+                        interactions.append(interaction)
+                    elif isinstance(operation, InsertOne) and index not in failed:
+                        interactions.append(interaction)
+            self.__count_interactions(interactions)
+
+    @staticmethod
+    def __flush_periodically(reference, closed):
+        """
+        Flushes the queued operations once they are flush_interval seconds old, until the storage is closed or
+        collected - the writes of a crawl that stops queueing are not held until close(). The thread only keeps a
+        weak reference, so an instance that is never closed can still be collected
+        :param reference: weak reference to the storage
+        :param closed: the event set by close()
+        """
+        delay = 0.0
+        while not closed.wait(delay):
+            storage = reference()
+            if storage is None:
+                return
+            delay = storage.__flush_if_due()
+            del storage
+
+    def __flush_if_due(self):
+        """
+        Flushes the queued operations if they are flush_interval seconds old
+        :return: the number of seconds until the next flush is due
+        """
+        age = time.monotonic() - self.__last_flush
+        if age < self.__flush_interval:
+            return self.__flush_interval - age
+        try:
+            self.flush()
+        except errors.PyMongoError as e:
+            self.logger.error("Periodic flush error: " + str(e))
+        return self.__flush_interval
+
+    def close(self):
+        """
+        Writes the queued operations - the shared client stays open for the other instances
+        """
+        self.__closed.set()
+        if self.__flusher is not None:
+            self.__flusher.join()
+        self.flush()
+        unregister_exit_flush(self)
+
+    def drop_database(self):
+        """
+        Removes all the collections of the database
+        """
+        with self.__flush_lock, self.__buffer_lock:
+            self.__buffers = {}
+            self.__queued = 0
+        self.__mongo_client.drop_database(self.__db.name)
+        self.__seen = {name: SeenFilter() for name in self.__seen}
+        self.__create_statistics_collection()
+        self.__create_indexes()
 
     """ Search Results """
 
@@ -58,17 +587,15 @@ class MongoDB:
         except errors.BulkWriteError as e:
             self.logger.error("Bulk write error: " + str(e))
 
-    def get_search_results(self, query, limit=None):
+    def get_search_results(self, query, projection=None, batch_size=None):
         """
 
         :param query:
-        :param limit:
-        :return:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: cursor, iterated lazily
         """
-        if self.__search_results_col.count_documents(query) > 0:
-            return self.__search_results_col.find(query, limit)
-        else:
-            return None
+        return self.__find(self.__search_results_col, query, projection, batch_size)
 
     """ Channels """
 
@@ -76,43 +603,32 @@ class MongoDB:
         """
 
         :param data:
-        :return:
+        :return: True if the channel was inserted, False if it was already stored
         """
-        try:
-            self.__channels_col.insert_one(data)
-        except errors.DuplicateKeyError as e:
-            self.logger.info("Duplicate key: " + str(e))
-        except errors.BulkWriteError as e:
-            self.logger.error("Bulk write error: " + str(e))
+        return self.__insert_new(self.__channels_col, data)
 
     def insert_channel_statistics(self, channel_id, statistics):
         """
-
-        :param channel_id:
-        :param statistics:
-        :return:
+        Stores a snapshot of the statistics of a channel and keeps the latest one on the channel document
+        :param channel_id: the id of the channel
+        :param statistics: dictionary with the counts of the channel
         """
-        try:
-            self.__channels_col.update_one(
-                {'_id': channel_id},
-                {'$addToSet': {'statistics': statistics}}
-            )
-        except errors.DuplicateKeyError as e:
-            self.logger.info("Duplicate key: " + str(e))
-        except errors.BulkWriteError as e:
-            self.logger.error("Bulk write error: " + str(e))
+        self.insert_statistics_snapshot(CHANNEL_ENTITY, channel_id, statistics)
+        self.__update(
+            self.__channels_col,
+            {'_id': channel_id},
+            {'$set': {'statistics': statistics}}
+        )
 
-    def get_channel(self, query, limit=None):
+    def get_channel(self, query, projection=None, batch_size=None):
         """
 
         :param query:
-        :param limit:
-        :return:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: cursor, iterated lazily
         """
-        if self.__channels_col.count_documents(query) > 0:
-            return self.__channels_col.find(query, limit)
-        else:
-            return None
+        return self.__find(self.__channels_col, query, projection, batch_size)
 
     """ Playlists """
 
@@ -120,14 +636,9 @@ class MongoDB:
         """
 
         :param data:
-        :return:
+        :return: True if the playlist was inserted, False if it was already stored
         """
-        try:
-            self.__playlists_col.insert_one(data)
-        except errors.DuplicateKeyError as e:
-            self.logger.info("Duplicate key: " + str(e))
-        except errors.BulkWriteError as e:
-            self.logger.error("Bulk write error: " + str(e))
+        return self.__insert_new(self.__playlists_col, data)
 
     """ Videos """
 
@@ -135,86 +646,296 @@ class MongoDB:
         """
 
         :param data:
+        :return: True if the video was inserted, False if it was already stored
+        """
+        return self.__insert_new(self.__videos_col, data)
+
+    def get_video(self, query, projection=None, batch_size=None):
+        """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: cursor, iterated lazily
+        """
+        return self.__find(self.__videos_col, query, projection, batch_size)
+
+    def set_comments_mark(self, video_id, mark):
+        """
+        Stores the newest comment thread retrieved for a video - the high-water mark of the delta comment crawl
+        :param video_id: the id of the video
+        :param mark: dictionary with the commentId and the publishedAt of the newest comment thread
         :return:
         """
-        try:
-            self.__videos_col.insert_one(data)
-        except errors.DuplicateKeyError as e:
-            self.logger.info("Duplicate key: " + str(e))
-        except errors.BulkWriteError as e:
-            self.logger.error("Bulk write error: " + str(e))
+        self.__update(
+            self.__videos_col,
+            {'_id': video_id},
+            {'$set': {'commentsMark': mark}}
+        )
+
+    def get_comments_mark(self, video_id):
+        """
+        Returns the newest comment thread retrieved for a video
+        :param video_id: the id of the video
+        :return: dictionary with the commentId and the publishedAt or None if the video was never refreshed
+        """
+        self.flush()
+        video = self.__videos_col.find_one({'_id': video_id}, {'commentsMark': 1})
+        if video:
+            return video.get('commentsMark')
+        return None
 
     def insert_video_statistics(self, video_id, data):
         """
+        Stores a snapshot of the statistics of a video and keeps the latest one on the video document
+        :param video_id: the id of the video
+        :param data: dictionary with the counts of the video
+        """
+        self.insert_statistics_snapshot(VIDEO_ENTITY, video_id, data)
+        self.__update(
+            self.__videos_col,
+            {'_id': video_id},
+            {'$set': {'statistics': data}}
+        )
 
-        :param video_id:
-        :param data:
-        :return:
+    """ Statistics """
+
+    def insert_statistics_snapshot(self, entity_type, entity_id, statistics, timestamp=None):
+        """
+        Stores the statistics of a channel or a video at a moment in the statistics collection
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param statistics: dictionary with the counts - the api returns them as strings
+        :param timestamp: the moment of the snapshot (now by default)
         """
+        snapshot = create_statistics_snapshot(entity_type, entity_id, statistics, timestamp)
+        if self.__buffered:
+            self.__enqueue(self.__statistics_col, InsertOne(snapshot))
+            return
+
         try:
-            self.__videos_col.update_one(
-                {'_id': video_id},
-                {'$set': {'statistics': data}}
-            )
-        except errors.DuplicateKeyError:
-            print("Duplicate key")
-            pass
-        except errors.BulkWriteError:
-            print("Bulk write error")
-            pass
+            self.__statistics_col.insert_one(snapshot)
+        except errors.PyMongoError as e:
+            self.logger.error("Statistics snapshot not stored: " + str(e))
+
+    def get_statistics(self, entity_type, entity_id, since=None, batch_size=None):
+        """
+        Returns the snapshots of a channel or a video, oldest first
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param since: optional datetime of the oldest snapshot
+        :param batch_size: the number of snapshots returned per round trip
+        :return: cursor of snapshots
+        """
+        query = {'entity.type': entity_type, 'entity.id': entity_id}
+        if since is not None:
+            query['timestamp'] = {'$gte': since}
+        return self.__find(self.__statistics_col, query, {'_id': 0}, batch_size).sort('timestamp', pymongo.ASCENDING)
+
+    def get_growth_rates(self, entity_type, metric, window=GROWTH_WINDOW, entity_ids=None, limit=None,
+                         batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes on the server how fast a count grows for each entity: the difference between the last and the
+        first snapshot in the window, divided by the number of days between them. The entities with fewer than
+        two snapshots in the window are skipped
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param metric: the name of the count (subscriberCount, viewCount, ...)
+        :param window: timedelta of the window that ends now
+        :param entity_ids: optional list of entity ids - all the entities of the type by default
+        :param limit: optional number of fastest growing entities returned
+        :param batch_size: the number of results returned per round trip
+        :return: cursor of {'_id': entity id, 'first', 'last', 'growth', 'rate'} sorted by rate (growth per day)
+        """
+        self.flush()
+        pipeline = growth_rates_pipeline(entity_type, metric, window, entity_ids, limit)
+        return self.__statistics_col.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
 
     """ Comments """
 
-    def insert_comment(self, data):
+    def insert_comment(self, data, source=None):
         """
 
         :param data:
-        :return:
+        :param source: the id of the channel of the video, the source of the edge of the comment (no edge if None)
+        :return: True if the comment was inserted or queued, False if it was already stored
         """
-        try:
-            self.__comments_col.insert_one(data)
-        except errors.DuplicateKeyError as e:
-            self.logger.info("Duplicate key: " + str(e))
-        except errors.BulkWriteError as e:
-            self.logger.error("Bulk write error: " + str(e))
+        return self.__insert_new(self.__comments_col, data, source and create_interaction(data, source))
 
-    def insert_comment_reply(self, comment_id, replies):
+    """ Replies """
+
+    def insert_comment_replies(self, comment_id, replies, source=None):
+        """
+        Stores the replies of a comment thread in the replies collection, keyed by reply id with the id of the
+        thread as parentId, so a reply that is retrieved again is updated instead of duplicated - only the replies
+        that the upserts insert are counted in the edges collection
+        :param comment_id: the id of the comment thread
+        :param replies: list of reply documents
+        :param source: the id of the author of the comment thread, the source of the edges of the replies (no edges
+        if None)
         """
+        documents = [dict(reply, parentId=comment_id) for reply in replies]
+        interactions = [create_interaction(document, source) for document in documents] if source else None
+        self.__upsert_many(self.__replies_col, documents, interactions)
 
-        :param comment_id:
-        :param replies:
-        :return:
+    def get_replies(self, query, projection=None, batch_size=None):
         """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: cursor, iterated lazily
+        """
+        return self.__find(self.__replies_col, query, projection, batch_size)
+
+    """ Users Network """
+
+    def get_interaction_edges(self, video_channels, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes the weighted edges of the users network on the server: an edge from the channel of a video to each
+        author that commented on it and an edge from the author of a comment to each author that replied to it.
+        The replies are joined with their comments by parentId and the edges are grouped by their ends, with the
+        number of interactions as weight (requires MongoDB 4.4 for $unionWith)
+        :param video_channels: dictionary video id -> id of the channel of the video
+        :param batch_size: the number of edges returned per round trip
+        :return: cursor of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+        self.flush()
+        pipeline = interaction_edges_pipeline(video_channels)
+        return self.__comments_col.aggregate(pipeline, allowDiskUse=True, batchSize=batch_size)
+
+    def insert_interactions(self, interactions):
+        """
+        Counts new interactions in the edges collection, with an upsert per edge that increments its weight, and
+        stores the names of their authors
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+        for name, operations in interaction_operations(interactions).items():
+            if self.__buffered:
+                for operation in operations:
+                    self.__enqueue(self.__db[name], operation)
+            elif operations:
+                self.__bulk_write(self.__db[name], operations)
+
+    def backfill_network_edges(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Counts the comments and replies stored by the previous versions in the edges collection, with a single
+        aggregation that groups them by video and by edge
+        :param batch_size: the number of edges written per bulk write
+        :return: the number of backfilled edges
+        """
+        self.flush()
+        if self.__db[EDGES_COLLECTION].find_one({}, {'_id': 1}) is not None:
+            self.logger.warning("The edges collection is not empty, the backfill would count its interactions twice")
+            return 0
         try:
-            self.__comments_col.update_one(
-                {'_id': comment_id},
-                {'$addToSet': {'replies': replies}}
+            claim = self.__db[MIGRATIONS_COLLECTION].update_one(
+                {'_id': EDGES_BACKFILL_MIGRATION}, {'$setOnInsert': {'started': datetime.utcnow()}}, upsert=True
             )
-        except errors.DuplicateKeyError as e:
-            self.logger.info("Duplicate key: " + str(e))
-        except errors.BulkWriteError as e:
-            self.logger.error("Bulk write error: " + str(e))
+            claimed = claim.upserted_id is not None
+        except errors.DuplicateKeyError:
+            claimed = False  # inserted by a concurrent call
+        if not claimed:
+            self.logger.info("The edges were already backfilled")
+            return 0
+
+        backfilled = 0
+        cursor = self.__comments_col.aggregate(interaction_backfill_pipeline(), allowDiskUse=True,
+                                               batchSize=batch_size)
+        batch = []
+        for edge in cursor:
+            batch.append(dict(edge['_id'], weight=edge['weight'], name=edge['name']))
+            if len(batch) >= batch_size:
+                self.__count_interactions(batch)
+                backfilled += len(batch)
+                batch = []
+        if batch:
+            self.__count_interactions(batch)
+            backfilled += len(batch)
+
+        self.__db[MIGRATIONS_COLLECTION].update_one({'_id': EDGES_BACKFILL_MIGRATION},
+                                                    {'$set': {'completed': datetime.utcnow(), 'edges': backfilled}})
+        self.logger.info("Backfilled " + str(backfilled) + " edges of the users network")
+        return backfilled
+
+    def get_network_edges(self, video_ids, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Reads the weighted edges of the users network of some videos from the edges collection, which is much
+        smaller than the comments and replies they are counted from
+        :param video_ids: list of video ids
+        :param batch_size: the number of edges returned per round trip
+        :return: cursor of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+        self.flush()
+        return self.__db[EDGES_COLLECTION].aggregate(network_edges_pipeline(video_ids), allowDiskUse=True,
+                                                     batchSize=batch_size)
+
+    def watch_interactions(self, max_await_time_ms=CHANGE_STREAM_AWAIT_MS):
+        """
+        Opens a change stream on the comments and replies inserted in the database, with only the fields needed
+        by the users network (requires a replica set - a single node one is enough)
+        :param max_await_time_ms: the maximum time the server waits for a change before returning an empty batch
+        :return: the change stream - its try_next() returns None when there was no change
+        :raise pymongo.errors.OperationFailure: if the deployment does not support change streams
+        """
+        return self.__db.watch(INTERACTIONS_STREAM_PIPELINE, max_await_time_ms=max_await_time_ms)
+
+    def migrate_replies(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Moves the replies embedded in the comments by the previous versions to the replies collection
+        :param batch_size: the number of comments migrated per bulk write
+        :return: the number of migrated comments
+        """
+        self.flush()
+        migrated = 0
+        comments = self.__comments_col.find({'replies': {'$exists': True}}, {'videoId': 1, 'replies': 1})
+        batch = []
+        for comment in comments.batch_size(batch_size):
+            batch.append(comment)
+            if len(batch) >= batch_size:
+                migrated += self.__migrate_comment_batch(batch)
+                batch = []
+        if batch:
+            migrated += self.__migrate_comment_batch(batch)
 
-    def get_comments(self, query, limit=None):
+        self.logger.info("Migrated the replies of " + str(migrated) + " comments")
+        return migrated
+
+    def __migrate_comment_batch(self, comments):
+        """
+        Upserts the embedded replies of a batch of comments, then removes the embedded arrays
+        :param comments: list of comments with their replies
+        :return: the number of migrated comments
+        """
+        replies = [dict(reply, parentId=comment['_id'], videoId=reply.get('videoId', comment.get('videoId')))
+                   for comment in comments for reply in comment['replies']]
+        if replies:
+            self.__bulk_write(self.__replies_col, upsert_operations(replies))
+        self.__bulk_write(self.__comments_col, [
+            UpdateOne({'_id': comment['_id']}, {'$unset': {'replies': ""}}) for comment in comments
+        ])
+        return len(comments)
+
+    def get_comments(self, query, projection=None, batch_size=None):
         """
 
         :param query:
-        :param limit:
-        :return:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: cursor, iterated lazily
         """
-        if self.__comments_col.count_documents(query) > 0:
-            return self.__comments_col.find(query, limit)
-        else:
-            return None
+        return self.__find(self.__comments_col, query, projection, batch_size)
 
     """ Tokens """
 
     def insert_token(self, data):
         """
-
-        :param data:
+        Adds a page token to the queue
+        :param data: the token document
         :return:
         """
+        data = dict(data)
+        data.setdefault('state', TOKEN_PENDING)
+        data.setdefault('attempts', 0)
         try:
             self.__tokens_col.insert_one(data)
         except errors.DuplicateKeyError as e:
@@ -222,19 +943,85 @@ class MongoDB:
         except errors.BulkWriteError as e:
             self.logger.error("Bulk write error: " + str(e))
 
-    def get_tokens(self):
+    def get_tokens(self, query=None, projection=None, batch_size=None):
+        """
+
+        :param query: filter of the tokens (all the tokens by default)
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: cursor, iterated lazily
         """
+        return self.__find(self.__tokens_col, query or {}, projection, batch_size)
 
+    def set_token_priorities(self, priorities):
+        """
+        Sets the priorities used to choose the next token to lease
+        :param priorities: dictionary token id -> priority
         :return:
         """
-        tokens = None
+        if not priorities:
+            return
+        self.__tokens_col.bulk_write(
+            [UpdateOne({'_id': token_id}, {'$set': {'priority': p}}) for token_id, p in priorities.items()],
+            ordered=False
+        )
 
-        try:
-            tokens = self.__tokens_col.find()
-        except errors.CursorNotFound as e:
-            self.logger.error("Cursor not found: " + str(e))
+    def lease_token(self, owner, token_types, lease_seconds=TOKEN_LEASE_SECONDS, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Atomically takes the pending token with the highest priority, or one whose lease has expired, so several
+        crawler processes can share the queue. Tokens that were leased too many times are moved to the dead state
+        :param owner: the id of the worker
+        :param token_types: the types of tokens that can be leased
+        :param lease_seconds: the duration of the lease
+        :param max_attempts: the number of leases after which a token is dead
+        :return: the token or None if there are no tokens left
+        """
+        while True:
+            now = datetime.utcnow()
+            token = self.__tokens_col.find_one_and_update(
+                token_lease_filter(token_types, now),
+                token_lease_update(owner, now, lease_seconds),
+                sort=[('priority', pymongo.DESCENDING)],
+                return_document=ReturnDocument.AFTER
+            )
+
+            if token is None or token['attempts'] <= max_attempts:
+                return token
+
+            self.logger.warning("Token [" + str(token['_id']) + "] failed " + str(max_attempts) + " times")
+            self.__tokens_col.update_one(
+                {'_id': token['_id'], 'leaseOwner': owner},
+                {'$set': {'state': TOKEN_DEAD}, '$unset': {'leaseExpires': ""}}
+            )
+
+    def complete_token(self, token_id, owner):
+        """
+        Removes a processed token from the queue, if the worker still holds its lease
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        :return:
+        """
+        self.__tokens_col.delete_one({'_id': token_id, 'leaseOwner': owner})
+
+    def release_token(self, token_id, owner, failed=True, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Gives back a token that was not processed
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        :param failed: False if the token was not processed for lack of quota - the attempt is not counted
+        :param max_attempts: the number of failed attempts after which the token is dead
+        :return:
+        """
+        query = {'_id': token_id, 'leaseOwner': owner, 'state': TOKEN_LEASED}
+        if not failed:
+            self.__tokens_col.update_one(query, {'$set': {'state': TOKEN_PENDING}, '$inc': {'attempts': -1},
+                                                 '$unset': {'leaseOwner': "", 'leaseExpires': ""}})
+            return
 
-        return tokens
+        self.__tokens_col.update_one(dict(query, attempts={'$gte': max_attempts}),
+                                     {'$set': {'state': TOKEN_DEAD}, '$unset': {'leaseExpires': ""}})
+        self.__tokens_col.update_one(query, {'$set': {'state': TOKEN_PENDING},
+                                             '$unset': {'leaseOwner': "", 'leaseExpires': ""}})
 
     def remove_token(self, token_id):
         """
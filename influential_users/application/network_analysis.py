@@ -1,11 +1,9 @@
 import pickle
 
-import matplotlib.pyplot as plt
 import networkx as nx
-from networkx.drawing.nx_agraph import graphviz_layout
 
+from influential_users.application.graph_format import CsrGraph
 from influential_users.application.message_logger import MessageLogger
-from influential_users.application.plotly_display import visualize_graph_3d, visualize_graph
 
 NETWORKS_FOLDER = '.networks'
 IMAGES_FOLDER = '.images'
@@ -30,11 +28,28 @@ class NetworkAnalysis:
         self.logger = ml.get_logger()
 
         # variables
-        self.__graph = nx.empty_graph
+        self.__networkx_graph = nx.empty_graph
+        self.__csr_graph = None  # the memory mapped graph loaded by create_network, until it is converted
         self.__labels = {}
         self.__rank = []
         self.file_name = file_name
 
+    @property
+    def __graph(self):
+        """
+        The networkx graph - a graph loaded from the binary files is converted by the first method that needs it,
+        so loading a network does not build it edge by edge
+        """
+        if self.__csr_graph is not None:
+            self.__networkx_graph = self.__csr_graph.to_networkx()
+            self.__csr_graph = None
+        return self.__networkx_graph
+
+    @__graph.setter
+    def __graph(self, graph):
+        self.__networkx_graph = graph
+        self.__csr_graph = None
+
     def set_file_name(self, file_name):
         """
         Sets the name of the file to read for input and also for exporting data to a specific format
@@ -42,11 +57,23 @@ class NetworkAnalysis:
         """
         self.file_name = file_name
 
+    def set_graph(self, graph, labels):
+        """
+        Uses a network that was already built, e.g. the current network of a GraphStream
+        :param graph: the networkx Graph
+        :param labels: dictionary node id -> name
+        """
+        self.__graph = graph
+        self.__labels = labels
+
     def __get_graph_info(self):
         """
         Prints the graph information
         :return: returns the graph information
         """
+        if self.__csr_graph is not None:
+            return "Binary graph with " + str(self.__csr_graph.number_of_nodes()) + " nodes and " + \
+                   str(self.__csr_graph.number_of_edges()) + " directed edges"
         return nx.info(self.__graph)
 
     def export_to_gexf(self):
@@ -72,17 +99,30 @@ class NetworkAnalysis:
 
     def create_network(self):
         """
-        Creates a network from the file with the edge-list.
-        A file name needs to be set before performing this operation
+        Creates a network from the binary files of the graph, memory mapped, or from the file with the edge-list
+        written by the previous versions. A file name needs to be set before performing this operation
         """
         if not self.file_name:
             self.logger.critical("No file name was set")
             exit(0)
 
-        self.__graph = nx.read_edgelist(NETWORKS_FOLDER + "/" + self.file_name + TEXT_EXTENSION,
-                                        create_using=nx.Graph(),
-                                        edgetype=str, delimiter=" ")
-        self.__labels = pickle.load(open(NETWORKS_FOLDER + "/" + self.file_name + OBJECT_EXTENSION, "rb"))
+        path = NETWORKS_FOLDER + "/" + self.file_name
+        if CsrGraph.exists(path):
+            # kept memory mapped until an algorithm needs the networkx graph, where the two directions of an
+            # interaction are summed
+            self.__csr_graph = CsrGraph.load(path)
+        else:
+            # the edge-list has a line per direction of an interaction, their weights are summed in the graph - the
+            # lines without a weight, written before the weights were stored, count as one interaction
+            edges = nx.read_weighted_edgelist(path + TEXT_EXTENSION, create_using=nx.MultiGraph(), delimiter=" ")
+            graph = nx.Graph()
+            for source, target, weight in edges.edges(data='weight', default=1.0):
+                if graph.has_edge(source, target):
+                    graph[source][target]['weight'] += weight
+                else:
+                    graph.add_edge(source, target, weight=weight)
+            self.__graph = graph
+        self.__labels = pickle.load(open(path + OBJECT_EXTENSION, "rb"))
 
         print(self.__get_graph_info())
 
@@ -111,6 +151,8 @@ class NetworkAnalysis:
             print("\t" + str(i) + ". " + self.__labels[v])
 
     def __configure_display(self, title):
+        import matplotlib.pyplot as plt  # the drawing libraries are imported only by the display methods
+
         plt.title(title)
         plt.figure(figsize=(30, 30))
         plt.axis('off')
@@ -127,6 +169,8 @@ class NetworkAnalysis:
         """
         Display the graph and
         """
+        import matplotlib.pyplot as plt
+
         plt.savefig(IMAGES_FOLDER + "/" + self.file_name + IMAGE_EXTENSION)
         plt.show()
 
@@ -134,6 +178,8 @@ class NetworkAnalysis:
         """
         Display the created tree
         """
+        from networkx.drawing.nx_agraph import graphviz_layout
+
         node_color, node_size = self.__configure_display('Tree')
         pos = graphviz_layout(self.__graph, prog='dot')
         tree = nx.minimum_spanning_tree(self.__graph)
@@ -178,6 +224,8 @@ class NetworkAnalysis:
         # self.__draw_graph()
 
     def display_plotly(self):
+        from influential_users.application.plotly_display import visualize_graph_3d
+
         node_sizes = self.get_node_sizes(self.__graph)
         # edge_weights = self.get_edge_weights(graph)
         node_ids = self.get_node_labels(self.__graph)
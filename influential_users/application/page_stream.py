@@ -0,0 +1,85 @@
+import queue
+import threading
+
+DEFAULT_QUEUE_SIZE = 2  # the number of pages fetched ahead of the consumer
+PUT_TIMEOUT = 0.1  # seconds between checks of the stop flag while the queue is full
+
+_END = object()  # marks the end of the stream
+
+
+class BoundedStream:
+    """
+    Iterates a generator in a producer thread and hands its values to the consumer through a bounded queue.
+    The producer fetches the next pages while the consumer stores the current one, and blocks when the consumer
+    falls behind, so at most maxsize pages are held in memory
+    """
+
+    def __init__(self, iterable, maxsize=DEFAULT_QUEUE_SIZE):
+        """
+        Class constructor
+        :param iterable: the generator that produces the values (e.g. the pages of a request)
+        :param maxsize: the maximum number of values waiting in the queue
+        """
+        self.__iterable = iterable
+        self.__queue = queue.Queue(maxsize=maxsize)
+        self.__stopped = threading.Event()
+
+    def __iter__(self):
+        producer = threading.Thread(target=self.__produce, daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                value = self.__queue.get()
+                if value is _END:
+                    break
+                if isinstance(value, _Error):
+                    raise value.error
+                yield value
+        finally:
+            self.close()
+            producer.join()
+
+    def close(self):
+        """
+        Stops the producer - called when the consumer does not need more values
+        """
+        self.__stopped.set()
+
+    def __produce(self):
+        """
+        Puts the values of the generator in the queue, followed by the end marker or the raised exception
+        """
+        try:
+            for value in self.__iterable:
+                if not self.__put(value):
+                    return
+            self.__put(_END)
+        except Exception as e:
+            self.__put(_Error(e))
+        finally:
+            if hasattr(self.__iterable, 'close'):
+                self.__iterable.close()
+
+    def __put(self, value):
+        """
+        Puts a value in the queue, waiting while it is full
+        :param value: the value
+        :return: False if the stream was closed before the value could be added
+        """
+        while not self.__stopped.is_set():
+            try:
+                self.__queue.put(value, timeout=PUT_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class _Error:
+    """
+    Exception raised by the producer, raised again in the consumer thread
+    """
+
+    def __init__(self, error):
+        self.error = error
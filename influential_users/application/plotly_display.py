@@ -1,7 +1,6 @@
 import networkx as nx
-from networkx.drawing.nx_agraph import graphviz_layout
-from plotly.graph_objs import *
-from plotly.offline import plot as offpy
+
+# plotly and pygraphviz are slow to import, they are loaded by the functions that draw the graph
 
 
 def reformat_graph_layout(graph, layout):
@@ -12,6 +11,8 @@ def reformat_graph_layout(graph, layout):
     :return:
     """
     if layout == "graphviz":
+        from networkx.drawing.nx_agraph import graphviz_layout
+
         positions = graphviz_layout(graph)
     elif layout == "spring":
         positions = nx.fruchterman_reingold_layout(graph, k=0.5, iterations=1000)
@@ -38,6 +39,8 @@ def visualize_graph(graph, node_labels, node_sizes=None, edge_weights=None, layo
     :param title:
     :return:
     """
+    from plotly.graph_objs import Data, Figure, Layout, Line, Marker, Scatter, XAxis, YAxis
+
     if edge_weights is None:
         edge_weights = []
     if node_sizes is None:
@@ -142,6 +145,9 @@ def visualize_graph_3d(graph, node_labels, node_sizes, filename, title="3d"):
     :param title:
     :return:
     """
+    from plotly.graph_objs import (Annotation, Annotations, Data, Figure, Font, Layout, Line, Margin, Marker,
+                                   Scatter3d, Scene, XAxis, YAxis, ZAxis)
+
     edge_trace = Scatter3d(x=[],
                            y=[],
                            z=[],
@@ -0,0 +1,244 @@
+import math
+import threading
+import time
+from contextlib import ExitStack
+
+DEFAULT_DAILY_QUOTA = 10000  # the default daily quota of a youtube api project
+QUOTA_PERIOD = 24 * 60 * 60  # the quota is refilled every day
+
+# quota units charged by the youtube api for a request to each endpoint
+QUOTA_COSTS = {
+    'search': 100,
+    'channels': 1,
+    'playlists': 1,
+    'playlistItems': 1,
+    'videos': 1,
+    'commentThreads': 1,
+    'comments': 1,
+}
+
+# the part of the daily quota of each endpoint, so one type of request cannot starve the others - the shares are
+# soft: an endpoint can go over its share while the other endpoints are idle
+ENDPOINT_SHARES = {
+    'search': 0.25,
+    'channels': 0.1,
+    'playlists': 0.1,
+    'playlistItems': 0.25,
+    'videos': 0.1,
+    'commentThreads': 0.5,
+    'comments': 0.25,
+}
+ENDPOINT_IDLE_SECONDS = 60  # an endpoint without requests for this long lends its share to the others
+
+# the endpoint requested when processing each type of page token
+TOKEN_ENDPOINTS = {
+    'search': 'search',
+    'channel': 'channels',
+    'channel_statistics': 'channels',
+    'channel_playlists': 'playlists',
+    'playlist_videos': 'playlistItems',
+    'video_statistics': 'videos',
+    'video_comments': 'commentThreads',
+}
+
+# the number of items (graph nodes or edges) expected from a page of each type of token
+TOKEN_ITEMS_PER_PAGE = {
+    'search': 50,
+    'channel': 50,
+    'channel_statistics': 50,
+    'channel_playlists': 50,
+    'playlist_videos': 50,
+    'video_statistics': 50,
+    'video_comments': 100,
+}
+
+
+class QuotaExhaustedError(Exception):
+    """
+    Raised when a request cannot be made without exceeding the quota
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket holding quota units - the bucket is refilled continuously, the whole capacity in a period
+    """
+
+    def __init__(self, capacity, period=QUOTA_PERIOD):
+        """
+        Class constructor
+        :param capacity: the maximum number of units in the bucket
+        :param period: the number of seconds in which the bucket is completely refilled
+        """
+        self.capacity = capacity
+        self.__units = float(capacity)
+        self.__rate = capacity / period
+        self.__last = time.monotonic()
+
+    def available(self):
+        """
+        Returns the number of units currently available
+        :return: the number of units
+        """
+        now = time.monotonic()
+        self.__units = min(self.capacity, self.__units + (now - self.__last) * self.__rate)
+        self.__last = now
+        return self.__units
+
+    def consume(self, units):
+        """
+        Removes units from the bucket
+        :param units: the number of units
+        """
+        self.__units -= units
+
+
+class QuotaScheduler:
+    """
+    Keeps track of the daily quota of the youtube api with a token bucket for the whole project and one for
+    each endpoint, and prioritizes the pending page tokens by the expected number of items per quota unit.
+    The buckets are kept in the memory of the process: crawler processes that share a key or a project (e.g.
+    several process_tokens workers) each count only their own requests, so the daily quota has to be divided
+    among them
+    """
+
+    def __init__(self, daily_quota=DEFAULT_DAILY_QUOTA, endpoint_quotas=None):
+        """
+        Class constructor
+        :param daily_quota: the number of quota units available per day
+        :param endpoint_quotas: optional dictionary endpoint -> the maximum daily units used by the endpoint, a
+        hard limit - the other endpoints get the ENDPOINT_SHARES of the daily quota (at least the cost of a
+        request), which they can exceed while the other endpoints are idle
+        """
+        if endpoint_quotas is None:
+            endpoint_quotas = {}
+
+        self.__lock = threading.Lock()
+        self.__hard_limits = set(endpoint_quotas)  # the endpoints that cannot borrow
+        self.__last_request = {}  # endpoint -> the time of its last charged request
+        self.__total = TokenBucket(daily_quota)
+        self.__buckets = {
+            endpoint: TokenBucket(endpoint_quotas.get(
+                endpoint, max(cost, daily_quota * ENDPOINT_SHARES.get(endpoint, 1))
+            )) for endpoint, cost in QUOTA_COSTS.items()
+        }
+        self.__used = {endpoint: 0 for endpoint in QUOTA_COSTS}
+
+    def consume(self, endpoint, force=False):
+        """
+        Charges the cost of a request to an endpoint
+        :param endpoint: the name of the endpoint (search, channels, videos, ...)
+        :param force: if True, the cost is charged even if it exceeds the quota - for a request already sent
+        :raise QuotaExhaustedError: if the request would exceed the quota
+        """
+        QuotaScheduler.consume_all([self], endpoint, force)
+
+    @staticmethod
+    def consume_all(schedulers, endpoint, force=False):
+        """
+        Charges the cost of a request to several schedulers, e.g. the quota of the key and of the project - all the
+        buckets are checked before any is charged, so a request that one of them does not allow costs nothing
+        :param schedulers: list of QuotaScheduler
+        :param endpoint: the name of the endpoint (search, channels, videos, ...)
+        :param force: if True, the cost is charged even if it exceeds the quota - for a request already sent
+        :raise QuotaExhaustedError: if the request would exceed the quota of one of the schedulers
+        """
+        with ExitStack() as stack:
+            for scheduler in sorted(schedulers, key=id):  # always locked in the same order
+                stack.enter_context(scheduler.__lock)
+            if not force and not all(scheduler.__affords(endpoint) for scheduler in schedulers):
+                raise QuotaExhaustedError("Not enough quota for a request to " + endpoint)
+            for scheduler in schedulers:
+                scheduler.__charge(endpoint, QUOTA_COSTS.get(endpoint, 1))
+
+    def refund(self, endpoint):
+        """
+        Gives back the cost of a request that was charged but did not reach the api, e.g. served from the cache
+        :param endpoint: the name of the endpoint
+        """
+        with self.__lock:
+            self.__charge(endpoint, -QUOTA_COSTS.get(endpoint, 1))
+
+    def can_afford(self, endpoint):
+        """
+        Checks if a request to an endpoint can be made with the remaining quota
+        :param endpoint: the name of the endpoint
+        :return: True if there is enough quota
+        """
+        with self.__lock:
+            return self.__affords(endpoint)
+
+    def __affords(self, endpoint):
+        """
+        Checks the buckets of an endpoint. Must be called with the lock acquired
+        :param endpoint: the name of the endpoint
+        :return: True if the project bucket has enough units, and the endpoint bucket too unless the endpoint can
+        borrow the shares of the idle endpoints
+        """
+        cost = QUOTA_COSTS.get(endpoint, 1)
+        bucket = self.__buckets.get(endpoint, self.__total)
+        if self.__total.available() < cost:
+            return False
+        return bucket.available() >= cost or (endpoint not in self.__hard_limits and self.__others_idle(endpoint))
+
+    def __others_idle(self, endpoint):
+        """
+        Checks if the other endpoints made no request recently. Must be called with the lock acquired
+        :param endpoint: the name of the endpoint
+        :return: True if no other endpoint was charged in the last ENDPOINT_IDLE_SECONDS
+        """
+        since = time.monotonic() - ENDPOINT_IDLE_SECONDS
+        return all(last < since for other, last in self.__last_request.items() if other != endpoint)
+
+    def __charge(self, endpoint, cost):
+        """
+        Removes units from the buckets of an endpoint. Must be called with the lock acquired
+        :param endpoint: the name of the endpoint
+        :param cost: the number of units, negative to give them back - a borrowing endpoint bucket goes below zero
+        and refills before the endpoint can use its own share again
+        """
+        if cost > 0:
+            self.__last_request[endpoint] = time.monotonic()
+        self.__total.consume(cost)
+        bucket = self.__buckets.get(endpoint, self.__total)
+        if bucket is not self.__total:
+            bucket.consume(cost)
+        self.__used[endpoint] = self.__used.get(endpoint, 0) + cost
+
+    def is_exhausted(self):
+        """
+        Checks if there is not enough quota left for any request
+        :return: True if the quota is exhausted
+        """
+        return not any(self.can_afford(endpoint) for endpoint in QUOTA_COSTS)
+
+    def get_used(self):
+        """
+        Returns the number of units used by each endpoint
+        :return: dictionary endpoint -> units
+        """
+        with self.__lock:
+            return dict(self.__used)
+
+    @staticmethod
+    def priority(token_type, engagement=0):
+        """
+        Computes the expected value per quota unit of a page token
+        :param token_type: the type of the token (search, video_comments, ...)
+        :param engagement: the engagement of the resource of the token (e.g. the comment count of a video)
+        :return: the priority of the token - higher is better
+        """
+        endpoint = TOKEN_ENDPOINTS.get(token_type)
+        if endpoint is None:
+            return 0
+
+        value = TOKEN_ITEMS_PER_PAGE[token_type] * (1 + math.log10(1 + engagement))
+        return value / QUOTA_COSTS[endpoint]
+
+    def get_affordable_token_types(self):
+        """
+        Returns the types of page tokens that can still be processed with the remaining quota
+        :return: list of token types
+        """
+        return [token_type for token_type, endpoint in TOKEN_ENDPOINTS.items() if self.can_afford(endpoint)]
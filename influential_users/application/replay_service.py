@@ -0,0 +1,485 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+RECORDINGS_FOLDER = '.recordings'
+JSON_EXTENSION = '.json'
+RESOURCES = ['search', 'channels', 'playlists', 'playlistItems', 'videos', 'commentThreads', 'comments']
+
+
+def request_key(resource, parameters):
+    """
+    Computes the key of a request, used to find a recorded response
+    :param resource: the name of the resource (search, channels, videos, ...)
+    :param parameters: the parameters of the request
+    :return: the key
+    """
+    data = json.dumps([resource, parameters], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def request_uri(resource, parameters):
+    """
+    Returns an uri for a request that is not sent over the network, used as the key of the response cache
+    :param resource: the name of the resource
+    :param parameters: the parameters of the request
+    :return: the uri
+    """
+    return "replay://youtube/v3/" + resource + "?" + request_key(resource, parameters)
+
+
+class ReplayService:
+    """
+    Stand-in for the youtube service built by googleapiclient - serves recorded or synthetic responses with a
+    configurable latency and error rate and counts the requests and the returned items
+    """
+
+    def __init__(self, source, latency=0.0, error_rate=0.0, error_status=500, seed=0):
+        """
+        Class constructor
+        :param source: object with a response(resource, parameters) method (RecordedSource or SyntheticSource)
+        :param latency: the number of seconds each request takes
+        :param error_rate: the probability of a request to fail with a http error
+        :param error_status: the status of the injected errors (403 for quota errors)
+        :param seed: the seed used for the injected errors
+        """
+        self.__source = source
+        self.__latency = latency
+        self.__error_rate = error_rate
+        self.__error_status = error_status
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__calls = {}
+        self.__items = 0
+        self.__errors = 0
+
+    def __getattr__(self, resource):
+        if resource not in RESOURCES:
+            raise AttributeError(resource)
+        return lambda: _ReplayResource(self, resource)
+
+    def execute(self, resource, parameters):
+        """
+        Returns the response of a request after the configured latency
+        :param resource: the name of the resource
+        :param parameters: the parameters of the request
+        :return: the response
+        :raise HttpError: for the injected errors and the requests without response
+        """
+        if self.__latency:
+            time.sleep(self.__latency)
+
+        with self.__lock:
+            self.__calls[resource] = self.__calls.get(resource, 0) + 1
+            failed = self.__random.random() < self.__error_rate
+            if failed:
+                self.__errors += 1
+
+        if failed:
+            raise http_error(self.__error_status, request_uri(resource, parameters))
+
+        response = self.__source.response(resource, parameters)
+
+        with self.__lock:
+            self.__items += len(response.get('items', []))
+
+        return response
+
+    def get_counters(self):
+        """
+        Returns the counters of the service
+        :return: dictionary with the number of calls per resource, returned items and injected errors
+        """
+        with self.__lock:
+            return {
+                'calls': dict(self.__calls),
+                'items': self.__items,
+                'errors': self.__errors
+            }
+
+    def reset_counters(self):
+        """
+        Sets the counters to zero
+        """
+        with self.__lock:
+            self.__calls = {}
+            self.__items = 0
+            self.__errors = 0
+
+
+class _ReplayResource:
+    """
+    A resource of the replay service (service.videos())
+    """
+
+    def __init__(self, service, resource):
+        self.__service = service
+        self.__resource = resource
+
+    def list(self, **kwargs):
+        return _ReplayRequest(self.__service, self.__resource, kwargs)
+
+
+class _ReplayRequest:
+    """
+    A request of the replay service (service.videos().list(...))
+    """
+
+    def __init__(self, service, resource, parameters):
+        self.__service = service
+        self.__resource = resource
+        self.__parameters = dict(parameters)
+        self.uri = request_uri(resource, self.__parameters)
+
+    def execute(self, http=None, num_retries=0):
+        return self.__service.execute(self.__resource, self.__parameters)
+
+
+def http_error(status, uri, reason=None):
+    """
+    Creates a http error like the ones raised by googleapiclient
+    :param status: the http status
+    :param uri: the uri of the request
+    :param reason: the reason of the error (quotaExceeded for status 403 by default)
+    :return: the error
+    """
+    if reason is None:
+        reason = 'quotaExceeded' if status == 403 else 'backendError'
+    content = json.dumps({
+        'error': {
+            'code': status,
+            'message': reason,
+            'errors': [{'reason': reason, 'message': reason}]
+        }
+    }).encode('utf-8')
+    return HttpError(httplib2.Response({'status': status}), content, uri=uri)
+
+
+class RecordedSource:
+    """
+    Responses recorded with RecordingService
+    """
+
+    def __init__(self, folder=RECORDINGS_FOLDER):
+        """
+        Class constructor
+        :param folder: the folder with the recorded responses
+        """
+        self.__folder = folder
+
+    def response(self, resource, parameters):
+        """
+        Returns the recorded response of a request
+        :param resource: the name of the resource
+        :param parameters: the parameters of the request
+        :return: the response
+        :raise HttpError: if the request was not recorded
+        """
+        path = os.path.join(self.__folder, request_key(resource, parameters) + JSON_EXTENSION)
+        if not os.path.exists(path):
+            raise http_error(404, request_uri(resource, parameters), reason='notRecorded')
+        with open(path) as f:
+            return json.load(f)['response']
+
+
+class RecordingService:
+    """
+    Wrapper of the youtube service that saves every response, so the requests can be replayed later by a
+    ReplayService with a RecordedSource
+    """
+
+    def __init__(self, service, folder=RECORDINGS_FOLDER):
+        """
+        Class constructor
+        :param service: the youtube service built by googleapiclient
+        :param folder: the folder where the responses are saved
+        """
+        self.__service = service
+        self.__folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def __getattr__(self, resource):
+        if resource not in RESOURCES:
+            raise AttributeError(resource)
+        return lambda: _RecordingResource(self, resource)
+
+    def record(self, resource, parameters, http):
+        """
+        Makes a request with the wrapped service and saves the response
+        :param resource: the name of the resource
+        :param parameters: the parameters of the request
+        :param http: the http connection used for the request
+        :return: the response
+        """
+        response = getattr(self.__service, resource)().list(**parameters).execute(http=http)
+        path = os.path.join(self.__folder, request_key(resource, parameters) + JSON_EXTENSION)
+        with open(path, 'w') as f:
+            json.dump({'resource': resource, 'parameters': parameters, 'response': response}, f, default=str)
+        return response
+
+
+class _RecordingResource:
+    """
+    A resource of the recording service
+    """
+
+    def __init__(self, service, resource):
+        self.__service = service
+        self.__resource = resource
+
+    def list(self, **kwargs):
+        return _RecordingRequest(self.__service, self.__resource, kwargs)
+
+
+class _RecordingRequest:
+    """
+    A request of the recording service
+    """
+
+    def __init__(self, service, resource, parameters):
+        self.__service = service
+        self.__resource = resource
+        self.__parameters = dict(parameters)
+        self.uri = request_uri(resource, self.__parameters)
+
+    def execute(self, http=None, num_retries=0):
+        return self.__service.record(self.__resource, self.__parameters, http)
+
+
+class SyntheticSource:
+    """
+    Deterministic synthetic youtube data - channels with playlists, videos with comment threads and replies
+    written by a fixed pool of authors, so the crawl produces a connected users network
+    """
+
+    def __init__(self, seed=0, nr_channels=200, nr_authors=5000, search_pages=10, playlists_per_channel=5,
+                 videos_per_playlist=20, max_comments=500, max_replies=20):
+        """
+        Class constructor
+        :param seed: the seed of the generated data
+        :param nr_channels: the number of channels that upload videos
+        :param nr_authors: the number of channels that write comments
+        :param search_pages: the number of pages of results of a search
+        :param playlists_per_channel: the number of playlists of a channel
+        :param videos_per_playlist: the number of videos of a playlist
+        :param max_comments: the maximum number of comment threads of a video
+        :param max_replies: the maximum number of replies of a comment thread
+        """
+        self.__seed = seed
+        self.__nr_channels = nr_channels
+        self.__nr_authors = nr_authors
+        self.__search_pages = search_pages
+        self.__playlists_per_channel = playlists_per_channel
+        self.__videos_per_playlist = videos_per_playlist
+        self.__max_comments = max_comments
+        self.__max_replies = max_replies
+
+    def response(self, resource, parameters):
+        """
+        Generates the response of a request
+        :param resource: the name of the resource
+        :param parameters: the parameters of the request
+        :return: the response
+        """
+        return getattr(self, '_SyntheticSource__' + resource)(parameters)
+
+    def __random(self, *key):
+        """
+        Returns a random generator that always produces the same values for the same key
+        :param key: the values that identify the generated data
+        :return: the random generator
+        """
+        return random.Random(":".join([str(self.__seed)] + [str(k) for k in key]))
+
+    @staticmethod
+    def __page(parameters, total, item, default_size=5):
+        """
+        Creates a page of results like the list endpoints of the youtube api
+        :param parameters: the parameters of the request (pageToken, maxResults)
+        :param total: the total number of items
+        :param item: function that creates the item with an index
+        :param default_size: the number of items per page when maxResults is missing
+        :return: the response
+        """
+        start = int(parameters.get('pageToken') or 0)
+        size = min(100, int(parameters.get('maxResults', default_size)))
+        end = min(total, start + size)
+        response = {
+            'etag': '"' + request_key('page', parameters) + '"',
+            'pageInfo': {'totalResults': total, 'resultsPerPage': size},
+            'items': [item(i) for i in range(start, end)]
+        }
+        if end < total:
+            response['nextPageToken'] = str(end)
+        return response
+
+    @staticmethod
+    def __channel_id(index):
+        return "UC" + "%04d" % index + hashlib.md5(("channel" + str(index)).encode()).hexdigest()[:18]
+
+    def __video_id(self, channel_index, *key):
+        # the index of the channel that uploaded the video is part of the id
+        return "v" + "%04d" % channel_index + request_key(str(self.__seed), key)[:6]
+
+    def __video_channel(self, video_id):
+        return self.__channel_id(int(video_id[1:5]))
+
+    def __author(self, rng):
+        index = rng.randrange(self.__nr_authors)
+        if index < self.__nr_channels:
+            author_id = self.__channel_id(index)
+        else:
+            author_id = "UC" + hashlib.md5(("author" + str(index)).encode()).hexdigest()[:22]
+        return author_id, "Author " + str(index)
+
+    def __video_comment_count(self, video_id):
+        return self.__random('comments', video_id).randrange(self.__max_comments + 1)
+
+    def __snippet(self, title, **kwargs):
+        snippet = {
+            'title': title,
+            'description': "Description of " + title,
+            'publishedAt': '2019-01-01T00:00:00.000Z'
+        }
+        snippet.update(kwargs)
+        return snippet
+
+    def __search(self, parameters):
+        keyword = parameters.get('q') or parameters.get('location')
+        total = self.__search_pages * int(parameters.get('maxResults', 5))
+
+        def item(i):
+            rng = self.__random('search', keyword, i)
+            channel_index = rng.randrange(self.__nr_channels)
+            channel_id = self.__channel_id(channel_index)
+            kind = rng.choice(['video'] * 8 + ['channel', 'playlist'])
+            if kind == 'channel':
+                resource_id = {'kind': 'youtube#channel', 'channelId': channel_id}
+            elif kind == 'playlist':
+                resource_id = {'kind': 'youtube#playlist', 'playlistId': "PL" + channel_id + "_" + str(i)}
+            else:
+                resource_id = {'kind': 'youtube#video', 'videoId': self.__video_id(channel_index, keyword, i)}
+            return {
+                'id': resource_id,
+                'snippet': self.__snippet(kind + " " + str(i), channelId=channel_id)
+            }
+
+        return self.__page(parameters, total, item)
+
+    def __channels(self, parameters):
+        items = []
+        for channel_id in parameters['id'].split(','):
+            rng = self.__random('channel', channel_id)
+            items.append({
+                'id': channel_id,
+                'snippet': self.__snippet("Channel " + channel_id),
+                'statistics': {
+                    'viewCount': str(rng.randrange(10 ** 7)),
+                    'subscriberCount': str(rng.randrange(10 ** 6)),
+                    'videoCount': str(rng.randrange(10 ** 3)),
+                    'commentCount': '0'
+                },
+                'contentDetails': {'relatedPlaylists': {'uploads': "UU" + channel_id[2:]}}
+            })
+        return {'etag': '"' + request_key('channels', parameters) + '"', 'items': items}
+
+    def __playlists(self, parameters):
+        channel_id = parameters['channelId']
+        return self.__page(parameters, self.__playlists_per_channel, lambda i: {
+            'id': "PL" + channel_id + "_" + str(i),
+            'snippet': self.__snippet("Playlist " + str(i), channelId=channel_id)
+        })
+
+    def __playlistItems(self, parameters):
+        playlist_id = parameters['playlistId']
+        if playlist_id.startswith('UU'):
+            channel_id = "UC" + playlist_id[2:]  # uploads playlist
+        else:
+            channel_id = playlist_id[2:].rsplit('_', 1)[0]
+        if not channel_id[2:6].isdigit():
+            # the authors that do not own a channel of the source have no uploads
+            return self.__page(parameters, 0, None)
+        channel_index = int(channel_id[2:6])
+        return self.__page(parameters, self.__videos_per_playlist, lambda i: {
+            'id': playlist_id + "_" + str(i),
+            'snippet': self.__snippet("Video " + str(i), channelId=channel_id, playlistId=playlist_id,
+                                      resourceId={'kind': 'youtube#video',
+                                                  'videoId': self.__video_id(channel_index, playlist_id, i)})
+        })
+
+    def __videos(self, parameters):
+        items = []
+        for video_id in parameters['id'].split(','):
+            rng = self.__random('video', video_id)
+            items.append({
+                'id': video_id,
+                'statistics': {
+                    'viewCount': str(rng.randrange(10 ** 7)),
+                    'likeCount': str(rng.randrange(10 ** 5)),
+                    'dislikeCount': str(rng.randrange(10 ** 3)),
+                    'favoriteCount': '0',
+                    'commentCount': str(self.__video_comment_count(video_id))
+                }
+            })
+        return {'etag': '"' + request_key('videos', parameters) + '"', 'items': items}
+
+    def __comment(self, comment_id, video_id, rng, published_at, parent_id=None):
+        author_id, author_name = self.__author(rng)
+        snippet = {
+            'videoId': video_id,
+            'authorDisplayName': author_name,
+            'authorChannelId': {'value': author_id},
+            'textDisplay': "Comment " + comment_id,
+            'likeCount': rng.randrange(100),
+            'publishedAt': published_at
+        }
+        if parent_id:
+            snippet['parentId'] = parent_id
+        return {'id': comment_id, 'snippet': snippet}
+
+    def __thread_replies(self, thread_id):
+        return self.__random('replies', thread_id).randrange(self.__max_replies + 1)
+
+    def __commentThreads(self, parameters):
+        video_id = parameters['videoId']
+        total = self.__video_comment_count(video_id)
+
+        def item(i):
+            # the newest threads first, like order=time
+            thread_id = "Ug" + video_id + "_" + str(total - i)
+            rng = self.__random('thread', thread_id)
+            published_at = (datetime(2019, 1, 1) + timedelta(minutes=total - i)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            nr_replies = self.__thread_replies(thread_id)
+            thread = {
+                'id': thread_id,
+                'snippet': {
+                    'videoId': video_id,
+                    'channelId': self.__video_channel(video_id),
+                    'totalReplyCount': nr_replies,
+                    'topLevelComment': self.__comment(thread_id, video_id, rng, published_at)
+                }
+            }
+            if nr_replies:
+                thread['replies'] = {'comments': [
+                    self.__comment(thread_id + "." + str(r), video_id, self.__random('reply', thread_id, r),
+                                   published_at, parent_id=thread_id)
+                    for r in range(min(nr_replies, 5))
+                ]}
+            return thread
+
+        return self.__page(parameters, total, item, default_size=20)
+
+    def __comments(self, parameters):
+        thread_id = parameters['parentId']
+        video_id = thread_id[2:].rsplit('_', 1)[0]
+        return self.__page(parameters, self.__thread_replies(thread_id), lambda r: self.__comment(
+            thread_id + "." + str(r), video_id, self.__random('reply', thread_id, r),
+            '2019-01-01T00:00:00.000Z', parent_id=thread_id
+        ), default_size=20)
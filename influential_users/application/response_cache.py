@@ -0,0 +1,289 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import httplib2
+
+CACHE_FOLDER = '.cache'
+CACHE_EXTENSION = '.response'
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024  # the maximum size of the cached responses
+
+# number of seconds a response of each endpoint is used without asking the server
+ENDPOINT_TTLS = {
+    'search': 60 * 60,
+    'channels': 24 * 60 * 60,
+    'playlists': 24 * 60 * 60,
+    'playlistItems': 6 * 60 * 60,
+    'videos': 60 * 60,
+    'commentThreads': 15 * 60,
+    'comments': 15 * 60,
+}
+DEFAULT_TTL = 0  # the responses of other endpoints are always revalidated
+
+IGNORED_PARAMETERS = ['key']  # query parameters that do not change the response
+
+
+class ResponseCache:
+    """
+    Bounded on-disk cache of http responses. The entries are addressed by the hash of the request, expire after a
+    time-to-live that depends on the endpoint and the least recently used ones are removed when the total size
+    exceeds the limit
+    """
+
+    def __init__(self, folder=CACHE_FOLDER, max_bytes=DEFAULT_MAX_BYTES, ttls=None):
+        """
+        Class constructor - loads the index of the entries that are already in the folder
+        :param folder: the folder where the responses are stored
+        :param max_bytes: the maximum size of the stored responses
+        :param ttls: dictionary endpoint -> time-to-live in seconds (ENDPOINT_TTLS by default)
+        """
+        self.__folder = folder
+        self.__max_bytes = max_bytes
+        self.__ttls = ENDPOINT_TTLS if ttls is None else ttls
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key -> size in bytes, the least recently used first
+        self.__stored = {}  # key -> the time the response was stored, for the entries written or read by this run
+        self.__total_bytes = 0
+
+        os.makedirs(folder, exist_ok=True)
+
+        files = []
+        for name in os.listdir(folder):
+            if name.endswith(CACHE_EXTENSION):
+                stat = os.stat(os.path.join(folder, name))
+                files.append((stat.st_mtime, name[:-len(CACHE_EXTENSION)], stat.st_size))
+        for _, key, size in sorted(files):
+            self.__entries[key] = size
+            self.__total_bytes += size
+
+        with self.__lock:
+            self.__evict()
+
+    @staticmethod
+    def key(uri):
+        """
+        Computes the key of a request - the hash of the uri without the parameters that do not change the response
+        :param uri: the uri of the request
+        :return: the key
+        """
+        parts = urlsplit(uri)
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                       if k not in IGNORED_PARAMETERS)
+        normalized = parts.path + "?" + urlencode(query)
+        return hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+
+    def ttl(self, uri):
+        """
+        Returns the time-to-live of the responses of the endpoint requested by an uri
+        :param uri: the uri of the request
+        :return: the number of seconds
+        """
+        endpoint = urlsplit(uri).path.rstrip('/').rsplit('/', 1)[-1]
+        return self.__ttls.get(endpoint, DEFAULT_TTL)
+
+    def get(self, key):
+        """
+        Returns a cached response and marks it as recently used
+        :param key: the key of the request
+        :return: dictionary with the headers, the content and the time it was stored or None
+        """
+        with self.__lock:
+            if key not in self.__entries:
+                return None
+            self.__entries.move_to_end(key)
+
+        try:
+            with open(self.__path(key), 'rb') as f:
+                entry = pickle.load(f)
+            os.utime(self.__path(key))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.delete(key)
+            return None
+
+        with self.__lock:
+            if key in self.__entries:
+                self.__stored[key] = entry['stored']
+        return entry
+
+    def is_fresh(self, uri):
+        """
+        Checks if the response of a request can be served from the cache without asking the server - only the
+        index is read, so the entries loaded from the folder are not fresh until they are read once. The answer
+        can be outdated by the time the request is made; CachingHttp reports whether a response came from the cache
+        :param uri: the uri of the request
+        :return: True if the response is cached and has not expired
+        """
+        key = self.key(uri)
+        with self.__lock:
+            stored = self.__stored.get(key)
+        return stored is not None and time.time() - stored < self.ttl(uri)
+
+    def set(self, key, headers, content):
+        """
+        Stores a response and removes the least recently used ones if the size limit is exceeded
+        :param key: the key of the request
+        :param headers: dictionary with the response headers
+        :param content: the body of the response
+        """
+        stored = time.time()
+        data = pickle.dumps({
+            'headers': headers,
+            'content': content,
+            'stored': stored
+        })
+        if len(data) > self.__max_bytes:
+            return
+
+        path = self.__path(key)
+        temp_path = path + "." + str(threading.get_ident())
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self.__lock:
+            self.__total_bytes += len(data) - self.__entries.pop(key, 0)
+            self.__entries[key] = len(data)
+            self.__stored[key] = stored
+            self.__evict()
+
+    def refresh(self, key, entry):
+        """
+        Marks a response as validated now - used when the server confirms that it has not changed
+        :param key: the key of the request
+        :param entry: the cached entry
+        """
+        self.set(key, entry['headers'], entry['content'])
+
+    def delete(self, key):
+        """
+        Removes a response from the cache
+        :param key: the key of the request
+        """
+        with self.__lock:
+            self.__total_bytes -= self.__entries.pop(key, 0)
+            self.__stored.pop(key, None)
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+    def __evict(self):
+        """
+        Removes the least recently used responses until the size limit is respected. Must be called with the
+        lock acquired
+        """
+        while self.__total_bytes > self.__max_bytes and self.__entries:
+            key, size = self.__entries.popitem(last=False)
+            self.__total_bytes -= size
+            self.__stored.pop(key, None)
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+
+    def __path(self, key):
+        """
+        Returns the path of the file of a response
+        :param key: the key of the request
+        :return: the path
+        """
+        return os.path.join(self.__folder, key + CACHE_EXTENSION)
+
+
+class CachingHttp(httplib2.Http):
+    """
+    Http connection that serves GET requests from a ResponseCache while they are fresh and revalidates
+    expired responses with If-None-Match, so unchanged resources are not transferred again. After each request
+    from_cache tells if the response was served without asking the server
+    """
+
+    def __init__(self, response_cache, **kwargs):
+        """
+        Class constructor
+        :param response_cache: the response cache, can be shared by the connections of several threads
+        :param kwargs: arguments of httplib2.Http
+        """
+        super().__init__(**kwargs)
+        self.response_cache = response_cache
+        self.from_cache = False  # True if the last response was served from the cache
+
+    def request(self, uri, method="GET", body=None, headers=None, **kwargs):
+        """
+        Makes a http request, using the cached response when possible
+        :return: the response and the content
+        """
+        self.from_cache = False
+        if method != "GET":
+            return super().request(uri, method=method, body=body, headers=headers, **kwargs)
+
+        key = self.response_cache.key(uri)
+        entry = self.response_cache.get(key)
+
+        if entry is not None:
+            if time.time() - entry['stored'] < self.response_cache.ttl(uri):
+                self.from_cache = True
+                return self.__cached_response(entry), entry['content']
+            if 'etag' in entry['headers']:
+                headers = dict(headers or {})
+                headers['if-none-match'] = entry['headers']['etag']
+
+        response, content = super().request(uri, method=method, body=body, headers=headers, **kwargs)
+
+        if response.status == 304 and entry is not None:
+            self.response_cache.refresh(key, entry)
+            return self.__cached_response(entry), entry['content']
+
+        if response.status == 200:
+            self.response_cache.set(key, dict(response), content)
+
+        return response, content
+
+    @staticmethod
+    def __cached_response(entry):
+        """
+        Creates the response object of a cached entry
+        :param entry: the cached entry
+        :return: the response
+        """
+        response = httplib2.Response(entry['headers'])
+        response.fromcache = True
+        return response
+
+
+class HttpPool:
+    """
+    Idle http connections shared by the threads of the crawler. A request borrows a connection and gives it back
+    when it is done, so the short lived producer threads of the page streams reuse the open TLS connections instead
+    of opening one each - httplib2 connections are not thread safe, a connection is used by one thread at a time
+    """
+
+    def __init__(self, factory):
+        """
+        Class constructor
+        :param factory: function that creates a new connection when none is idle
+        """
+        self.__factory = factory
+        self.__idle = []  # the most recently used connection last
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """
+        Borrows an idle connection, or creates one if they are all in use
+        :return: context manager yielding the http object
+        """
+        with self.__lock:
+            http = self.__idle.pop() if self.__idle else None
+        if http is None:
+            http = self.__factory()
+
+        try:
+            yield http
+        finally:
+            with self.__lock:
+                self.__idle.append(http)
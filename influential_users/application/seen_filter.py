@@ -0,0 +1,148 @@
+import hashlib
+import math
+import threading
+
+DEFAULT_EXACT_LIMIT = 100000  # the number of ids kept in an exact set before switching to a bloom filter
+DEFAULT_BLOOM_CAPACITY = 10 ** 7  # the number of ids of the first bloom filter
+DEFAULT_ERROR_RATE = 0.001  # the maximum probability of a new id to be reported as seen by the bloom filters
+BLOOM_GROWTH = 2  # each bloom filter holds BLOOM_GROWTH times more ids than the previous one
+BLOOM_TIGHTENING = 0.5  # each bloom filter has BLOOM_TIGHTENING times the error rate of the previous one
+
+
+class BloomFilter:
+    """
+    Probabilistic set of strings: an added string is always found, a string that was not added is found with a
+    probability of at most error_rate while the filter holds at most capacity strings
+    """
+
+    def __init__(self, capacity=DEFAULT_BLOOM_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        """
+        Class constructor
+        :param capacity: the number of strings expected in the filter
+        :param error_rate: the probability of a false positive
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.__size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))  # number of bits
+        self.__hashes = max(1, round(self.__size / capacity * math.log(2)))  # number of bits set by a string
+        self.__bits = bytearray((self.__size + 7) // 8)
+
+    def add(self, key):
+        """
+        Adds a string to the filter
+        :param key: the string
+        """
+        for position in self.__positions(key):
+            self.__bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.__bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+    def __positions(self, key):
+        """
+        Computes the bits of a string with double hashing
+        :param key: the string
+        :return: generator of bit positions
+        """
+        digest = hashlib.blake2b(str(key).encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.__size for i in range(self.__hashes))
+
+
+class SeenFilter:
+    """
+    Thread safe set of the ids stored in a collection. The ids are kept in an exact set while there are few of
+    them, then moved to bloom filters so the memory stays bounded. When a bloom filter is full a larger one with
+    a lower error rate is added (a scalable bloom filter), so a new id is reported as seen with a probability of at
+    most error_rate however many ids are added. A miss is always exact: the id was never added
+    """
+
+    def __init__(self, exact_limit=DEFAULT_EXACT_LIMIT, capacity=DEFAULT_BLOOM_CAPACITY,
+                 error_rate=DEFAULT_ERROR_RATE):
+        """
+        Class constructor
+        :param exact_limit: the maximum number of ids in the exact set
+        :param capacity: the number of ids of the first bloom filter
+        :param error_rate: the maximum probability of a false positive of the bloom filters
+        """
+        self.__exact_limit = exact_limit
+        self.__capacity = capacity
+        self.__error_rate = error_rate
+        self.__ids = set()
+        self.__blooms = []  # the bloom filters, the ids are added to the last one
+        self.__bloom_count = 0  # the number of ids in the last bloom filter
+        self.__count = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return self.__count
+
+    def __contains__(self, key):
+        with self.__lock:
+            if self.__blooms:
+                return any(key in bloom for bloom in self.__blooms)
+            return key in self.__ids
+
+    def add(self, key):
+        """
+        Adds an id to the filter
+        :param key: the id
+        :return: False if the id was already seen or is a false positive of the bloom filters
+        """
+        with self.__lock:
+            if self.__blooms:
+                if any(key in bloom for bloom in self.__blooms):
+                    return False
+                self.__add_to_bloom(key)
+            else:
+                if key in self.__ids:
+                    return False
+                self.__ids.add(key)
+                if len(self.__ids) > self.__exact_limit:
+                    self.__switch_to_bloom()
+            self.__count += 1
+            return True
+
+    def discard(self, key):
+        """
+        Removes an id whose write failed. The bloom filters cannot remove it, their positives are confirmed by the
+        storage before they are trusted
+        :param key: the id
+        """
+        with self.__lock:
+            if key in self.__ids:
+                self.__ids.remove(key)
+                self.__count -= 1
+
+    def is_exact(self):
+        """
+        Checks if the filter still holds the exact set of ids
+        :return: False if the ids were moved to bloom filters - a positive can then be false
+        """
+        return not self.__blooms
+
+    def __add_to_bloom(self, key):
+        """
+        Adds an id to the last bloom filter, after adding a larger one if it is full
+        :param key: the id
+        """
+        last = self.__blooms[-1]
+        if self.__bloom_count >= last.capacity:
+            last = BloomFilter(last.capacity * BLOOM_GROWTH, last.error_rate * BLOOM_TIGHTENING)
+            self.__blooms.append(last)
+            self.__bloom_count = 0
+        last.add(key)
+        self.__bloom_count += 1
+
+    def __switch_to_bloom(self):
+        """
+        Moves the ids of the exact set to the first bloom filter - its error rate is chosen so the sum of the error
+        rates of all the filters stays below error_rate
+        """
+        self.__blooms = [BloomFilter(max(self.__capacity, 10 * len(self.__ids)),
+                                     self.__error_rate * (1 - BLOOM_TIGHTENING))]
+        self.__bloom_count = 0
+        for key in self.__ids:
+            self.__add_to_bloom(key)
+        self.__ids = set()
@@ -0,0 +1,1217 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from datetime import datetime
+
+from dotenv import load_dotenv
+
+from influential_users.application.message_logger import MessageLogger
+from influential_users.application.seen_filter import SeenFilter
+from influential_users.application.storage import (
+    AGGREGATION_BATCH_SIZE, AUTHORS_COLLECTION, CHANNEL_ENTITY, CHANNELS_COLLECTION, COMMENTS_COLLECTION,
+    DATABASE_NAME, DEFAULT_BUFFER_SIZE, DEFAULT_FLUSH_INTERVAL, EDGES_BACKFILL_MIGRATION, EDGES_COLLECTION,
+    GROWTH_WINDOW, MAX_TOKEN_ATTEMPTS, MIGRATION_BATCH_SIZE, MIGRATIONS_COLLECTION, PLAYLISTS_COLLECTION,
+    REPLIES_COLLECTION, SEARCH_RESULTS_COLLECTION, SEEN_COLLECTIONS, STATISTICS_COLLECTION, StorageBackend,
+    TOKEN_DEAD, TOKEN_LEASE_SECONDS, TOKEN_LEASED, TOKEN_PENDING, TOKENS_COLLECTION, VIDEO_ENTITY, VIDEOS_COLLECTION,
+    create_interaction, create_statistics_snapshot, interaction_updates, register_exit_flush, token_lease_filter,
+    token_lease_update, unregister_exit_flush
+)
+
+load_dotenv()
+SQLITE_FOLDER = os.getenv('SQLITE_FOLDER', '.storage')
+SQLITE_EXTENSION = '.sqlite3'
+SQLITE_BUSY_TIMEOUT = 30  # the number of seconds a connection waits for the write lock of another process
+SQLITE_CACHE_SIZE = 64 * 1024  # KiB of page cache per connection
+DEFAULT_BATCH_SIZE = 1000  # the number of rows fetched at a time by the cursors
+
+DATE_KEY = '$date'  # datetimes are stored as {"$date": "<ISO 8601>"}, so they are read back as datetimes
+FIELD_NAME = re.compile(r'^[^."\']+$')
+
+# the collections stored as (id, JSON document) rows - the statistics snapshots have their own table
+DOCUMENT_COLLECTIONS = [SEARCH_RESULTS_COLLECTION, CHANNELS_COLLECTION, PLAYLISTS_COLLECTION, VIDEOS_COLLECTION,
+                        COMMENTS_COLLECTION, REPLIES_COLLECTION, TOKENS_COLLECTION, EDGES_COLLECTION,
+                        AUTHORS_COLLECTION, MIGRATIONS_COLLECTION]
+
+# the indexes on the fields of the documents: collection name -> list of indexed fields
+INDEXES = {
+    SEARCH_RESULTS_COLLECTION: [
+        ['keyword', 'search_type', 'order', 'pageToken'],
+    ],
+    COMMENTS_COLLECTION: [
+        ['videoId'],
+    ],
+    REPLIES_COLLECTION: [
+        ['parentId'],
+        ['videoId'],
+    ],
+    TOKENS_COLLECTION: [
+        ['state', 'type', 'priority'],
+    ],
+    EDGES_COLLECTION: [
+        ['videoId'],
+    ],
+}
+
+
+def encode_document(document):
+    """
+    Serializes a document to JSON
+    :param document: the document
+    :return: the JSON text
+    """
+    return json.dumps(document, default=_encode_value, separators=(',', ':'))
+
+
+def decode_document(text):
+    """
+    Deserializes a document from JSON
+    :param text: the JSON text
+    :return: the document
+    """
+    return json.loads(text, object_hook=_decode_object)
+
+
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {DATE_KEY: _encode_date(value)}
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+def _encode_date(value):
+    return value.isoformat(timespec='microseconds')
+
+
+def _decode_object(value):
+    if len(value) == 1 and DATE_KEY in value:
+        return datetime.fromisoformat(value[DATE_KEY])
+    return value
+
+
+def _json_path(field, date=False):
+    """
+    Converts a dotted field name to a SQLite JSON path
+    :param field: the field name (e.g. statistics.commentCount)
+    :param date: True to address the value of a stored datetime
+    :return: the path (e.g. $."statistics"."commentCount")
+    """
+    parts = field.split('.')
+    if not all(FIELD_NAME.match(part) for part in parts):
+        raise ValueError("Unsupported field name: " + field)
+    if date:
+        parts.append(DATE_KEY)
+    return '$' + ''.join('."' + part + '"' for part in parts)
+
+
+def _json_field(field, date=False, table=None):
+    return "json_extract(" + (table + "." if table else "") + "doc, '" + _json_path(field, date) + "')"
+
+
+class SQLiteDB(StorageBackend):
+    """
+    Embedded storage backend on a SQLite file in WAL mode, so a crawl or an analysis can run without a database
+    server. Each collection is a table of (id, JSON document) rows with indexes on the queried fields
+    """
+
+    """ Init """
+
+    def __init__(self, database_name=DATABASE_NAME, seen_filters=True, buffered=False, buffer_size=DEFAULT_BUFFER_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, path=None):
+        """
+        Init method for opening the database file
+        :param database_name: the name of the database - the file is SQLITE_FOLDER/<database_name>.sqlite3
+        :param seen_filters: if True, the ids of the channels, playlists and videos are loaded at startup and kept in
+        memory, so the inserts of known documents are skipped without a query
+        :param buffered: if True, the inserts and updates of the channels, playlists, videos and comments are queued
+        and written in a single transaction - the queued writes are flushed before every read and at exit
+        :param buffer_size: the number of queued operations that triggers a flush
+        :param flush_interval: the maximum age in seconds of the queued operations - a background thread writes
+        them when they get older, also while nothing new is queued
+        :param path: the path of the database file, instead of the one derived from the database name
+        """
+
+        # logging module
+        ml = MessageLogger('sqlite')
+        self.logger = ml.get_logger()
+
+        if path is None:
+            os.makedirs(SQLITE_FOLDER, exist_ok=True)
+            path = os.path.join(SQLITE_FOLDER, database_name + SQLITE_EXTENSION)
+        self.__path = path
+        self.__local = threading.local()  # the connection of each thread
+        self.__connections = {}  # thread -> its connection
+        self.__connections_lock = threading.Lock()
+        self.__write_lock = threading.Lock()  # the transactions of the process are made one at a time
+
+        self.__create_tables()
+        self.__seen = {}  # collection name -> SeenFilter with the stored ids
+        if seen_filters:
+            self.__warm_seen_filters()
+
+        self.__buffered = buffered
+        self.__buffer_size = buffer_size
+        self.__flush_interval = flush_interval
+        self.__buffer = []  # queued (function, arguments) writes
+        self.__last_flush = time.monotonic()
+        self.__buffer_lock = threading.Lock()
+        self.__flush_lock = threading.Lock()
+        self.__closed = threading.Event()
+        self.__flusher = None
+        if buffered:
+            register_exit_flush(self)
+            self.__flusher = threading.Thread(target=self.__flush_periodically, args=(weakref.ref(self), self.__closed),
+                                              name="sqlite-flush", daemon=True)
+            self.__flusher.start()
+
+    def __connection(self):
+        """
+        Returns the connection of the current thread - SQLite connections cannot be shared between threads that
+        use them at the same time, WAL mode lets the readers run while a transaction is written. The connections
+        of the threads that ended are closed when a new one is opened, so the short lived threads of the crawler do
+        not leave open connections behind
+        :return: the sqlite3 connection
+        """
+        connection = getattr(self.__local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.__path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+                                         check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA cache_size=-" + str(SQLITE_CACHE_SIZE))
+            self.__local.connection = connection
+            with self.__connections_lock:
+                for thread in [thread for thread in self.__connections if not thread.is_alive()]:
+                    self.__connections.pop(thread).close()
+                self.__connections[threading.current_thread()] = connection
+        return connection
+
+    @contextmanager
+    def __transaction(self):
+        """
+        Runs the statements of the block in a single write transaction
+        :return: the connection of the current thread
+        """
+        with self.__write_lock:
+            connection = self.__connection()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+
+    def __create_tables(self):
+        """
+        Creates the tables and the indexes that do not exist
+        """
+        with self.__transaction() as connection:
+            for name in DOCUMENT_COLLECTIONS:
+                connection.execute('CREATE TABLE IF NOT EXISTS "' + name + '" (id TEXT PRIMARY KEY, doc TEXT NOT NULL)')
+            connection.execute('CREATE TABLE IF NOT EXISTS "' + STATISTICS_COLLECTION + '" (entity_type TEXT NOT NULL, '
+                               'entity_id TEXT NOT NULL, timestamp TEXT NOT NULL, doc TEXT NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS "' + STATISTICS_COLLECTION + '_entity" ON "' +
+                               STATISTICS_COLLECTION + '" (entity_type, entity_id, timestamp)')
+
+            for name, indexes in INDEXES.items():
+                for fields in indexes:
+                    connection.execute('CREATE INDEX IF NOT EXISTS "' + name + '_' + '_'.join(fields) + '" ON "' +
+                                       name + '" (' + ', '.join(_json_field(field) for field in fields) + ')')
+
+    def __warm_seen_filters(self):
+        """
+        Loads the ids of the stored documents in the seen filters
+        """
+        for name in SEEN_COLLECTIONS:
+            seen = SeenFilter()
+            for (document_id,) in self.__connection().execute('SELECT id FROM "' + name + '"'):
+                seen.add(document_id)
+            self.__seen[name] = seen
+            self.logger.info("Seen filter of " + name + ": " + str(len(seen)) + " ids")
+
+    def is_known(self, collection_name, document_id):
+        """
+        Checks if a document was stored. A miss of the filter is exact - a positive is confirmed with a query once
+        the filter holds many ids, since a bloom filter can report a new id as seen. Without the filters the table is
+        queried
+        :param collection_name: the name of the collection (CHANNELS_COLLECTION, VIDEOS_COLLECTION, ...)
+        :param document_id: the id of the document
+        :return: True if the document is known
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is not None and (document_id not in seen or seen.is_exact()):
+            return document_id in seen
+        return bool(list(self.__find(collection_name, {'_id': document_id}, {'_id': 1}, limit=1)))
+
+    """ Queries """
+
+    def __where(self, query):
+        """
+        Translates a MongoDB filter to a SQL condition. The supported operators are $eq, $ne, $gt, $gte, $lt,
+        $lte, $in, $nin, $exists, $and and $or
+        :param query: the filter
+        :return: tuple (SQL condition, list of parameters)
+        :raise ValueError: for an unsupported operator or field name
+        """
+        clauses = []
+        parameters = []
+        for field, condition in query.items():
+            if field in ('$and', '$or'):
+                parts = [self.__where(sub_query) for sub_query in condition]
+                clauses.append('(' + (' AND ' if field == '$and' else ' OR ').join(
+                    '(' + clause + ')' for clause, _ in parts) + ')')
+                for _, sub_parameters in parts:
+                    parameters.extend(sub_parameters)
+                continue
+
+            if isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+                comparisons = condition.items()
+            else:
+                comparisons = [('$eq', condition)]
+            for operator, value in comparisons:
+                clause, clause_parameters = self.__compare(field, operator, value)
+                clauses.append(clause)
+                parameters.extend(clause_parameters)
+
+        return ' AND '.join(clauses) or '1', parameters
+
+    @staticmethod
+    def __compare(field, operator, value):
+        """
+        Translates the comparison of a field to a SQL condition, with the semantics of MongoDB for missing fields
+        :param field: the dotted field name
+        :param operator: the comparison operator ($eq, $in, ...)
+        :param value: the compared value
+        :return: tuple (SQL condition, list of parameters)
+        """
+        if operator == '$exists':
+            if field == '_id':
+                return ('1' if value else '0'), []
+            return "json_type(doc, '" + _json_path(field) + "') IS " + ('NOT NULL' if value else 'NULL'), []
+
+        if operator in ('$in', '$nin'):
+            values = [v for v in value if v is not None]
+            is_date = any(isinstance(v, datetime) for v in values)
+            values = [_encode_date(v) if isinstance(v, datetime) else v for v in values]
+            column = 'id' if field == '_id' else _json_field(field, is_date)
+            members = column + ' IN (SELECT value FROM json_each(?))'
+            if operator == '$in':
+                if len(values) < len(value):
+                    return '(' + members + ' OR ' + column + ' IS NULL)', [json.dumps(values)]
+                return members, [json.dumps(values)]
+            if len(values) < len(value):
+                return '(' + column + ' IS NOT NULL AND NOT ' + members + ')', [json.dumps(values)]
+            return '(' + column + ' IS NULL OR NOT ' + members + ')', [json.dumps(values)]
+
+        is_date = isinstance(value, datetime)
+        column = 'id' if field == '_id' else _json_field(field, is_date)
+        if is_date:
+            value = _encode_date(value)
+        elif isinstance(value, (list, dict)):
+            value = encode_document(value)  # json_extract returns arrays and objects as minified JSON
+
+        if operator == '$eq':
+            if value is None:
+                return column + ' IS NULL', []
+            return column + ' = ?', [value]
+        if operator == '$ne':
+            if value is None:
+                return column + ' IS NOT NULL', []
+            return '(' + column + ' IS NULL OR ' + column + ' != ?)', [value]
+
+        comparisons = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}
+        if operator not in comparisons:
+            raise ValueError("Unsupported query operator: " + operator)
+        return column + ' ' + comparisons[operator] + ' ?', [value]
+
+    @staticmethod
+    def __project(document, projection):
+        """
+        Keeps the fields of a document selected by a MongoDB projection
+        :param document: the document
+        :param projection: dictionary field -> 1 to include or 0 to exclude (None for all the fields)
+        :return: the projected document
+        """
+        if not projection:
+            return document
+
+        include_id = projection.get('_id', 1)
+        fields = [field for field in projection if field != '_id']
+        if not any(projection[field] for field in fields) and not (include_id and '_id' in projection):
+            result = {k: v for k, v in document.items() if k != '_id' or include_id}
+            for field in fields:
+                *parents, name = field.split('.')
+                target = result
+                for parent in parents:
+                    target = target.get(parent) if isinstance(target, dict) else None
+                if isinstance(target, dict):
+                    target.pop(name, None)
+            return result
+
+        result = {'_id': document['_id']} if include_id and '_id' in document else {}
+        for field in fields:
+            *parents, name = field.split('.')
+            source = document
+            target = result
+            for parent in parents:
+                source = source.get(parent) if isinstance(source, dict) else None
+                target = target.setdefault(parent, {})
+            if isinstance(source, dict) and name in source:
+                target[name] = source[name]
+        return result
+
+    def __find(self, collection_name, query, projection=None, batch_size=None, order=None, limit=None):
+        """
+        Queries a collection - the queued writes are flushed first and the rows are fetched in batches
+        :param collection_name: the name of the collection
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of rows fetched at a time
+        :param order: optional SQL ORDER BY clause
+        :param limit: optional maximum number of documents
+        :return: generator of documents
+        """
+        self.flush()
+        where, parameters = self.__where(query)
+        ids_only = bool(projection) and projection.get('_id', 1) and not any(
+            included for field, included in projection.items() if field != '_id')
+        sql = 'SELECT id, ' + ('NULL' if ids_only else 'doc') + ' FROM "' + collection_name + '" WHERE ' + where
+        if order:
+            sql += ' ORDER BY ' + order
+        if limit:
+            sql += ' LIMIT ' + str(int(limit))
+        cursor = self.__connection().execute(sql, parameters)
+        return self.__documents(cursor, projection, ids_only, batch_size or DEFAULT_BATCH_SIZE)
+
+    def __documents(self, cursor, projection, ids_only, batch_size):
+        """
+        Decodes the rows of a cursor
+        :param cursor: the cursor of (id, doc) rows
+        :param projection: the fields that are returned (all by default)
+        :param ids_only: True if only the ids were selected
+        :param batch_size: the number of rows fetched at a time
+        :return: generator of documents
+        """
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            for document_id, doc in rows:
+                if ids_only:
+                    yield {'_id': document_id}
+                else:
+                    yield self.__project(dict(_id=document_id, **decode_document(doc)), projection)
+            rows = cursor.fetchmany(batch_size)
+
+    """ Writes """
+
+    @staticmethod
+    def __apply_update(document, update, insert=False):
+        """
+        Applies the $set, $setOnInsert, $unset and $inc operators of a MongoDB update to a document
+        :param document: the document, modified in place
+        :param update: the update operators
+        :param insert: True if the document is created by an upsert - $setOnInsert is ignored otherwise
+        :raise ValueError: for an unsupported operator
+        """
+        for operator, fields in update.items():
+            if operator not in ('$set', '$setOnInsert', '$unset', '$inc'):
+                raise ValueError("Unsupported update operator: " + operator)
+            if operator == '$setOnInsert':
+                if not insert:
+                    continue
+                operator = '$set'
+            for field, value in fields.items():
+                *parents, name = field.split('.')
+                target = document
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                if operator == '$set':
+                    target[name] = value
+                elif operator == '$unset':
+                    target.pop(name, None)
+                else:
+                    target[name] = target.get(name, 0) + value
+
+    @staticmethod
+    def __insert_row(connection, collection_name, document):
+        """
+        Inserts a document unless its id is stored
+        :param connection: the connection in a transaction
+        :param collection_name: the name of the collection
+        :param document: the document with an _id
+        :return: True if the document was inserted
+        """
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO "' + collection_name + '" (id, doc) VALUES (?, ?)',
+            (document['_id'], encode_document({k: v for k, v in document.items() if k != '_id'}))
+        )
+        return cursor.rowcount == 1
+
+    @staticmethod
+    def __upsert_rows(connection, collection_name, documents):
+        """
+        Inserts or updates documents by id - the fields of a stored document are replaced, the others are kept
+        :param connection: the connection in a transaction
+        :param collection_name: the name of the collection
+        :param documents: list of documents with an _id
+        """
+        connection.executemany(
+            'INSERT INTO "' + collection_name + '" (id, doc) VALUES (?, ?) '
+            'ON CONFLICT (id) DO UPDATE SET doc = json_patch(doc, excluded.doc)',
+            [(document['_id'], encode_document({k: v for k, v in document.items() if k != '_id'}))
+             for document in documents]
+        )
+
+    def __update_rows(self, connection, collection_name, query, update, order=None, multi=False):
+        """
+        Updates the documents matching a query
+        :param connection: the connection in a transaction
+        :param collection_name: the name of the collection
+        :param query: the filter of the documents
+        :param update: the $set, $unset and $inc operators
+        :param order: optional SQL ORDER BY clause choosing the updated document
+        :param multi: False to update only the first matching document
+        :return: list of the updated documents
+        """
+        where, parameters = self.__where(query)
+        sql = 'SELECT id, doc FROM "' + collection_name + '" WHERE ' + where
+        if order:
+            sql += ' ORDER BY ' + order
+        if not multi:
+            sql += ' LIMIT 1'
+
+        updated = []
+        for document_id, doc in connection.execute(sql, parameters).fetchall():
+            document = decode_document(doc)
+            self.__apply_update(document, update)
+            connection.execute('UPDATE "' + collection_name + '" SET doc = ? WHERE id = ?',
+                               (encode_document(document), document_id))
+            updated.append(dict(_id=document_id, **document))
+        return updated
+
+    def __upsert_updates(self, connection, collection_name, updates):
+        """
+        Applies update operators to documents by id - the missing documents are created, like MongoDB upserts
+        :param connection: the connection in a transaction
+        :param collection_name: the name of the collection
+        :param updates: list of (document id, update operators)
+        """
+        for document_id, update in updates:
+            row = connection.execute('SELECT doc FROM "' + collection_name + '" WHERE id = ?',
+                                     (document_id,)).fetchone()
+            document = decode_document(row[0]) if row else {}
+            self.__apply_update(document, update, insert=row is None)
+            connection.execute('INSERT OR REPLACE INTO "' + collection_name + '" (id, doc) VALUES (?, ?)',
+                               (document_id, encode_document(document)))
+
+    @staticmethod
+    def __insert_snapshot(connection, snapshot):
+        """
+        Inserts a statistics snapshot
+        :param connection: the connection in a transaction
+        :param snapshot: the snapshot with its timestamp and entity
+        """
+        connection.execute(
+            'INSERT INTO "' + STATISTICS_COLLECTION + '" (entity_type, entity_id, timestamp, doc) VALUES (?, ?, ?, ?)',
+            (snapshot['entity']['type'], snapshot['entity']['id'], _encode_date(snapshot['timestamp']),
+             encode_document(snapshot))
+        )
+
+    def __write(self, function, *args):
+        """
+        Runs a write in its own transaction, or queues it in buffered mode
+        :param function: the write method, called with the connection and the arguments
+        :param args: the arguments of the write
+        """
+        if self.__buffered:
+            self.__enqueue(function, args)
+            return
+
+        try:
+            with self.__transaction() as connection:
+                function(connection, *args)
+        except sqlite3.Error as e:
+            self.logger.error("Write error: " + str(e))
+
+    def __count_interactions(self, connection, interactions):
+        """
+        Counts the interactions of newly stored documents in the edges table and stores the names of their authors
+        :param connection: the connection in a transaction
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+        for name, updates in interaction_updates(interactions).items():
+            self.__upsert_updates(connection, name, updates)
+
+    def __insert_counted(self, connection, collection_name, data, interaction):
+        """
+        Inserts a document unless its id is stored, and counts its interaction if it was inserted
+        :param connection: the connection in a transaction
+        :param collection_name: the name of the collection
+        :param data: the document with an _id
+        :param interaction: optional interaction of the document
+        :return: True if the document was inserted
+        """
+        inserted = self.__insert_row(connection, collection_name, data)
+        if inserted and interaction:
+            self.__count_interactions(connection, [interaction])
+        return inserted
+
+    def __insert_new(self, collection_name, data, interaction=None):
+        """
+        Inserts a document unless the exact seen filter of the collection holds its id. A miss of the filter is a
+        new id, so the insert is queued in buffered mode - a positive of a bloom filter can be false, so the queued
+        writes are flushed, the insert is made and INSERT OR IGNORE decides
+        :param collection_name: the name of the collection
+        :param data: the document
+        :param interaction: optional interaction counted in the edges table if the document is inserted
+        :return: True if the document was inserted or queued, False if it was already stored or on error
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is not None and not seen.add(data['_id']):
+            if seen.is_exact():
+                return False
+            self.flush()
+        elif self.__buffered:
+            self.__enqueue(self.__insert_counted, (collection_name, data, interaction))
+            return True
+
+        try:
+            with self.__transaction() as connection:
+                inserted = self.__insert_counted(connection, collection_name, data, interaction)
+        except sqlite3.Error as e:
+            self.logger.error("Write error: " + str(e))
+            self.__forget_seen(collection_name, [data['_id']])
+            return False
+
+        if not inserted:
+            self.logger.info("Duplicate key: " + str(data['_id']))
+        return inserted
+
+    def __forget_seen(self, collection_name, document_ids):
+        """
+        Removes the ids of documents that were not written from the seen filter of a collection, so they are not
+        skipped when they are inserted again
+        :param collection_name: the name of the collection
+        :param document_ids: list of ids
+        """
+        seen = self.__seen.get(collection_name)
+        if seen is not None:
+            for document_id in document_ids:
+                seen.discard(document_id)
+
+    def __enqueue(self, function, args):
+        """
+        Queues a write and flushes the queue when it is full or old
+        :param function: the write method
+        :param args: the arguments of the write
+        """
+        with self.__buffer_lock:
+            self.__buffer.append((function, args))
+            due = (len(self.__buffer) >= self.__buffer_size or
+                   time.monotonic() - self.__last_flush >= self.__flush_interval)
+
+        if due:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the queued operations in a single transaction, in the order they were queued
+        """
+        with self.__flush_lock:
+            with self.__buffer_lock:
+                buffer = self.__buffer
+                self.__buffer = []
+                self.__last_flush = time.monotonic()
+
+            if not buffer:
+                return
+            try:
+                with self.__transaction() as connection:
+                    for function, args in buffer:
+                        function(connection, *args)
+            except sqlite3.Error as e:
+                self.logger.error("Write error, " + str(len(buffer)) + " operations lost: " + str(e))
+                for function, args in buffer:
+                    if function == self.__insert_counted:
+                        collection_name, data, _ = args
+                        self.__forget_seen(collection_name, [data['_id']])
+
+    @staticmethod
+    def __flush_periodically(reference, closed):
+        """
+        Flushes the queued operations once they are flush_interval seconds old, until the storage is closed or
+        collected - the writes of a crawl that stops queueing are not held until close(). The thread only keeps a
+        weak reference, so an instance that is never closed can still be collected
+        :param reference: weak reference to the storage
+        :param closed: the event set by close()
+        """
+        delay = 0.0
+        while not closed.wait(delay):
+            storage = reference()
+            if storage is None:
+                return
+            delay = storage.__flush_if_due()
+            del storage
+
+    def __flush_if_due(self):
+        """
+        Flushes the queued operations if they are flush_interval seconds old
+        :return: the number of seconds until the next flush is due
+        """
+        age = time.monotonic() - self.__last_flush
+        if age < self.__flush_interval:
+            return self.__flush_interval - age
+        self.flush()
+        return self.__flush_interval
+
+    def close(self):
+        """
+        Writes the queued operations and closes the connections
+        """
+        self.__closed.set()
+        if self.__flusher is not None:
+            self.__flusher.join()
+        self.flush()
+        unregister_exit_flush(self)
+        with self.__connections_lock:
+            for connection in self.__connections.values():
+                connection.close()
+            self.__connections = {}
+        self.__local = threading.local()
+
+    def drop_database(self):
+        """
+        Removes all the documents of the database
+        """
+        with self.__flush_lock, self.__buffer_lock:
+            self.__buffer = []
+        with self.__transaction() as connection:
+            for name in DOCUMENT_COLLECTIONS + [STATISTICS_COLLECTION]:
+                connection.execute('DROP TABLE IF EXISTS "' + name + '"')
+        self.__seen = {name: SeenFilter() for name in self.__seen}
+        self.__create_tables()
+
+    """ Search Results """
+
+    def insert_search_results(self, query):
+        """
+
+        :param query:
+        :return:
+        """
+        try:
+            with self.__transaction() as connection:
+                for document in query:
+                    if not self.__insert_row(connection, SEARCH_RESULTS_COLLECTION, document):
+                        self.logger.info("Duplicate key: " + str(document['_id']))
+        except sqlite3.Error as e:
+            self.logger.error("Write error: " + str(e))
+
+    def get_search_results(self, query, projection=None, batch_size=None):
+        """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents fetched at a time
+        :return: generator of documents
+        """
+        return self.__find(SEARCH_RESULTS_COLLECTION, query, projection, batch_size)
+
+    """ Channels """
+
+    def insert_channel(self, data):
+        """
+
+        :param data:
+        :return: True if the channel was inserted, False if it was already stored
+        """
+        return self.__insert_new(CHANNELS_COLLECTION, data)
+
+    def insert_channel_statistics(self, channel_id, statistics):
+        """
+        Stores a snapshot of the statistics of a channel and keeps the latest one on the channel document
+        :param channel_id: the id of the channel
+        :param statistics: dictionary with the counts of the channel
+        """
+        self.insert_statistics_snapshot(CHANNEL_ENTITY, channel_id, statistics)
+        self.__write(self.__update_rows, CHANNELS_COLLECTION, {'_id': channel_id}, {'$set': {'statistics': statistics}})
+
+    def get_channel(self, query, projection=None, batch_size=None):
+        """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents fetched at a time
+        :return: generator of documents
+        """
+        return self.__find(CHANNELS_COLLECTION, query, projection, batch_size)
+
+    """ Playlists """
+
+    def insert_playlist(self, data):
+        """
+
+        :param data:
+        :return: True if the playlist was inserted, False if it was already stored
+        """
+        return self.__insert_new(PLAYLISTS_COLLECTION, data)
+
+    """ Videos """
+
+    def insert_video(self, data):
+        """
+
+        :param data:
+        :return: True if the video was inserted, False if it was already stored
+        """
+        return self.__insert_new(VIDEOS_COLLECTION, data)
+
+    def get_video(self, query, projection=None, batch_size=None):
+        """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents fetched at a time
+        :return: generator of documents
+        """
+        return self.__find(VIDEOS_COLLECTION, query, projection, batch_size)
+
+    def set_comments_mark(self, video_id, mark):
+        """
+        Stores the newest comment thread retrieved for a video - the high-water mark of the delta comment crawl
+        :param video_id: the id of the video
+        :param mark: dictionary with the commentId and the publishedAt of the newest comment thread
+        """
+        self.__write(self.__update_rows, VIDEOS_COLLECTION, {'_id': video_id}, {'$set': {'commentsMark': mark}})
+
+    def get_comments_mark(self, video_id):
+        """
+        Returns the newest comment thread retrieved for a video
+        :param video_id: the id of the video
+        :return: dictionary with the commentId and the publishedAt or None if the video was never refreshed
+        """
+        videos = list(self.__find(VIDEOS_COLLECTION, {'_id': video_id}, {'commentsMark': 1}, limit=1))
+        if videos:
+            return videos[0].get('commentsMark')
+        return None
+
+    def insert_video_statistics(self, video_id, data):
+        """
+        Stores a snapshot of the statistics of a video and keeps the latest one on the video document
+        :param video_id: the id of the video
+        :param data: dictionary with the counts of the video
+        """
+        self.insert_statistics_snapshot(VIDEO_ENTITY, video_id, data)
+        self.__write(self.__update_rows, VIDEOS_COLLECTION, {'_id': video_id}, {'$set': {'statistics': data}})
+
+    """ Statistics """
+
+    def insert_statistics_snapshot(self, entity_type, entity_id, statistics, timestamp=None):
+        """
+        Stores the statistics of a channel or a video at a moment in the statistics table
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param statistics: dictionary with the counts - the api returns them as strings
+        :param timestamp: the moment of the snapshot (now by default)
+        """
+        self.__write(self.__insert_snapshot, create_statistics_snapshot(entity_type, entity_id, statistics, timestamp))
+
+    def get_statistics(self, entity_type, entity_id, since=None, batch_size=None):
+        """
+        Returns the snapshots of a channel or a video, oldest first
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param since: optional datetime of the oldest snapshot
+        :param batch_size: the number of snapshots fetched at a time
+        :return: generator of snapshots
+        """
+        self.flush()
+        sql = 'SELECT doc FROM "' + STATISTICS_COLLECTION + '" WHERE entity_type = ? AND entity_id = ?'
+        parameters = [entity_type, entity_id]
+        if since is not None:
+            sql += ' AND timestamp >= ?'
+            parameters.append(_encode_date(since))
+        cursor = self.__connection().execute(sql + ' ORDER BY timestamp', parameters)
+
+        rows = cursor.fetchmany(batch_size or DEFAULT_BATCH_SIZE)
+        while rows:
+            for (doc,) in rows:
+                yield decode_document(doc)
+            rows = cursor.fetchmany(batch_size or DEFAULT_BATCH_SIZE)
+
+    def get_growth_rates(self, entity_type, metric, window=GROWTH_WINDOW, entity_ids=None, limit=None,
+                         batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes how fast a count grows for each entity: the difference between the last and the first snapshot
+        in the window, divided by the number of days between them. The entities with fewer than two snapshots in
+        the window are skipped
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param metric: the name of the count (subscriberCount, viewCount, ...)
+        :param window: timedelta of the window that ends now
+        :param entity_ids: optional list of entity ids - all the entities of the type by default
+        :param limit: optional number of fastest growing entities returned
+        :param batch_size: the number of results fetched at a time
+        :return: generator of {'_id': entity id, 'first', 'last', 'growth', 'rate'} sorted by rate (growth per day)
+        """
+        self.flush()
+        parameters = [_json_path(metric), entity_type, _encode_date(datetime.utcnow() - window)]
+        entities = ''
+        if entity_ids is not None:
+            entities = ' AND entity_id IN (SELECT value FROM json_each(?))'
+            parameters.append(json.dumps(list(entity_ids)))
+
+        sql = (
+            'WITH snapshots AS ('
+            '  SELECT entity_id, timestamp, json_extract(doc, ?) AS value FROM "' + STATISTICS_COLLECTION + '"'
+            '  WHERE entity_type = ? AND timestamp >= ?' + entities +
+            '), bounds AS ('
+            '  SELECT entity_id, MIN(timestamp) AS first_time, MAX(timestamp) AS last_time FROM snapshots'
+            '  GROUP BY entity_id HAVING MAX(timestamp) > MIN(timestamp)'
+            ') '
+            'SELECT b.entity_id, f.value, l.value, l.value - f.value AS growth,'
+            '  (l.value - f.value) / (julianday(b.last_time) - julianday(b.first_time)) AS rate '
+            'FROM bounds AS b '
+            'JOIN snapshots AS f ON f.entity_id = b.entity_id AND f.timestamp = b.first_time '
+            'JOIN snapshots AS l ON l.entity_id = b.entity_id AND l.timestamp = b.last_time '
+            'ORDER BY rate DESC'
+        )
+        if limit:
+            sql += ' LIMIT ?'
+            parameters.append(limit)
+        cursor = self.__connection().execute(sql, parameters)
+
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            for entity_id, first, last, growth, rate in rows:
+                yield {'_id': entity_id, 'first': first, 'last': last, 'growth': growth, 'rate': rate}
+            rows = cursor.fetchmany(batch_size)
+
+    """ Comments """
+
+    def insert_comment(self, data, source=None):
+        """
+
+        :param data:
+        :param source: the id of the channel of the video, the source of the edge of the comment (no edge if None)
+        :return: True if the comment was inserted or queued, False if it was already stored
+        """
+        return self.__insert_new(COMMENTS_COLLECTION, data, source and create_interaction(data, source))
+
+    def get_comments(self, query, projection=None, batch_size=None):
+        """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents fetched at a time
+        :return: generator of documents
+        """
+        return self.__find(COMMENTS_COLLECTION, query, projection, batch_size)
+
+    """ Replies """
+
+    def insert_comment_replies(self, comment_id, replies, source=None):
+        """
+        Stores the replies of a comment thread in the replies table, keyed by reply id with the id of the thread
+        as parentId, so a reply that is retrieved again is updated instead of duplicated
+        :param comment_id: the id of the comment thread
+        :param replies: list of reply documents
+        :param source: the id of the author of the comment thread, the source of the edges of the replies (no edges
+        if None)
+        """
+        documents = [dict(reply, parentId=comment_id) for reply in replies]
+        if documents:
+            self.__write(self.__upsert_replies, documents, source)
+
+    def __upsert_replies(self, connection, documents, source):
+        """
+        Inserts or updates replies by id and counts the interactions of the ones that were not stored
+        :param connection: the connection in a transaction
+        :param documents: list of reply documents with their parentId
+        :param source: the id of the author of the comment thread (no edges if None)
+        """
+        stored = set()
+        if source:
+            stored = {row[0] for row in connection.execute(
+                'SELECT id FROM "' + REPLIES_COLLECTION + '" WHERE id IN (SELECT value FROM json_each(?))',
+                (json.dumps([document['_id'] for document in documents]),)
+            )}
+        self.__upsert_rows(connection, REPLIES_COLLECTION, documents)
+        if source:
+            self.__count_interactions(connection, [create_interaction(document, source) for document in documents
+                                                   if document['_id'] not in stored])
+
+    def get_replies(self, query, projection=None, batch_size=None):
+        """
+
+        :param query:
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents fetched at a time
+        :return: generator of documents
+        """
+        return self.__find(REPLIES_COLLECTION, query, projection, batch_size)
+
+    def migrate_replies(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Moves the replies embedded in the comments by the previous versions to the replies table
+        :param batch_size: the number of comments migrated per transaction
+        :return: the number of migrated comments
+        """
+        self.flush()
+        migrated = 0
+        query = {'replies': {'$exists': True}}
+        while True:
+            comments = list(self.__find(COMMENTS_COLLECTION, query, {'videoId': 1, 'replies': 1}, limit=batch_size))
+            if not comments:
+                break
+
+            replies = [dict(reply, parentId=comment['_id'], videoId=reply.get('videoId', comment.get('videoId')))
+                       for comment in comments for reply in comment['replies']]
+            with self.__transaction() as connection:
+                if replies:
+                    self.__upsert_rows(connection, REPLIES_COLLECTION, replies)
+                self.__update_rows(connection, COMMENTS_COLLECTION,
+                                   {'_id': {'$in': [comment['_id'] for comment in comments]}},
+                                   {'$unset': {'replies': ""}}, multi=True)
+            migrated += len(comments)
+
+        self.logger.info("Migrated the replies of " + str(migrated) + " comments")
+        return migrated
+
+    """ Users Network """
+
+    def get_interaction_edges(self, video_channels, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes the weighted edges of the users network with a single query: an edge from the channel of a video
+        to each author that commented on it and an edge from the author of a comment to each author that replied
+        to it, grouped by their ends with the number of interactions as weight
+        :param video_channels: dictionary video id -> id of the channel of the video
+        :param batch_size: the number of edges fetched at a time
+        :return: generator of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+        self.flush()
+        sql = (
+            'WITH video_channels AS (SELECT key AS video_id, value AS channel_id FROM json_each(?)) '
+            'SELECT source, target, COUNT(*) AS weight, MAX(name) FROM ('
+            '  SELECT v.channel_id AS source, ' + _json_field('authorId', table='c') + ' AS target, ' +
+            _json_field('authorName', table='c') + ' AS name'
+            '  FROM "' + COMMENTS_COLLECTION + '" AS c JOIN video_channels AS v'
+            '  ON ' + _json_field('videoId', table='c') + ' = v.video_id'
+            '  UNION ALL'
+            '  SELECT ' + _json_field('authorId', table='p') + ', ' + _json_field('authorId', table='r') + ', ' +
+            _json_field('authorName', table='r') +
+            '  FROM "' + REPLIES_COLLECTION + '" AS r JOIN video_channels AS v'
+            '  ON ' + _json_field('videoId', table='r') + ' = v.video_id'
+            '  JOIN "' + COMMENTS_COLLECTION + '" AS p ON p.id = ' + _json_field('parentId', table='r') +
+            ') '
+            "WHERE source IS NOT NULL AND source != '' AND target IS NOT NULL AND target != '' "
+            'GROUP BY source, target'
+        )
+        cursor = self.__connection().execute(sql, (json.dumps(video_channels),))
+
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            for source, target, weight, name in rows:
+                yield {'_id': {'source': source, 'target': target}, 'weight': weight, 'name': name}
+            rows = cursor.fetchmany(batch_size)
+
+    def insert_interactions(self, interactions):
+        """
+        Counts new interactions in the edges table and stores the names of their authors
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+        for name, updates in interaction_updates(interactions).items():
+            if updates:
+                self.__write(self.__upsert_updates, name, updates)
+
+    def backfill_network_edges(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Counts the comments and replies stored by the previous versions in the edges table, with a single query
+        that groups them by video and by edge
+        :param batch_size: the number of edges written per transaction
+        :return: the number of backfilled edges
+        """
+        self.flush()
+        with self.__transaction() as connection:
+            empty = connection.execute('SELECT 1 FROM "' + EDGES_COLLECTION + '" LIMIT 1').fetchone() is None
+            claimed = empty and self.__insert_row(connection, MIGRATIONS_COLLECTION,
+                                                  {'_id': EDGES_BACKFILL_MIGRATION, 'started': datetime.utcnow()})
+        if not empty:
+            self.logger.warning("The edges table is not empty, the backfill would count its interactions twice")
+            return 0
+        if not claimed:
+            self.logger.info("The edges were already backfilled")
+            return 0
+
+        sql = (
+            'SELECT video_id, source, target, COUNT(*), MAX(name) FROM ('
+            '  SELECT ' + _json_field('videoId', table='c') + ' AS video_id, ' +
+            _json_field('channelId', table='v') + ' AS source, ' + _json_field('authorId', table='c') +
+            ' AS target, ' + _json_field('authorName', table='c') + ' AS name'
+            '  FROM "' + COMMENTS_COLLECTION + '" AS c LEFT JOIN "' + VIDEOS_COLLECTION + '" AS v'
+            '  ON v.id = ' + _json_field('videoId', table='c') +
+            '  UNION ALL'
+            '  SELECT ' + _json_field('videoId', table='r') + ', ' + _json_field('authorId', table='p') + ', ' +
+            _json_field('authorId', table='r') + ', ' + _json_field('authorName', table='r') +
+            '  FROM "' + REPLIES_COLLECTION + '" AS r'
+            '  JOIN "' + COMMENTS_COLLECTION + '" AS p ON p.id = ' + _json_field('parentId', table='r') +
+            ') '
+            "WHERE source IS NOT NULL AND source != '' AND target IS NOT NULL AND target != '' "
+            'GROUP BY video_id, source, target'
+        )
+        cursor = self.__connection().execute(sql)
+
+        backfilled = 0
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            with self.__transaction() as connection:
+                self.__count_interactions(connection, [
+                    {'videoId': video_id, 'source': source, 'target': target, 'weight': weight, 'name': name}
+                    for video_id, source, target, weight, name in rows
+                ])
+            backfilled += len(rows)
+            rows = cursor.fetchmany(batch_size)
+
+        with self.__transaction() as connection:
+            self.__upsert_rows(connection, MIGRATIONS_COLLECTION, [
+                {'_id': EDGES_BACKFILL_MIGRATION, 'completed': datetime.utcnow(), 'edges': backfilled}
+            ])
+        self.logger.info("Backfilled " + str(backfilled) + " edges of the users network")
+        return backfilled
+
+    def get_network_edges(self, video_ids, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Reads the weighted edges of the users network of some videos from the edges table, summing the counts of
+        the videos by edge, with the names of the targets from the authors table
+        :param video_ids: list of video ids
+        :param batch_size: the number of edges fetched at a time
+        :return: generator of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+        self.flush()
+        sql = (
+            'SELECT ' + _json_field('source', table='e') + ' AS source, ' + _json_field('target', table='e') +
+            ' AS target, SUM(' + _json_field('weight', table='e') + '), MAX(' + _json_field('name', table='a') + ')'
+            ' FROM "' + EDGES_COLLECTION + '" AS e LEFT JOIN "' + AUTHORS_COLLECTION + '" AS a'
+            ' ON a.id = ' + _json_field('target', table='e') +
+            ' WHERE ' + _json_field('videoId', table='e') + ' IN (SELECT value FROM json_each(?))'
+            ' GROUP BY source, target'
+        )
+        cursor = self.__connection().execute(sql, (json.dumps(list(video_ids)),))
+
+        rows = cursor.fetchmany(batch_size)
+        while rows:
+            for source, target, weight, name in rows:
+                yield {'_id': {'source': source, 'target': target}, 'weight': weight, 'name': name}
+            rows = cursor.fetchmany(batch_size)
+
+    """ Tokens """
+
+    def insert_token(self, data):
+        """
+        Adds a page token to the queue
+        :param data: the token document
+        """
+        data = dict(data)
+        data.setdefault('state', TOKEN_PENDING)
+        data.setdefault('attempts', 0)
+        try:
+            with self.__transaction() as connection:
+                if not self.__insert_row(connection, TOKENS_COLLECTION, data):
+                    self.logger.info("Duplicate key: " + str(data['_id']))
+        except sqlite3.Error as e:
+            self.logger.error("Write error: " + str(e))
+
+    def get_tokens(self, query=None, projection=None, batch_size=None):
+        """
+
+        :param query: filter of the tokens (all the tokens by default)
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents fetched at a time
+        :return: generator of documents
+        """
+        return self.__find(TOKENS_COLLECTION, query or {}, projection, batch_size)
+
+    def set_token_priorities(self, priorities):
+        """
+        Sets the priorities used to choose the next token to lease
+        :param priorities: dictionary token id -> priority
+        """
+        if not priorities:
+            return
+        with self.__transaction() as connection:
+            connection.executemany(
+                'UPDATE "' + TOKENS_COLLECTION + '" SET doc = json_set(doc, \'' + _json_path('priority') +
+                '\', ?) WHERE id = ?',
+                [(p, token_id) for token_id, p in priorities.items()]
+            )
+
+    def lease_token(self, owner, token_types, lease_seconds=TOKEN_LEASE_SECONDS, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Atomically takes the pending token with the highest priority, or one whose lease has expired, so several
+        crawler processes can share the queue. Tokens that were leased too many times are moved to the dead state
+        :param owner: the id of the worker
+        :param token_types: the types of tokens that can be leased
+        :param lease_seconds: the duration of the lease
+        :param max_attempts: the number of leases after which a token is dead
+        :return: the token or None if there are no tokens left
+        """
+        while True:
+            now = datetime.utcnow()
+            with self.__transaction() as connection:
+                tokens = self.__update_rows(
+                    connection,
+                    TOKENS_COLLECTION,
+                    token_lease_filter(token_types, now),
+                    token_lease_update(owner, now, lease_seconds),
+                    order=_json_field('priority') + ' DESC'
+                )
+
+                token = tokens[0] if tokens else None
+                if token is None or token['attempts'] <= max_attempts:
+                    return token
+
+                self.logger.warning("Token [" + str(token['_id']) + "] failed " + str(max_attempts) + " times")
+                self.__update_rows(connection, TOKENS_COLLECTION, {'_id': token['_id'], 'leaseOwner': owner},
+                                   {'$set': {'state': TOKEN_DEAD}, '$unset': {'leaseExpires': ""}})
+
+    def complete_token(self, token_id, owner):
+        """
+        Removes a processed token from the queue, if the worker still holds its lease
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        """
+        where, parameters = self.__where({'_id': token_id, 'leaseOwner': owner})
+        with self.__transaction() as connection:
+            connection.execute('DELETE FROM "' + TOKENS_COLLECTION + '" WHERE ' + where, parameters)
+
+    def release_token(self, token_id, owner, failed=True, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Gives back a token that was not processed
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        :param failed: False if the token was not processed for lack of quota - the attempt is not counted
+        :param max_attempts: the number of failed attempts after which the token is dead
+        """
+        query = {'_id': token_id, 'leaseOwner': owner, 'state': TOKEN_LEASED}
+        with self.__transaction() as connection:
+            if not failed:
+                self.__update_rows(connection, TOKENS_COLLECTION, query,
+                                   {'$set': {'state': TOKEN_PENDING}, '$inc': {'attempts': -1},
+                                    '$unset': {'leaseOwner': "", 'leaseExpires': ""}})
+                return
+
+            self.__update_rows(connection, TOKENS_COLLECTION, dict(query, attempts={'$gte': max_attempts}),
+                               {'$set': {'state': TOKEN_DEAD}, '$unset': {'leaseExpires': ""}})
+            self.__update_rows(connection, TOKENS_COLLECTION, query,
+                               {'$set': {'state': TOKEN_PENDING}, '$unset': {'leaseOwner': "", 'leaseExpires': ""}})
+
+    def remove_token(self, token_id):
+        """
+
+        :param token_id:
+        :return:
+        """
+        with self.__transaction() as connection:
+            connection.execute('DELETE FROM "' + TOKENS_COLLECTION + '" WHERE id = ?', (token_id,))
@@ -0,0 +1,552 @@
+import atexit
+import os
+import weakref
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+load_dotenv()
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', "mongodb")  # mongodb, motor or sqlite
+
+DATABASE_NAME = "influential_users"
+SEARCH_RESULTS_COLLECTION = "search_results"
+CHANNELS_COLLECTION = "channels"
+PLAYLISTS_COLLECTION = "playlists"
+VIDEOS_COLLECTION = "videos"
+COMMENTS_COLLECTION = "comments"
+REPLIES_COLLECTION = "replies"
+STATISTICS_COLLECTION = "statistics"
+TOKENS_COLLECTION = "tokens"
+EDGES_COLLECTION = "edges"  # the interactions of the users network, counted per video at ingest time
+AUTHORS_COLLECTION = "authors"  # the names of the authors of the comments and replies
+MIGRATIONS_COLLECTION = "migrations"  # a marker document per migration that was started
+EDGES_BACKFILL_MIGRATION = "edges_backfill"  # the marker of backfill_network_edges
+
+TOKEN_PENDING = "pending"  # the token waits to be processed
+TOKEN_LEASED = "leased"  # the token is processed by a worker until the lease expires
+TOKEN_DEAD = "dead"  # the token failed too many times and is not processed again
+TOKEN_LEASE_SECONDS = 10 * 60
+MAX_TOKEN_ATTEMPTS = 3
+
+SEEN_COLLECTIONS = [CHANNELS_COLLECTION, PLAYLISTS_COLLECTION, VIDEOS_COLLECTION]  # the comments are not loaded
+MIGRATION_BATCH_SIZE = 1000  # the number of comments migrated per bulk write
+AGGREGATION_BATCH_SIZE = 10000  # the number of edges returned per round trip by the edge list aggregation
+
+CHANNEL_ENTITY = "channel"
+VIDEO_ENTITY = "video"
+GROWTH_WINDOW = timedelta(days=7)  # the default window of the growth rates
+
+DEFAULT_BUFFER_SIZE = 1000  # the number of queued write operations that triggers a flush
+DEFAULT_FLUSH_INTERVAL = 1.0  # the maximum number of seconds between flushes while writes are queued
+
+
+class StorageBackend(ABC):
+    """
+    The methods used by the crawler and the analysis to store and read the youtube data. The queries and
+    projections are MongoDB filter documents - the other backends support the operators used by the application
+    """
+
+    """ Init """
+
+    @abstractmethod
+    def is_known(self, collection_name, document_id):
+        """
+        Checks if a document was stored, without a round trip to the database
+        :param collection_name: the name of the collection (CHANNELS_COLLECTION, VIDEOS_COLLECTION, ...)
+        :param document_id: the id of the document
+        :return: True if the document is known
+        """
+
+    @abstractmethod
+    def flush(self):
+        """
+        Writes the queued operations
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Writes the queued operations and releases the resources of the backend
+        """
+
+    @abstractmethod
+    def drop_database(self):
+        """
+        Removes all the collections of the database
+        """
+
+    """ Search Results """
+
+    @abstractmethod
+    def insert_search_results(self, query):
+        """
+        Stores search results
+        :param query: list of search result documents
+        """
+
+    @abstractmethod
+    def get_search_results(self, query, projection=None, batch_size=None):
+        """
+        Returns the search results matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: iterator of documents
+        """
+
+    """ Channels """
+
+    @abstractmethod
+    def insert_channel(self, data):
+        """
+        Stores a channel
+        :param data: the channel document
+        :return: True if the channel was inserted, False if it was already stored
+        """
+
+    @abstractmethod
+    def insert_channel_statistics(self, channel_id, statistics):
+        """
+        Stores a snapshot of the statistics of a channel and keeps the latest one on the channel document
+        :param channel_id: the id of the channel
+        :param statistics: dictionary with the counts of the channel
+        """
+
+    @abstractmethod
+    def get_channel(self, query, projection=None, batch_size=None):
+        """
+        Returns the channels matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: iterator of documents
+        """
+
+    """ Playlists """
+
+    @abstractmethod
+    def insert_playlist(self, data):
+        """
+        Stores a playlist
+        :param data: the playlist document
+        :return: True if the playlist was inserted, False if it was already stored
+        """
+
+    """ Videos """
+
+    @abstractmethod
+    def insert_video(self, data):
+        """
+        Stores a video
+        :param data: the video document
+        :return: True if the video was inserted, False if it was already stored
+        """
+
+    @abstractmethod
+    def get_video(self, query, projection=None, batch_size=None):
+        """
+        Returns the videos matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: iterator of documents
+        """
+
+    @abstractmethod
+    def set_comments_mark(self, video_id, mark):
+        """
+        Stores the newest comment thread retrieved for a video
+        :param video_id: the id of the video
+        :param mark: dictionary with the commentId and the publishedAt of the newest comment thread
+        """
+
+    @abstractmethod
+    def get_comments_mark(self, video_id):
+        """
+        Returns the newest comment thread retrieved for a video
+        :param video_id: the id of the video
+        :return: dictionary with the commentId and the publishedAt or None if the video was never refreshed
+        """
+
+    @abstractmethod
+    def insert_video_statistics(self, video_id, data):
+        """
+        Stores a snapshot of the statistics of a video and keeps the latest one on the video document
+        :param video_id: the id of the video
+        :param data: dictionary with the counts of the video
+        """
+
+    """ Statistics """
+
+    @abstractmethod
+    def insert_statistics_snapshot(self, entity_type, entity_id, statistics, timestamp=None):
+        """
+        Stores the statistics of a channel or a video at a moment
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param statistics: dictionary with the counts
+        :param timestamp: the moment of the snapshot (now by default)
+        """
+
+    @abstractmethod
+    def get_statistics(self, entity_type, entity_id, since=None, batch_size=None):
+        """
+        Returns the snapshots of a channel or a video, oldest first
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param entity_id: the id of the channel or the video
+        :param since: optional datetime of the oldest snapshot
+        :param batch_size: the number of snapshots returned per round trip
+        :return: iterator of snapshots
+        """
+
+    @abstractmethod
+    def get_growth_rates(self, entity_type, metric, window=GROWTH_WINDOW, entity_ids=None, limit=None,
+                         batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes how fast a count grows for each entity over a window
+        :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+        :param metric: the name of the count (subscriberCount, viewCount, ...)
+        :param window: timedelta of the window that ends now
+        :param entity_ids: optional list of entity ids - all the entities of the type by default
+        :param limit: optional number of fastest growing entities returned
+        :param batch_size: the number of results returned per round trip
+        :return: iterator of {'_id': entity id, 'first', 'last', 'growth', 'rate'} sorted by rate (growth per day)
+        """
+
+    """ Comments """
+
+    @abstractmethod
+    def insert_comment(self, data, source=None):
+        """
+        Stores a comment thread - the interaction of a comment that was not stored before is counted in the edges
+        collection, so a comment retrieved again is not counted twice
+        :param data: the comment document
+        :param source: the id of the channel of the video, the source of the edge of the comment (no edge if None)
+        :return: True if the comment was inserted or queued, False if it was already stored
+        """
+
+    @abstractmethod
+    def get_comments(self, query, projection=None, batch_size=None):
+        """
+        Returns the comments matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: iterator of documents
+        """
+
+    """ Replies """
+
+    def insert_comment_reply(self, comment_id, reply, source=None):
+        """
+        Stores a reply of a comment thread
+        :param comment_id: the id of the comment thread
+        :param reply: the reply document
+        :param source: the id of the author of the comment thread (no edge if None)
+        """
+        self.insert_comment_replies(comment_id, [reply], source)
+
+    @abstractmethod
+    def insert_comment_replies(self, comment_id, replies, source=None):
+        """
+        Stores the replies of a comment thread keyed by reply id, with the id of the thread as parentId - the
+        interactions of the replies that were not stored before are counted in the edges collection
+        :param comment_id: the id of the comment thread
+        :param replies: list of reply documents
+        :param source: the id of the author of the comment thread, the source of the edges of the replies (no edges
+        if None)
+        """
+
+    @abstractmethod
+    def get_replies(self, query, projection=None, batch_size=None):
+        """
+        Returns the replies matching a query
+        :param query: the filter of the documents
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: iterator of documents
+        """
+
+    @abstractmethod
+    def migrate_replies(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Moves the replies embedded in the comments by the previous versions to the replies collection
+        :param batch_size: the number of comments migrated per batch
+        :return: the number of migrated comments
+        """
+
+    """ Users Network """
+
+    @abstractmethod
+    def get_interaction_edges(self, video_channels, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Computes the weighted edges of the users network: an edge from the channel of a video to each author that
+        commented on it and an edge from the author of a comment to each author that replied to it
+        :param video_channels: dictionary video id -> id of the channel of the video
+        :param batch_size: the number of edges returned per round trip
+        :return: iterator of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+
+    @abstractmethod
+    def insert_interactions(self, interactions):
+        """
+        Counts new interactions in the edges collection and stores the names of their authors
+        :param interactions: list of interaction documents (see interaction_updates)
+        """
+
+    @abstractmethod
+    def backfill_network_edges(self, batch_size=MIGRATION_BATCH_SIZE):
+        """
+        Counts the comments and replies stored by the previous versions, which did not keep the edges collection.
+        Like migrate_replies it is run explicitly, once, on a database of a previous version before it is crawled
+        again - it does nothing if the edges collection is not empty, and the first call writes a marker document
+        atomically so a concurrent or later call does not count the interactions twice. If a backfill is
+        interrupted, the edges collection and the marker have to be removed before it is run again
+        :param batch_size: the number of edges written per batch
+        :return: the number of backfilled edges
+        """
+
+    @abstractmethod
+    def get_network_edges(self, video_ids, batch_size=AGGREGATION_BATCH_SIZE):
+        """
+        Returns the weighted edges of the users network of some videos from the edges collection
+        :param video_ids: list of video ids
+        :param batch_size: the number of edges returned per round trip
+        :return: iterator of {'_id': {'source', 'target'}, 'weight', 'name'} where name is the name of the target
+        """
+
+    """ Tokens """
+
+    @abstractmethod
+    def insert_token(self, data):
+        """
+        Adds a page token to the queue
+        :param data: the token document
+        """
+
+    @abstractmethod
+    def get_tokens(self, query=None, projection=None, batch_size=None):
+        """
+        Returns the tokens matching a query
+        :param query: filter of the tokens (all the tokens by default)
+        :param projection: the fields that are returned (all by default)
+        :param batch_size: the number of documents returned per round trip
+        :return: iterator of documents
+        """
+
+    @abstractmethod
+    def set_token_priorities(self, priorities):
+        """
+        Sets the priorities used to choose the next token to lease
+        :param priorities: dictionary token id -> priority
+        """
+
+    @abstractmethod
+    def lease_token(self, owner, token_types, lease_seconds=TOKEN_LEASE_SECONDS, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Atomically takes the pending token with the highest priority, or one whose lease has expired
+        :param owner: the id of the worker
+        :param token_types: the types of tokens that can be leased
+        :param lease_seconds: the duration of the lease
+        :param max_attempts: the number of leases after which a token is dead
+        :return: the token or None if there are no tokens left
+        """
+
+    @abstractmethod
+    def complete_token(self, token_id, owner):
+        """
+        Removes a processed token from the queue, if the worker still holds its lease
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        """
+
+    @abstractmethod
+    def release_token(self, token_id, owner, failed=True, max_attempts=MAX_TOKEN_ATTEMPTS):
+        """
+        Gives back a token that was not processed
+        :param token_id: the id of the token
+        :param owner: the id of the worker
+        :param failed: False if the token was not processed for lack of quota - the attempt is not counted
+        :param max_attempts: the number of failed attempts after which the token is dead
+        """
+
+    @abstractmethod
+    def remove_token(self, token_id):
+        """
+        Removes a token from the queue
+        :param token_id: the id of the token
+        """
+
+
+def create_statistics_snapshot(entity_type, entity_id, statistics, timestamp=None):
+    """
+    Creates the document of a statistics snapshot - the counts are stored as numbers
+    :param entity_type: CHANNEL_ENTITY or VIDEO_ENTITY
+    :param entity_id: the id of the channel or the video
+    :param statistics: dictionary with the counts - the api returns them as strings
+    :param timestamp: the moment of the snapshot (now by default)
+    :return: the snapshot document
+    """
+    snapshot = {
+        'timestamp': timestamp or datetime.utcnow(),
+        'entity': {'type': entity_type, 'id': entity_id}
+    }
+    for name, value in statistics.items():
+        try:
+            snapshot[name] = int(value)
+        except (TypeError, ValueError):
+            snapshot[name] = value
+    return snapshot
+
+
+def token_lease_filter(token_types, now):
+    """
+    Creates the filter of the tokens that can be leased: the pending ones and the ones whose lease has expired
+    :param token_types: the types of tokens that can be leased
+    :param now: the current datetime
+    :return: the filter
+    """
+    return {
+        'type': {'$in': list(token_types)},
+        '$or': [
+            {'state': TOKEN_PENDING},
+            {'state': {'$exists': False}},
+            {'state': TOKEN_LEASED, 'leaseExpires': {'$lt': now}}
+        ]
+    }
+
+
+def token_lease_update(owner, now, lease_seconds):
+    """
+    Creates the update that leases a token to a worker
+    :param owner: the id of the worker
+    :param now: the current datetime
+    :param lease_seconds: the duration of the lease
+    :return: the update operators
+    """
+    return {
+        '$set': {
+            'state': TOKEN_LEASED,
+            'leaseOwner': owner,
+            'leaseExpires': now + timedelta(seconds=lease_seconds)
+        },
+        '$inc': {'attempts': 1}
+    }
+
+
+def interaction_edge_id(video_id, source, target):
+    """
+    Creates the id of the edge of a video in the edges collection - the youtube ids do not contain spaces
+    :param video_id: the id of the video
+    :param source: the id of the channel or the author that received the interaction
+    :param target: the id of the author of the interaction
+    :return: the id of the edge
+    """
+    return video_id + " " + source + " " + target
+
+
+def create_interaction(document, source):
+    """
+    Creates the interaction of a comment or a reply for the edges collection
+    :param document: the comment or the reply document
+    :param source: the id of the channel of the video for a comment, of the author of the comment for a reply
+    :return: the interaction document
+    """
+    return {
+        'videoId': document['videoId'],
+        'source': source,
+        'target': document['authorId'],
+        'name': document['authorName']
+    }
+
+
+def interaction_updates(interactions, now=None):
+    """
+    Creates the upserts that count a batch of interactions in the edges collection and store the names of their
+    authors. The interactions of the same edge are counted with a single $inc and the interactions without a
+    source or a target are skipped
+    :param interactions: list of {'videoId', 'source', 'target', 'name'} where source is the channel of the video
+    for a comment or the author of the comment for a reply, and target is the author of the comment or the reply -
+    an optional 'weight' counts several interactions at once
+    :param now: the datetime of the ingest (now by default)
+    :return: dictionary collection name -> list of (document id, update operators)
+    """
+    now = now or datetime.utcnow()
+    weights = {}
+    names = {}
+    for interaction in interactions:
+        if not interaction.get('source') or not interaction.get('target'):
+            continue
+        key = (interaction['videoId'], interaction['source'], interaction['target'])
+        weights[key] = weights.get(key, 0) + interaction.get('weight', 1)
+        if interaction.get('name'):
+            names[interaction['target']] = interaction['name']
+
+    return {
+        EDGES_COLLECTION: [
+            (interaction_edge_id(*key), {
+                '$set': {'videoId': key[0], 'source': key[1], 'target': key[2], 'lastSeen': now},
+                '$setOnInsert': {'firstSeen': now},
+                '$inc': {'weight': weight}
+            })
+            for key, weight in weights.items()
+        ],
+        AUTHORS_COLLECTION: [
+            (author_id, {'$set': {'name': name, 'lastSeen': now}}) for author_id, name in names.items()
+        ],
+    }
+
+
+_exit_flushes = weakref.WeakSet()  # the storages flushed at exit - the set does not keep them alive
+
+
+def register_exit_flush(storage):
+    """
+    Writes the queued operations of a storage at exit if it was not closed, without keeping it alive
+    :param storage: the StorageBackend
+    """
+    _exit_flushes.add(storage)
+
+
+def unregister_exit_flush(storage):
+    """
+    Removes a closed storage from the ones flushed at exit
+    :param storage: the StorageBackend
+    """
+    _exit_flushes.discard(storage)
+
+
+def _flush_at_exit():
+    """
+    Writes the queued operations of the storages that are still open
+    """
+    for storage in list(_exit_flushes):
+        storage.flush()
+
+
+atexit.register(_flush_at_exit)
+
+
+def get_storage(database_name=DATABASE_NAME, backend=None, **kwargs):
+    """
+    Creates the storage backend - the backends are imported on use, so the sqlite runs do not need pymongo
+    :param database_name: the name of the database
+    :param backend: "mongodb", "motor" or "sqlite" (STORAGE_BACKEND by default)
+    :param kwargs: the options of the backend (buffered, seen_filters, ...)
+    :return: the StorageBackend
+    :raise ValueError: for an unknown backend
+    """
+    backend = backend or STORAGE_BACKEND
+
+    if backend == "mongodb":
+        from influential_users.application.mongodb import MongoDB
+        return MongoDB(database_name, **kwargs)
+    if backend == "motor":
+        from influential_users.application.async_mongodb import BackgroundMongoDB
+        return BackgroundMongoDB(database_name, **kwargs)
+    if backend == "sqlite":
+        from influential_users.application.sqlite_db import SQLiteDB
+        return SQLiteDB(database_name, **kwargs)
+
+    raise ValueError("Unknown storage backend: " + str(backend))
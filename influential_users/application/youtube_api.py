@@ -1,29 +1,50 @@
+import heapq
 import math
 import os
 import pickle
 import random
+import socket
 import string
+import threading
+import uuid
+from collections import Counter
 from datetime import datetime
 
-import httplib2
 from dotenv import load_dotenv
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from influential_users.application.comment_budget import CommentBudget
+from influential_users.application.crawl_executor import CrawlExecutor
+from influential_users.application.graph_format import CsrGraph
+from influential_users.application.id_batcher import IdBatcher
+from influential_users.application.key_pool import DEFAULT_WORKERS_PER_KEY, KeyPool, is_quota_error
 from influential_users.application.message_logger import MessageLogger
-from influential_users.application.mongodb import MongoDB
+from influential_users.application.page_stream import BoundedStream
+from influential_users.application.quota_scheduler import DEFAULT_DAILY_QUOTA, QuotaExhaustedError, QuotaScheduler
+from influential_users.application.response_cache import CachingHttp, HttpPool, ResponseCache
+from influential_users.application.seen_filter import SeenFilter
+from influential_users.application.storage import CHANNEL_ENTITY, PLAYLISTS_COLLECTION, VIDEOS_COLLECTION, get_storage
 
 load_dotenv()
 DEVELOPER_KEY = os.getenv('GOOGLE_DEV_KEY')
+DEVELOPER_KEYS = os.getenv('GOOGLE_DEV_KEYS')  # comma separated keys of several projects
 YOUTUBE_API_SERVICE_NAME = 'youtube'
 YOUTUBE_API_VERSION = 'v3'
 
 STRING_LENGTH = 10
 NETWORKS_FOLDER = '.networks'
-TEXT_EXTENSION = '.txt'
 OBJECT_EXTENSION = '.pickle'
 
 COMMENT_PAGES_LIMIT = 3
+FIRST_PAGE_TOKEN_PREFIX = 'first-page:'  # the id of a saved token for a first page, followed by the video id
+REPLY_BATCH_SIZE = 20  # the number of comment threads expanded by a crawl task
+DEFAULT_MAX_WORKERS = 1  # sequential crawl
+DB_BATCH_SIZE = 1000  # the number of documents read per round trip by the large queries
+
+SNOWBALL_HOPS = 2  # the number of hops of the snowball crawl from the seed videos
+SNOWBALL_CHANNELS_PER_HOP = 500  # the maximum number of channels crawled in a hop
+SNOWBALL_VIDEOS_PER_CHANNEL = 5  # the number of uploads crawled for each channel
+SNOWBALL_COMMENT_PAGES = 1  # the number of comment pages crawled for each upload
 
 
 class YoutubeAPI:
@@ -33,17 +54,69 @@ class YoutubeAPI:
 
     """ Init """
 
-    def __init__(self):
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, daily_quota=DEFAULT_DAILY_QUOTA, service=None, db=None,
+                 keys=None, workers_per_key=DEFAULT_WORKERS_PER_KEY, skip_known=False, expand_replies=False):
         """
 
+        :param max_workers: the number of channels, playlists and videos that are crawled in parallel
+        :param daily_quota: the number of youtube api quota units that can be used per day by each key
+        :param service: youtube service used instead of the one built with the developer key (e.g. ReplayService)
+        :param db: storage backend used instead of the one selected by STORAGE_BACKEND
+        :param keys: list of developer keys (GOOGLE_DEV_KEYS or GOOGLE_DEV_KEY by default)
+        :param workers_per_key: the maximum number of requests in progress for each key
+        :param skip_known: if True, the videos of the playlists and the comments of the videos that are already
+        stored are not requested again
+        :param expand_replies: if True, the comment threads with more replies than the inline ones are kept for
+        expand_replies() - also enabled by process_search_results(expand_replies=True)
         """
 
         # logging module
         ml = MessageLogger('youtube_api')
         self.__logger = ml.get_logger()
-        self.__db = MongoDB()  # mongodb driver
+        self.__database = db  # storage backend, connected on first use
         self.__max_results = 0  # the maximum number of results
-        self.__get_authentication_service()  # get the authentication service for youtube api
+        self.__max_workers = max_workers  # the number of parallel crawl workers
+        self.__skip_known = skip_known  # do not crawl again the stored playlists and videos
+        if keys is None:
+            keys = DEVELOPER_KEYS.split(',') if DEVELOPER_KEYS else [DEVELOPER_KEY]
+        self.__keys = KeyPool(keys, daily_quota, workers_per_key)  # developer keys with their own quota
+        self.__quota = QuotaScheduler(daily_quota * len(keys))  # quota usage of the youtube api
+        self.__http_pool = HttpPool(lambda: CachingHttp(self.__response_cache))  # connections shared by threads
+        self.__cache = None  # http responses shared by the connections of all threads, loaded on first use
+        self.__lazy_lock = threading.RLock()
+        self.__video_statistics = IdBatcher(self.__fetch_video_statistics)  # coalesced videos.list lookups
+        self.__channel_statistics = IdBatcher(self.__fetch_channel_statistics)  # coalesced channels.list lookups
+        self.__channel_details = IdBatcher(self.__fetch_channel_details)  # coalesced channels.list lookups
+        self.__channel_uploads = IdBatcher(self.__fetch_channel_uploads)  # coalesced channels.list lookups
+        self.__expand_replies = expand_replies  # keep the threads to expand, otherwise the backlog stays empty
+        self.__reply_backlog = []  # comment threads with more replies than the ones returned inline
+        self.__reply_backlog_lock = threading.Lock()
+        self.__services = {}  # key -> youtube service, built on first use
+        if service is not None:
+            self.__services = {key: service for key in self.__keys.get_keys()}
+
+    @property
+    def __db(self):
+        """
+        The database driver - the connection is made by the first method that needs it, so the runs that do not
+        use the database start faster
+        """
+        if self.__database is None:
+            with self.__lazy_lock:
+                if self.__database is None:
+                    self.__database = get_storage(buffered=True)
+        return self.__database
+
+    @property
+    def __response_cache(self):
+        """
+        The cache of http responses - its index is loaded by the first request
+        """
+        if self.__cache is None:
+            with self.__lazy_lock:
+                if self.__cache is None:
+                    self.__cache = ResponseCache()
+        return self.__cache
 
     """ Search data """
 
@@ -127,6 +200,7 @@ class YoutubeAPI:
             search_results.append({
                 '_id': etag,
                 'keyword': keyword,
+                'pageToken': page_token,
                 'totalResults': total_results,
                 'selectedNrResults': nr_results,
                 'order': order,
@@ -143,109 +217,201 @@ class YoutubeAPI:
 
     """ Process data """
 
-    def process_search_results(self, search_results):
+    def process_search_results(self, search_results, max_workers=None, flush_lookups=True, comment_budget=None,
+                               expand_replies=False):
         """
-
+        Crawls the channels, playlists and videos from the search results. Independent resources are crawled
+        in parallel by at most max_workers threads
         :param search_results:
+        :param max_workers: the number of parallel crawl workers (the value set in the constructor by default)
+        :param flush_lookups: if False, the statistics lookups stay queued until flush_lookups() is called, so
+        the ids of several searches are requested together
+        :param comment_budget: total number of comment pages spread across the videos by crawl_comments()
+        instead of COMMENT_PAGES_LIMIT pages for every video
+        :param expand_replies: if True, all the replies of the crawled comment threads are requested, and the
+        threads crawled afterwards are kept for expand_replies()
         :return:
         """
 
         videos_list = []
         channels_list = []
+        if expand_replies:
+            self.__expand_replies = True
 
         if not search_results:
             print("Search results are empty")
             return
 
+        # checked before any task runs, the playlists of the channels can contain the videos of the results
+        known_videos = set()
+        if self.__skip_known:
+            known_videos = {item['id']['videoId'] for item in search_results[0]['results']
+                            if item['id']['kind'] == 'youtube#video'
+                            and self.__db.is_known(VIDEOS_COLLECTION, item['id']['videoId'])}
+
+        executor = CrawlExecutor(max_workers or self.__max_workers)
+
         for item in search_results[0]['results']:
-            title = item['snippet']['title']
-            description = item['snippet']['description']
-            published_at = item['snippet']['publishedAt']
             kind = item['id']['kind']
 
             if kind == 'youtube#channel':
-                print(" > Channel: " + title)
+                channels_list.append(item['id']['channelId'])
+                executor.submit(self.__process_channel_item, executor, item)
 
-                channel_id = item['id']['channelId']
-                channels_list.append(channel_id)
+            if kind == 'youtube#playlist':
+                executor.submit(self.__process_playlist_item, executor, item)
 
-                playlists = self.__get_channel_playlists(
-                    part='snippet',
-                    channelId=channel_id,
-                    maxResults=50
-                )
-                if playlists is False:
-                    return
-                for pl in playlists:
-                    self.__db.insert_playlist(pl)
-                    self.__get_playlist_videos(
-                        part='snippet',
-                        playlistId=pl['_id'],
-                        maxResults=50
-                    )
+            elif kind == 'youtube#video':
+                videos_list.append(item['id']['videoId'])
+                if item['id']['videoId'] in known_videos:
+                    continue
+                executor.submit(self.__process_video_item, item, comment_budget is None)
 
-                self.__db.insert_channel({
-                    "_id": channel_id,
-                    "title": title,
-                    "description": description,
-                    "publishedAt": published_at,
-                    "retrieval date": datetime.utcnow(),
-                })
+        try:
+            executor.wait()
+        except QuotaExhaustedError as e:
+            print("! Quota exhausted: " + str(e))
+            return
 
-            if kind == 'youtube#playlist':
-                print(" > Playlist: " + title)
+        if executor.is_stopped():
+            return
 
-                playlist_id = item['id']['playlistId']
+        # the batchers request a chunk as soon as it is full, so adding ids can also exhaust the quota
+        try:
+            if videos_list:
+                lookup = self.__video_statistics.add(videos_list)
+                if comment_budget is not None:
+                    self.__video_statistics.flush()
+                    new_videos = [video_id for video_id in videos_list if video_id not in known_videos]
+                    self.crawl_comments(new_videos, comment_budget, lookup.result() or {})
+
+            if expand_replies:
+                self.expand_replies(max_workers)
+
+            if channels_list:
+                self.__channel_statistics.add(channels_list)
+
+            if flush_lookups:
+                self.flush_lookups()
+        except QuotaExhaustedError as e:
+            print("! Quota exhausted: " + str(e))
+            return
 
-                self.__db.insert_playlist({
-                    "_id": playlist_id,
-                    "title": title,
-                    "description": description,
-                    "publishedAt": published_at,
-                    "retrieval date": datetime.utcnow(),
-                })
+    def flush_lookups(self):
+        """
+        Requests the statistics and channel details that are still queued, in chunks of at most 50 ids
+        :raise QuotaExhaustedError: if the quota does not allow a request - the ids that were not requested can be
+        added again
+        """
+        self.__video_statistics.flush()
+        self.__channel_statistics.flush()
+        self.__channel_details.flush()
 
-                self.__get_playlist_videos(
-                    part='snippet',
-                    playlistId=playlist_id,
-                    maxResults=50
-                )
+    def __process_channel_item(self, executor, item):
+        """
+        Crawls the playlists of a channel from the search results and schedules the crawl of their videos
+        :param executor: the crawl executor
+        :param item: the search result item
+        """
+        title = item['snippet']['title']
+        channel_id = item['id']['channelId']
+
+        print(" > Channel: " + title)
+
+        def process_playlist(pl):
+            if not self.__db.insert_playlist(pl) and self.__skip_known:
+                return
+            executor.submit(
+                self.__get_playlist_videos,
+                part='snippet',
+                playlistId=pl['_id'],
+                maxResults=50
+            )
+
+        result_success = self.__get_channel_playlists(
+            process_playlist,
+            part='snippet',
+            channelId=channel_id,
+            maxResults=50
+        )
+        if result_success is False:
+            executor.stop()
+            return
 
-            elif kind == 'youtube#video':
-                print(" > Video: " + title)
+        self.__db.insert_channel({
+            "_id": channel_id,
+            "title": title,
+            "description": item['snippet']['description'],
+            "publishedAt": item['snippet']['publishedAt'],
+            "retrieval date": datetime.utcnow(),
+        })
 
-                video_id = item['id']['videoId']
-                channel_id = item['snippet']['channelId']
-                videos_list.append(video_id)
+    def __process_playlist_item(self, executor, item):
+        """
+        Stores a playlist from the search results and schedules the crawl of its videos
+        :param executor: the crawl executor
+        :param item: the search result item
+        """
+        title = item['snippet']['title']
+        playlist_id = item['id']['playlistId']
 
-                self.__db.insert_video({
-                    "_id": video_id,
-                    "channelId": channel_id,
-                    "title": title,
-                    "description": description,
-                    "publishedAt": published_at,
-                    "retrieval date": datetime.utcnow()
-                })
+        print(" > Playlist: " + title)
 
-                self.__get_video_comments(
-                    part='snippet,replies',
-                    videoId=video_id,
-                    textFormat='plainText',
-                    maxResults=100,
-                    order='relevance'
-                )
+        if self.__skip_known and self.__db.is_known(PLAYLISTS_COLLECTION, playlist_id):
+            return
 
-        if videos_list:
-            videos_id_str = ','.join(videos_list)
-            self.__get_video_statistics(part='statistics', id=videos_id_str, maxResults=self.__max_results)
+        self.__db.insert_playlist({
+            "_id": playlist_id,
+            "title": title,
+            "description": item['snippet']['description'],
+            "publishedAt": item['snippet']['publishedAt'],
+            "retrieval date": datetime.utcnow(),
+        })
+
+        executor.submit(
+            self.__get_playlist_videos,
+            part='snippet',
+            playlistId=playlist_id,
+            maxResults=50
+        )
+
+    def __process_video_item(self, item, crawl_comments=True):
+        """
+        Stores a video from the search results and crawls its comments
+        :param item: the search result item
+        :param crawl_comments: if False, the comments are left for crawl_comments()
+        """
+        title = item['snippet']['title']
+        video_id = item['id']['videoId']
 
-        if channels_list:
-            channels_id_str = ','.join(channels_list)
-            self.__get_channel_statistics(part='statistics', id=channels_id_str, maxResults=50)
+        print(" > Video: " + title)
+
+        self.__db.insert_video({
+            "_id": video_id,
+            "channelId": item['snippet']['channelId'],
+            "title": title,
+            "description": item['snippet']['description'],
+            "publishedAt": item['snippet']['publishedAt'],
+            "retrieval date": datetime.utcnow()
+        })
+
+        if not crawl_comments:
+            return
+
+        self.__get_video_comments(
+            part='snippet,replies',
+            videoId=video_id,
+            textFormat='plainText',
+            maxResults=100,
+            order='relevance'
+        )
 
     def process_tokens(self, nr_results, content_type=None, location_radius=None, order="relevance"):
         """
-
+        Processes the remaining page tokens, the ones with the most expected items per quota unit first
+        (e.g. the comments of the most commented videos), and stops when the quota is exhausted.
+        The tokens are leased one at a time from the database, so several crawler processes can share the queue:
+        a token is removed when it is processed, given back when it fails and abandoned after too many failures
         :param nr_results:
         :param content_type:
         :param location_radius:
@@ -254,20 +420,32 @@ class YoutubeAPI:
         """
 
         self.__max_results = 50
+        worker_id = socket.gethostname() + "-" + str(os.getpid()) + "-" + uuid.uuid4().hex[:8]
 
-        tokens = self.__db.get_tokens()
+        self.__prioritize_tokens()
 
-        if tokens and tokens.count() > 0:
-            print("Processing remaining page tokens:")
-            for t in tokens:
-                token_type = t['type']
-                args = t['query']
-                token_id = t['_id']
+        print("Processing remaining page tokens:")
+        while True:
+            token_types = self.__quota.get_affordable_token_types()
+            if not token_types:
+                print("! Quota exhausted")
+                break
+
+            t = self.__db.lease_token(worker_id, token_types)
+            if t is None:
+                print("! No remaining tokens")
+                break
+
+            token_type = t['type']
+            args = t['query']
+            token_id = t['_id']
+            if 'pageToken' in args:  # the saved first pages are requested without a page token
                 args['pageToken'] = token_id
-                result_success = False
+            result_success = False
 
-                print(" > " + token_type + " token [" + token_id + "]")
+            print(" > " + token_type + " token [" + token_id + "]")
 
+            try:
                 if token_type == "search":
                     keyword = t['keyword']
                     if 'order' in t['query']:
@@ -285,11 +463,7 @@ class YoutubeAPI:
                     result_success = self.__get_channel_statistics(**args)
 
                 elif token_type == 'channel_playlists':
-                    playlists = self.__get_channel_playlists(**args)
-                    if playlists is False:
-                        return
-                    for pl in playlists:
-                        self.__db.insert_playlist(pl)
+                    result_success = self.__get_channel_playlists(self.__db.insert_playlist, **args)
 
                 elif token_type == 'playlist_videos':
                     result_success = self.__get_playlist_videos(**args)
@@ -302,134 +476,531 @@ class YoutubeAPI:
 
                 else:
                     pass
+            except QuotaExhaustedError as e:
+                print("! Quota exhausted: " + str(e))
+                self.__db.release_token(token_id, worker_id, failed=False)
+                if self.__quota.is_exhausted():
+                    break
+                continue
+
+            if result_success is not False:
+                print(" > Removing token [" + token_id + "]")
+                self.__db.complete_token(token_id, worker_id)
+            else:
+                print(" > Releasing token [" + token_id + "]")
+                self.__db.release_token(token_id, worker_id)
 
-                if result_success is not False:
-                    print(" > Removing token [" + token_id + "]")
-                    self.__db.remove_token(token_id)
-        else:
-            print("! No remaining tokens")
+        print("Quota used: " + str(self.__quota.get_used()) + ", keys: " + str(self.__keys.get_usage()))
+
+    def __prioritize_tokens(self):
+        """
+        Sets the priority of the tokens that were added since the last run, from their expected items per quota unit
+        :return:
+        """
+        tokens = list(self.__db.get_tokens({'priority': {'$exists': False}}, {'type': 1, 'query.videoId': 1}))
+        counts = self.__get_comment_counts(tokens)
+
+        self.__db.set_token_priorities({
+            t['_id']: QuotaScheduler.priority(t['type'], counts.get(t['query'].get('videoId'), 0)) for t in tokens
+        })
+
+    def __get_comment_counts(self, tokens):
+        """
+        Gets the number of comments of the videos that have comment page tokens
+        :param tokens: list of tokens
+        :return: dictionary video id -> number of comments
+        """
+        counts = {}
+        video_ids = [t['query']['videoId'] for t in tokens if t['type'] == 'video_comments']
+        if not video_ids:
+            return counts
+
+        for video in self.__db.get_video({'_id': {'$in': video_ids}}, {'statistics.commentCount': 1}):
+            statistics = video.get('statistics')
+            if isinstance(statistics, dict):
+                counts[video['_id']] = int(statistics.get('commentCount', 0))
+
+        return counts
+
+    def crawl_comments(self, video_ids, page_budget, statistics=None):
+        """
+        Crawls the comments of the videos within a total number of pages. Each page goes to the video expected to
+        bring the most new authors, based on the comment count of the video and on the new authors found in its
+        previous pages. The page tokens of the videos that were not finished are saved for process_tokens, with
+        a first page token for the videos that the budget did not reach
+        :param video_ids: list of video ids
+        :param page_budget: the total number of comment pages
+        :param statistics: dictionary video id -> statistics (requested with videos.list if missing)
+        :return: the number of distinct authors found
+        """
+
+        if statistics is None:
+            try:
+                lookup = self.__video_statistics.add(video_ids)
+                self.__video_statistics.flush()
+                statistics = lookup.result() or {}
+            except QuotaExhaustedError as e:
+                print("! Quota exhausted: " + str(e))
+                return 0
+
+        budget = CommentBudget(page_budget)
+        for video_id in video_ids:
+            if video_id in statistics:
+                budget.add_video(video_id, statistics[video_id]['commentCount'])
+
+        page_tokens = {}
+        seen_authors = set()
+
+        while True:
+            video_id = budget.next_video()
+            if video_id is None:
+                break
+
+            kwargs = {
+                'part': 'snippet,replies',
+                'videoId': video_id,
+                'textFormat': 'plainText',
+                'maxResults': 100,
+                'order': 'relevance'
+            }
+            if video_id in page_tokens:
+                kwargs['pageToken'] = page_tokens.pop(video_id)
+
+            try:
+                results = self.__list('commentThreads', **kwargs)
+            except HttpError as e:
+                print("HTTP error: " + str(e))
+                budget.record_page(video_id, 0, False)
+                continue
+            except QuotaExhaustedError as e:
+                print("! Quota exhausted: " + str(e))
+                page_tokens[video_id] = kwargs.get('pageToken')
+                break
+
+            authors = set()
+            for item in results['items']:
+                authors.update(self.__store_comment_thread(item))
+            new_authors = len(authors - seen_authors)
+            seen_authors.update(authors)
+
+            if 'nextPageToken' in results:
+                page_tokens[video_id] = results['nextPageToken']
+            budget.record_page(video_id, new_authors, 'nextPageToken' in results)
+
+        for video_id in budget.get_pending_videos():
+            page_tokens.setdefault(video_id, None)  # no page was requested
+
+        for video_id, token in page_tokens.items():
+            query = {
+                'part': 'snippet,replies',
+                'videoId': video_id,
+                'textFormat': 'plainText',
+                'maxResults': 100,
+                'order': 'relevance'
+            }
+            if token:
+                query['pageToken'] = token
+            self.__db.insert_token({
+                '_id': token or FIRST_PAGE_TOKEN_PREFIX + video_id,
+                'type': 'video_comments',
+                "retrieval date": datetime.utcnow(),
+                'query': query
+            })
+
+        print("Comment pages left in the budget: " + str(budget.get_remaining()) + ", authors: " +
+              str(len(seen_authors)))
+
+        return len(seen_authors)
+
+    def expand_replies(self, max_workers=None):
+        """
+        Requests with comments.list the replies of the crawled comment threads that have more replies than the
+        ones returned inline by commentThreads.list. The threads are split in batches crawled in parallel. The
+        threads are only kept once the expansion is enabled, in the constructor or by process_search_results
+        :param max_workers: the number of parallel crawl workers (the value set in the constructor by default)
+        :return: the number of expanded threads
+        """
+
+        with self.__reply_backlog_lock:
+            threads = self.__reply_backlog
+            self.__reply_backlog = []
+
+        if not threads:
+            return 0
+
+        print("Expanding the replies of " + str(len(threads)) + " comment threads")
+
+        executor = CrawlExecutor(max_workers or self.__max_workers)
+        for i in range(0, len(threads), REPLY_BATCH_SIZE):
+            executor.submit(self.__expand_thread_batch, threads[i:i + REPLY_BATCH_SIZE])
+
+        try:
+            executor.wait()
+        except QuotaExhaustedError as e:
+            print("! Quota exhausted: " + str(e))
+
+        return len(threads)
+
+    def __expand_thread_batch(self, threads):
+        """
+        Requests all the replies of a batch of comment threads
+        :param threads: list of (thread id, video id, id of the author of the thread)
+        """
+
+        for thread_id, video_id, author_id in threads:
+            try:
+                pages = self.__pages('comments', 'comment_replies', part='snippet', parentId=thread_id,
+                                     textFormat='plainText', maxResults=100)
+                for results in BoundedStream(pages):
+                    self.__db.insert_comment_replies(
+                        thread_id, [self.__reply_document(r_item, video_id) for r_item in results['items']], author_id
+                    )
+            except HttpError as e:
+                print("HTTP error: " + str(e))
+
+    def refresh_comments(self, video_ids=None, max_workers=None):
+        """
+        Delta crawl of the comments - requests the comment threads of the videos newest first and stops at the
+        newest thread retrieved by the previous refresh, so only the new comments are requested. The first refresh
+        of a video requests COMMENT_PAGES_LIMIT pages and sets the mark
+        :param video_ids: list of video ids (all the videos in the database by default)
+        :param max_workers: the number of parallel crawl workers (the value set in the constructor by default)
+        """
+
+        if video_ids is None:
+            video_ids = [video['_id'] for video in self.__db.get_video({}, {'_id': 1}, batch_size=DB_BATCH_SIZE)]
+
+        print("Refreshing the comments of " + str(len(video_ids)) + " videos")
+
+        executor = CrawlExecutor(max_workers or self.__max_workers)
+        for video_id in video_ids:
+            executor.submit(self.__get_new_video_comments, video_id)
+
+        try:
+            executor.wait()
+        except QuotaExhaustedError as e:
+            print("! Quota exhausted: " + str(e))
+
+    def snowball(self, video_ids, hops=SNOWBALL_HOPS, channels_per_hop=SNOWBALL_CHANNELS_PER_HOP,
+                 videos_per_channel=SNOWBALL_VIDEOS_PER_CHANNEL, comment_pages=SNOWBALL_COMMENT_PAGES,
+                 quota_budget=None, max_workers=None):
+        """
+        Snowball crawl from the commenters of the seed videos. At each hop the latest uploads of the commenters found
+        in the previous hop are crawled with their comments, and their commenters form the next hop. The frontier is
+        limited to the channels_per_hop most frequent commenters that were not visited, and the visited channels
+        are kept in a seen filter, so the memory stays bounded while the graph grows by up to
+        channels_per_hop * videos_per_channel videos per hop
+        :param video_ids: list of seed video ids, with stored comments
+        :param hops: the number of hops
+        :param channels_per_hop: the maximum number of channels crawled in a hop
+        :param videos_per_channel: the number of uploads crawled for each channel (at most 50)
+        :param comment_pages: the number of comment pages crawled for each upload
+        :param quota_budget: the maximum number of quota units used by the crawl (no limit by default)
+        :param max_workers: the number of parallel crawl workers (the value set in the constructor by default)
+        :return: the number of crawled channels
+        """
+
+        visited = SeenFilter()
+        start_units = self.__get_used_units()
+        commenters = self.__get_commenters(video_ids)
+        crawled = 0
+
+        def over_budget():
+            return quota_budget is not None and self.__get_used_units() - start_units >= quota_budget
+
+        for hop in range(1, hops + 1):
+            frontier = heapq.nlargest(channels_per_hop, (c for c in commenters if c not in visited),
+                                      key=commenters.get)
+            if not frontier or over_budget():
+                break
+
+            for channel_id in frontier:
+                visited.add(channel_id)
+            print("Snowball hop " + str(hop) + ": " + str(len(frontier)) + " channels")
+
+            try:
+                lookup = self.__channel_uploads.add(frontier)
+                self.__channel_uploads.flush()
+            except QuotaExhaustedError as e:
+                print("! Quota exhausted: " + str(e))
+                break
+            uploads = lookup.result() or {}
+
+            commenters = Counter()
+            lock = threading.Lock()
+            executor = CrawlExecutor(max_workers or self.__max_workers)
+
+            def crawl_channel(playlist_id):
+                nonlocal crawled
+                if over_budget():
+                    executor.stop()
+                    return
+                authors = self.__get_snowball_uploads(playlist_id, videos_per_channel, comment_pages)
+                with lock:
+                    commenters.update(authors)
+                    crawled += 1
+
+            for playlist_id in uploads.values():
+                if playlist_id:
+                    executor.submit(crawl_channel, playlist_id)
+
+            try:
+                executor.wait()
+            except QuotaExhaustedError as e:
+                print("! Quota exhausted: " + str(e))
+                break
+
+            if executor.is_stopped():
+                print("! Quota budget spent")
+                break
+
+        print("Snowball crawl: " + str(crawled) + " channels, " + str(self.__get_used_units() - start_units) +
+              " quota units")
+
+        return crawled
+
+    def __get_commenters(self, video_ids):
+        """
+        Counts the stored comments and replies of each author on the videos
+        :param video_ids: list of video ids
+        :return: Counter author id -> number of videos commented
+        """
+        commenters = Counter()
+        query = {'videoId': {'$in': list(video_ids)}}
+        projection = {'_id': 0, 'videoId': 1, 'authorId': 1}
+        authors = set()
+        for comment in self.__db.get_comments(query, projection, batch_size=DB_BATCH_SIZE):
+            authors.add((comment['videoId'], comment['authorId']))
+        for reply in self.__db.get_replies(query, projection, batch_size=DB_BATCH_SIZE):
+            authors.add((reply['videoId'], reply['authorId']))
+        for _, author_id in authors:
+            if author_id:
+                commenters[author_id] += 1
+        return commenters
+
+    def __get_snowball_uploads(self, playlist_id, videos_per_channel, comment_pages):
+        """
+        Crawls the latest uploads of a channel and their first comment pages. The remaining pages are not saved as
+        tokens, the snowball crawl only samples the channels
+        :param playlist_id: the id of the uploads playlist of the channel
+        :param videos_per_channel: the number of uploads
+        :param comment_pages: the number of comment pages of each upload
+        :return: the set of authors that commented on the uploads
+        """
+
+        authors = set()
+        try:
+            results = self.__list('playlistItems', part='snippet', playlistId=playlist_id,
+                                  maxResults=videos_per_channel)
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return authors
+
+        for item in results['items']:
+            video_id = item['snippet']['resourceId']['videoId']
+            inserted = self.__db.insert_video({
+                '_id': video_id,
+                'channelId': item['snippet']['channelId'],
+                'title': item['snippet']['title'],
+                'description': item['snippet']['description'],
+                'publishedAt': item['snippet']['publishedAt'],
+                'statistics': [],
+            })
+            if not inserted and self.__skip_known:
+                continue
+
+            pages = self.__pages('commentThreads', 'video_comments', part='snippet,replies', videoId=video_id,
+                                 textFormat='plainText', maxResults=100, order='relevance')
+            try:
+                for index, page in enumerate(pages, 1):
+                    for thread in page['items']:
+                        authors.update(self.__store_comment_thread(thread))
+                    if index >= comment_pages:
+                        break
+            except HttpError as e:
+                print("HTTP error: " + str(e))
+            finally:
+                pages.close()
+
+        return authors
+
+    def __get_used_units(self):
+        """
+        Returns the number of quota units used by the crawler
+        :return: the number of units
+        """
+        return sum(self.__quota.get_used().values())
 
     def get_channel_data(self):
         """
 
         """
-        channel_result = self.__db.get_channel({}, {'_id': 1})
-        if channel_result is None:
+        # the ids are read before crawling, an idle cursor would time out during the crawl
+        channel_ids = [channel['_id'] for channel in self.__db.get_channel({}, {'_id': 1}, batch_size=DB_BATCH_SIZE)]
+        if not channel_ids:
             self.__logger.warning("No channels available")
             return
         else:
-            for channel in channel_result:
-                playlists = self.__get_channel_playlists(
+            for channel_id in channel_ids:
+                result_success = self.__get_channel_playlists(
+                    self.__db.insert_playlist,
                     part='snippet',
-                    channelId=channel['_id'],
+                    channelId=channel_id,
                     maxResults=50
                 )
-                if playlists is False:
+                if result_success is False:
                     return
-                for pl in playlists:
-                    self.__db.insert_playlist(pl)
-                    """
-                    self.__get_playlist_videos(
-                        part='snippet',
-                        playlistId=pl['_id'],
-                        maxResults=50
-                    )
-                    """
 
     """ Users Network """
 
     def create_network(self, search_id):
         """
-        Gets data from database and creates a file with the users edge-list
+        Gets data from database and creates the binary files of the users network (see CsrGraph)
         :param search_id: id (etag) of the search result
-        :return: name of the generated file
+        :return: name of the generated files
         """
 
-        videos_list = []
-        channels_list = []
         channel_names = {}
-        missing_channels = []
-        video_channel = {}
 
-        # create file for network and open it for appending data
+        # choose the name of the network files
         file_name = "network_" + self.__random_string(STRING_LENGTH)
         path = NETWORKS_FOLDER + "/"
-        while os.path.exists(path + file_name + ".*"):
+        while CsrGraph.exists(path + file_name):
             file_name = "network_" + self.__random_string(STRING_LENGTH)
         self.__logger.info("File name: " + file_name)
-        f = open(path + file_name + TEXT_EXTENSION, "a")
 
         # getting videos list from search
-        results = self.__db.get_search_results({'_id': search_id}, {'results': 1})
-        if results:
-            res = results.next()
-            for vid in res['results']:
-                if vid["id"]["kind"] == "youtube#video":
-                    videos_list.append(vid["id"]["videoId"])
-                    channels_list.append(vid["snippet"]["channelId"])
-                    video_channel[vid["id"]["videoId"]] = vid["snippet"]["channelId"]
-        else:
-            self.__logger.error("No results for search [" + search_id + "] in database")
+        video_channel = self.__get_video_channels(search_id)
+        if video_channel is False:
             return False
+        channels_list = list(video_channel.values())
 
         # checking if channel id from videos exist and make a list with missing channels
-        for channel in channels_list:
-            channel_result = self.__db.get_channel({'_id': channel}, {'title': 1})
-            if channel_result is None:
-                missing_channels.append(channel)
-            else:
-                title = channel_result.next()["title"]
-                channel_names[channel] = title
+        for channel in self.__db.get_channel({'_id': {'$in': channels_list}}, {'title': 1}):
+            channel_names[channel['_id']] = channel['title']
+        missing_channels = [channel for channel in set(channels_list) if channel not in channel_names]
 
         # get channels list
         if missing_channels:
             print("Getting channel details from Youtube Api")
-            channels_id_str = ','.join(missing_channels)
-            result_validation = self.__get_channel(part='snippet,statistics', id=channels_id_str, maxResults=50)
+            try:
+                lookup = self.__channel_details.add(missing_channels)
+                self.__channel_details.flush()
+                details = lookup.result()
+            except QuotaExhaustedError as e:
+                print("! Quota exhausted: " + str(e))
+                return False
 
-            if result_validation is True:
+            if details is not False:
                 # checking if channel id from videos exist
-                for channel in channels_list:
-                    channel_result = self.__db.get_channel({'_id': channel}, {'title': 1})
-                    if channel_result is None:
+                for channel in self.__db.get_channel({'_id': {'$in': missing_channels}}, {'title': 1}):
+                    channel_names[channel['_id']] = channel['title']
+                for channel in missing_channels:
+                    if channel not in channel_names:
                         print("Channels is missing: " + channel)
                         return
-                    else:
-                        title = channel_result.next()["title"]
-                        channel_names[channel] = title
-
-        # getting users from comments
-        comment_limit = {
-            "_id": 0,
-            'authorName': 1,
-            'authorId': 1,
-            'replies': 1
-        }
-        for vid in videos_list:
-            channel_id = video_channel[vid]
-            comments = self.__db.get_comments({'videoId': vid}, comment_limit)
-            if comments:
-                for com in comments:
-                    f.write(channel_id + " " + com["authorId"] + "\n")
-                    channel_names[com["authorId"]] = com["authorName"]
-                    if "replies" in com:
-                        for rep in com['replies']:
-                            # f.write(ch_id + "," + rep["authorId"] + "\n")
-                            f.write(com["authorId"] + " " + rep["authorId"] + "\n")
-                            channel_names[rep["authorId"]] = rep["authorName"]
-            else:
-                channel_names.pop(channel_id)
+
+        # getting the weighted edges between users, counted at ingest time in the edges collection
+        def edges():
+            for edge in self.__db.get_network_edges(list(video_channel)):
+                channel_names[edge["_id"]["target"]] = edge["name"]
+                yield edge["_id"]["source"], edge["_id"]["target"], edge["weight"]
+
+        CsrGraph.from_edges(edges()).save(path + file_name)
 
         # export data to
         pickle.dump(channel_names, open(path + file_name + OBJECT_EXTENSION, "wb"))
 
-        # close file
-        f.close()
-
         return file_name
 
+    def watch_network(self, search_id=None):
+        """
+        Starts the users network that is updated while the crawl runs, from the change streams of the database
+        :param search_id: id (etag) of the search result whose videos are followed (all the videos by default)
+        :return: the started GraphStream or False on error
+        """
+        from influential_users.application.graph_stream import GraphStream  # needs pymongo, unlike the sqlite runs
+
+        video_channels = None
+        if search_id is not None:
+            video_channels = self.__get_video_channels(search_id)
+            if video_channels is False:
+                return False
+
+        graph = GraphStream(self.__db, video_channels)
+        if not graph.start():
+            return False
+        return graph
+
+    def __get_video_channels(self, search_id):
+        """
+        Reads the videos of a stored search
+        :param search_id: id (etag) of the search result
+        :return: dictionary video id -> id of the channel of the video or False if the search is not stored
+        """
+        res = next(self.__db.get_search_results({'_id': search_id}, {'results': 1}), None)
+        if not res:
+            self.__logger.error("No results for search [" + search_id + "] in database")
+            return False
+
+        return {vid["id"]["videoId"]: vid["snippet"]["channelId"]
+                for vid in res['results'] if vid["id"]["kind"] == "youtube#video"}
+
     """ Extract data """
 
+    def __pages(self, resource, token_type, max_pages=None, token_data=None, **kwargs):
+        """
+        Generator with the pages of a list request. If it stops after max_pages while there are more pages, the
+        page token is saved so the request can be continued by process_tokens
+        :param resource: the name of the resource (search, channels, videos, ...)
+        :param token_type: the type of the saved page token
+        :param max_pages: the maximum number of pages (all the pages by default)
+        :param token_data: additional fields of the saved page token
+        :param kwargs: the parameters of the request
+        :return: the pages of results
+        """
+
+        index = 0
+
+        while True:
+            results = self.__list(resource, **kwargs)
+            yield results
+            index += 1
+
+            if 'nextPageToken' not in results:
+                return
+
+            kwargs['pageToken'] = results['nextPageToken']
+
+            if max_pages is not None and index >= max_pages:
+                token = {
+                    '_id': results['nextPageToken'],
+                    'type': token_type,
+                    "retrieval date": datetime.utcnow(),
+                    'query': dict(kwargs)
+                }
+                if token_data:
+                    token.update(token_data)
+                self.__db.insert_token(token)
+                return
+
+    def __stream_items(self, resource, token_type, max_pages=None, token_data=None, **kwargs):
+        """
+        Generator with the items of a list request. The pages are fetched by a producer thread through a bounded
+        queue, so the next pages are requested while the current items are stored
+        :param resource: the name of the resource (search, channels, videos, ...)
+        :param token_type: the type of the saved page token
+        :param max_pages: the maximum number of pages (all the pages by default)
+        :param token_data: additional fields of the saved page token
+        :param kwargs: the parameters of the request
+        :return: the items
+        """
+
+        pages = self.__pages(resource, token_type, max_pages=max_pages, token_data=token_data, **kwargs)
+        for results in BoundedStream(pages):
+            for item in results['items']:
+                yield item
+
     def __get_search_results(self, nr_pages, **kwargs):
         """
 
@@ -438,49 +1009,22 @@ class YoutubeAPI:
         :return:
         """
 
-        index = 0
-        results = []
         final_results = []
-        temp_token = {}
         etag = ""
         total_results = 0
+        keyword = kwargs['q'] if 'q' in kwargs else kwargs.get('location')
 
         try:
-            results = self.__service.search().list(**kwargs).execute()
+            pages = self.__pages('search', 'search', max_pages=nr_pages, token_data={'keyword': keyword}, **kwargs)
+            for results in BoundedStream(pages):
+                if not etag:
+                    etag = results['etag'].replace("\"", "")
+                    total_results = results['pageInfo']['totalResults']
+                final_results.extend(results['items'])
         except HttpError as e:
             print("HTTP error: " + str(e))
             return False, False, False
 
-        if results:
-            etag = results['etag']
-            etag = etag.replace("\"", "")
-            total_results = results['pageInfo']['totalResults']
-
-        while results and index < nr_pages:
-            final_results.extend(results['items'])
-
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.search().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'keyword': kwargs['q'],
-                            'type': 'search',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                    index += 1
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False, False, False
-            else:
-                break
-
-        if temp_token:
-            self.__db.insert_token(temp_token)
-
         return final_results, etag, total_results
 
     def __get_channel(self, **kwargs):
@@ -490,16 +1034,11 @@ class YoutubeAPI:
         :return:
         """
 
-        temp_token = {}
+        final_results = {}
 
         try:
-            results = self.__service.channels().list(**kwargs).execute()
-        except HttpError as e:
-            print("HTTP error: " + str(e))
-            return False
-        while results:
-            for item in results['items']:
-                self.__db.insert_channel({
+            for item in self.__stream_items('channels', 'channel', **kwargs):
+                channel = {
                     "_id": item['id'],
                     "title": item['snippet']['title'],
                     "description": item['snippet']['description'],
@@ -513,29 +1052,15 @@ class YoutubeAPI:
                         'commentCount': item['statistics']['commentCount'] if 'commentCount' in item[
                             'statistics'] else 0
                     }
-                })
-
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.channels().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'type': 'channel',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False
-            else:
-                break
-
-        if temp_token:
-            self.__db.insert_token(temp_token)
+                }
+                if self.__db.insert_channel(channel):
+                    self.__db.insert_statistics_snapshot(CHANNEL_ENTITY, item['id'], channel['statistics'])
+                final_results[item['id']] = channel
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
-        return True
+        return final_results
 
     def __get_channel_statistics(self, **kwargs):
         """
@@ -544,15 +1069,10 @@ class YoutubeAPI:
         :return:
         """
 
-        temp_token = {}
+        final_results = {}
 
         try:
-            results = self.__service.channels().list(**kwargs).execute()
-        except HttpError as e:
-            print("HTTP error: " + str(e))
-            return False
-        while results:
-            for item in results['items']:
+            for item in self.__stream_items('channels', 'channel_statistics', **kwargs):
                 cid = item['id']
                 statistics = {
                     'viewCount': item['statistics']['viewCount'] if 'viewCount' in item['statistics'] else 0,
@@ -562,78 +1082,37 @@ class YoutubeAPI:
                     'commentCount': item['statistics']['commentCount'] if 'commentCount' in item[
                         'statistics'] else 0
                 }
-                self.__db.insert_video_statistics(cid, statistics)
-
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.channels().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'type': 'channel_statistics',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False
-            else:
-                break
-
-        if temp_token:
-            self.__db.insert_token(temp_token)
+                self.__db.insert_channel_statistics(cid, statistics)
+                final_results[cid] = statistics
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
-        return True
+        return final_results
 
-    def __get_channel_playlists(self, **kwargs):
+    def __get_channel_playlists(self, consumer, **kwargs):
         """
-
+        Streams the playlists of a channel to a consumer, as the pages arrive
+        :param consumer: function called with each playlist
         :param kwargs:
-        :return:
+        :return: True or False on error
         """
 
-        final_results = []
-        temp_token = {}
-
         try:
-            results = self.__service.playlists().list(**kwargs).execute()
-        except HttpError as e:
-            print("HTTP error: " + str(e))
-            return False
-        while results:
-            for item in results['items']:
-                playlists = {
+            for item in self.__stream_items('playlists', 'channel_playlists', **kwargs):
+                consumer({
                     '_id': item['id'],
                     'channelId': kwargs["channelId"],
                     'title': item['snippet']['title'],
                     'description': item['snippet']['description'],
                     "publishedAt": item['snippet']['publishedAt'],
                     "retrieval date": datetime.utcnow(),
-                }
-                final_results.append(playlists)
-
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.playlists().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'type': 'channel_playlists',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False
-            else:
-                break
-
-        if temp_token:
-            self.__db.insert_token(temp_token)
+                })
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
-        return final_results
+        return True
 
     def __get_playlist_videos(self, **kwargs):
         """
@@ -642,47 +1121,21 @@ class YoutubeAPI:
         :return:
         """
 
-        final_results = []
-        temp_token = {}
-
         try:
-            results = self.__service.playlistItems().list(**kwargs).execute()
-        except HttpError as e:
-            print("HTTP error: " + str(e))
-            return False
-        while results:
-            for item in results['items']:
-                video = {
+            for item in self.__stream_items('playlistItems', 'playlist_videos', **kwargs):
+                self.__db.insert_video({
                     '_id': item['snippet']['resourceId']['videoId'],
                     'channelId': item['snippet']['channelId'],
                     'title': item['snippet']['title'],
                     'description': item['snippet']['description'],
                     'publishedAt': item['snippet']['publishedAt'],
                     'statistics': [],
-                }
-                self.__db.insert_video(video)
-
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.playlistItems().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'type': 'playlist_videos',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False
-            else:
-                break
-
-        if temp_token:
-            self.__db.insert_token(temp_token)
+                })
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
-        return final_results
+        return True
 
     def __get_video_statistics(self, **kwargs):
         """
@@ -691,15 +1144,10 @@ class YoutubeAPI:
         :return:
         """
 
-        temp_token = {}
+        final_results = {}
 
         try:
-            results = self.__service.videos().list(**kwargs).execute()
-        except HttpError as e:
-            print("HTTP error: " + str(e))
-            return False
-        while results:
-            for item in results['items']:
+            for item in self.__stream_items('videos', 'video_statistics', **kwargs):
                 vid = item['id']
                 statistics = {
                     'viewCount': item['statistics']['viewCount'] if 'viewCount' in item['statistics'] else 0,
@@ -712,28 +1160,12 @@ class YoutubeAPI:
                         'statistics'] else 0
                 }
                 self.__db.insert_video_statistics(vid, statistics)
+                final_results[vid] = statistics
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.videos().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'type': 'video_statistics',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False
-            else:
-                break
-
-        if temp_token:
-            self.__db.insert_token(temp_token)
-
-        return True
+        return final_results
 
     def __get_video_comments(self, **kwargs):
         """
@@ -742,76 +1174,222 @@ class YoutubeAPI:
         :return:
         """
 
-        final_results = []
-        temp_token = {}
-        nr_pages = COMMENT_PAGES_LIMIT
-        index = 0
+        try:
+            for item in self.__stream_items('commentThreads', 'video_comments', max_pages=COMMENT_PAGES_LIMIT,
+                                            **kwargs):
+                self.__store_comment_thread(item)
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
+        return True
+
+    def __get_new_video_comments(self, video_id):
+        """
+        Requests the comment threads of a video that are newer than its high-water mark and moves the mark to the
+        newest thread. The mark is not moved if the crawl fails before reaching it
+        :param video_id: the id of the video
+        :return: True or False on error
+        """
+
+        mark = self.__db.get_comments_mark(video_id)
+        newest = None
+
+        # the pages are not fetched ahead, the crawl stops as soon as a known thread is found
+        pages = self.__pages('commentThreads', 'video_comments', max_pages=None if mark else COMMENT_PAGES_LIMIT,
+                             part='snippet,replies', videoId=video_id, textFormat='plainText', maxResults=100,
+                             order='time')
         try:
-            results = self.__service.commentThreads().list(**kwargs).execute()
+            for results in pages:
+                reached_mark = False
+                for item in results['items']:
+                    published_at = item['snippet']['topLevelComment']['snippet']['publishedAt']
+                    if mark and (item['id'] == mark['commentId'] or published_at < mark['publishedAt']):
+                        reached_mark = True
+                        break
+                    if newest is None:
+                        newest = {'commentId': item['id'], 'publishedAt': published_at}
+                    self.__store_comment_thread(item)
+                if reached_mark:
+                    break
         except HttpError as e:
             print("HTTP error: " + str(e))
             return False
-        while results and index < nr_pages:
-            for item in results['items']:
-                cid = item['id']
-                self.__db.insert_comment({
-                    '_id': item['id'],
-                    'videoId': item['snippet']['topLevelComment']['snippet']['videoId'],
-                    'authorName': item['snippet']['topLevelComment']['snippet']['authorDisplayName'],
-                    'authorId': item['snippet']['topLevelComment']['snippet']['authorChannelId']['value']
-                    if 'authorChannelId' in item['snippet']['topLevelComment']['snippet'] else "",
-                    'text': item['snippet']['topLevelComment']['snippet']['textDisplay'],
-                    'likeCount': item['snippet']['topLevelComment']['snippet']['likeCount'],
-                    'publishedAt': item['snippet']['topLevelComment']['snippet']['publishedAt'],
-                    'replies': []
-                })
-                if 'replies' in item:
-                    for r_item in item['replies']['comments']:
-                        self.__db.insert_comment_reply(cid, {
-                            '_id': r_item['id'],
-                            'videoId': r_item['snippet']['videoId'],
-                            'authorName': r_item['snippet']['authorDisplayName'],
-                            'authorId': r_item['snippet']['authorChannelId']['value']
-                            if 'authorChannelId' in r_item['snippet'] else "",
-                            'text': r_item['snippet']['textDisplay'],
-                            'likeCount': r_item['snippet']['likeCount'],
-                            'publishedAt': r_item['snippet']['publishedAt']
-                        })
-            if 'nextPageToken' in results:
-                kwargs['pageToken'] = results['nextPageToken']
-                try:
-                    results = self.__service.commentThreads().list(**kwargs).execute()
-                    if 'nextPageToken' in results:
-                        temp_token = {
-                            '_id': results['nextPageToken'],
-                            'type': 'video_comments',
-                            "retrieval date": datetime.utcnow(),
-                            'query': kwargs
-                        }
-                    index += 1
-                except HttpError as e:
-                    print("HTTP error: " + str(e))
-                    return False
-            else:
-                break
+        finally:
+            pages.close()
+
+        if newest:
+            self.__db.set_comments_mark(video_id, newest)
+
+        return True
+
+    def __store_comment_thread(self, item):
+        """
+        Stores a comment thread and its replies
+        :param item: the comment thread from the youtube api
+        :return: the set of authors of the thread
+        """
+
+        cid = item['id']
+        comment = {
+            '_id': item['id'],
+            'videoId': item['snippet']['topLevelComment']['snippet']['videoId'],
+            'authorName': item['snippet']['topLevelComment']['snippet']['authorDisplayName'],
+            'authorId': item['snippet']['topLevelComment']['snippet']['authorChannelId']['value']
+            if 'authorChannelId' in item['snippet']['topLevelComment']['snippet'] else "",
+            'text': item['snippet']['topLevelComment']['snippet']['textDisplay'],
+            'likeCount': item['snippet']['topLevelComment']['snippet']['likeCount'],
+            'publishedAt': item['snippet']['topLevelComment']['snippet']['publishedAt'],
+            'totalReplyCount': item['snippet'].get('totalReplyCount', 0)
+        }
+        # the edges collection counts each comment and reply once, when the database stores it for the first time
+        self.__db.insert_comment(comment, item['snippet'].get('channelId'))
+        authors = {comment['authorId']}
+
+        inline_replies = item['replies']['comments'] if 'replies' in item else []
+        replies = [self.__reply_document(r_item, comment['videoId']) for r_item in inline_replies]
+        if replies:
+            self.__db.insert_comment_replies(cid, replies, comment['authorId'])
+        authors.update(reply['authorId'] for reply in replies)
+
+        if self.__expand_replies and comment['totalReplyCount'] > len(inline_replies):
+            with self.__reply_backlog_lock:
+                self.__reply_backlog.append((cid, comment['videoId'], comment['authorId']))
+
+        authors.discard("")
+        return authors
+
+    @staticmethod
+    def __reply_document(r_item, video_id):
+        """
+        Creates the document of a reply
+        :param r_item: the reply from the youtube api
+        :param video_id: the id of the video of the comment thread
+        :return: the reply document
+        """
+        return {
+            '_id': r_item['id'],
+            'videoId': r_item['snippet'].get('videoId', video_id),
+            'authorName': r_item['snippet']['authorDisplayName'],
+            'authorId': r_item['snippet']['authorChannelId']['value']
+            if 'authorChannelId' in r_item['snippet'] else "",
+            'text': r_item['snippet']['textDisplay'],
+            'likeCount': r_item['snippet']['likeCount'],
+            'publishedAt': r_item['snippet']['publishedAt']
+        }
+
+    def __fetch_video_statistics(self, ids):
+        """
+        Requests the statistics of a chunk of videos - used by the videos.list batcher
+        :param ids: list of at most 50 video ids
+        :return: dictionary video id -> statistics or False on error
+        """
+        return self.__get_video_statistics(part='statistics', id=','.join(ids), maxResults=len(ids))
+
+    def __fetch_channel_statistics(self, ids):
+        """
+        Requests the statistics of a chunk of channels - used by the channels.list batcher
+        :param ids: list of at most 50 channel ids
+        :return: dictionary channel id -> statistics or False on error
+        """
+        return self.__get_channel_statistics(part='statistics', id=','.join(ids), maxResults=len(ids))
+
+    def __fetch_channel_details(self, ids):
+        """
+        Requests the details of a chunk of channels - used by the channels.list batcher
+        :param ids: list of at most 50 channel ids
+        :return: dictionary channel id -> channel or False on error
+        """
+        return self.__get_channel(part='snippet,statistics', id=','.join(ids), maxResults=len(ids))
+
+    def __get_channel_uploads(self, **kwargs):
+        """
+        Stores the channels and returns the ids of their uploads playlists
+        :param kwargs:
+        :return: dictionary channel id -> uploads playlist id or False on error
+        """
 
-        if temp_token:
-            self.__db.insert_token(temp_token)
+        final_results = {}
+
+        try:
+            for item in self.__stream_items('channels', 'channel', **kwargs):
+                self.__db.insert_channel({
+                    "_id": item['id'],
+                    "title": item['snippet']['title'],
+                    "description": item['snippet']['description'],
+                    "publishedAt": item['snippet']['publishedAt'],
+                    "retrieval date": datetime.utcnow(),
+                })
+                final_results[item['id']] = item['contentDetails']['relatedPlaylists'].get('uploads')
+        except HttpError as e:
+            print("HTTP error: " + str(e))
+            return False
 
         return final_results
 
+    def __fetch_channel_uploads(self, ids):
+        """
+        Requests the uploads playlists of a chunk of channels - used by the channels.list batcher
+        :param ids: list of at most 50 channel ids
+        :return: dictionary channel id -> uploads playlist id or False on error
+        """
+        return self.__get_channel_uploads(part='snippet,contentDetails', id=','.join(ids), maxResults=len(ids))
+
     """ Authentication"""
 
-    def __get_authentication_service(self):
+    def __get_authentication_service(self, key):
         """
-
-        :return:
+        Returns the youtube service of a developer key, built on first use from the discovery document bundled with
+        google-api-python-client, so no discovery request is made - the client is pinned in requirements.txt, so
+        the document does not change with an upgrade
+        :param key: the developer key
+        :return: the service
         """
 
-        http = httplib2.Http(cache=".cache")
-        self.__service = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, http=http, developerKey=DEVELOPER_KEY,
-                               cache_discovery=True)
+        with self.__lazy_lock:
+            if key not in self.__services:
+                from googleapiclient.discovery import build  # slow to import, not needed by the offline runs
+
+                with self.__http_pool.connection() as http:
+                    self.__services[key] = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION, http=http,
+                                                 developerKey=key, static_discovery=True)
+            return self.__services[key]
+
+    def __list(self, resource, **kwargs):
+        """
+        Executes a list request on a resource of the youtube api with an idle http connection of the pool.
+        The request is made with a key of the pool; if the key turns out to be exhausted the next one is used
+        :param resource: the name of the resource (search, channels, videos, ...)
+        :param kwargs: the parameters of the request
+        :return: the response of the request
+        :raise QuotaExhaustedError: if the daily quota does not allow the request (fresh cached responses are free)
+        """
+        while True:
+            api_key = self.__keys.acquire(resource)
+            try:
+                request = getattr(self.__get_authentication_service(api_key.key), resource)().list(**kwargs)
+                # the cost is charged before the request unless the response looks fresh in the cache index, then
+                # corrected with what the connection actually did - the entry can expire in the meantime
+                charged = not self.__response_cache.is_fresh(request.uri)
+                if charged:
+                    QuotaScheduler.consume_all([api_key.quota, self.__quota], resource)
+                with self.__http_pool.connection() as http:
+                    http.from_cache = False
+                    response = request.execute(http=http)
+                    from_cache = http.from_cache
+                if charged and from_cache:
+                    api_key.quota.refund(resource)
+                    self.__quota.refund(resource)
+                elif not charged and not from_cache:
+                    QuotaScheduler.consume_all([api_key.quota, self.__quota], resource, force=True)
+                return response
+            except HttpError as e:
+                if not is_quota_error(e):
+                    raise
+                self.__logger.warning("Quota exceeded for key ..." + str(api_key.key)[-4:] + ", switching key")
+                self.__keys.mark_exhausted(api_key)
+            finally:
+                self.__keys.release(api_key)
 
     """ Search results cache """
 
@@ -822,10 +1400,10 @@ class YoutubeAPI:
         :return:
         """
 
-        results = self.__db.get_search_results(query)
+        results = next(self.__db.get_search_results(query), None)
         if results:
             print("Getting cached search with keyword: " + query['keyword'])
-            return results.next()
+            return [results]
         else:
             return []
 
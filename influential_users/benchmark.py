@@ -0,0 +1,108 @@
+import argparse
+import threading
+import time
+
+from influential_users.application.replay_service import RecordedSource, ReplayService, SyntheticSource
+from influential_users.application.storage import get_storage
+from influential_users.application.youtube_api import YoutubeAPI
+
+BENCHMARK_DATABASE_NAME = "influential_users_benchmark"
+WRITE_METHODS_PREFIXES = ('insert_', 'remove_', 'set_', 'update_')
+
+
+class CountingStorage:
+    """
+    Wrapper of the database driver that counts the write operations
+    """
+
+    def __init__(self, db):
+        """
+        Class constructor
+        :param db: the database driver
+        """
+        self.__db = db
+        self.__lock = threading.Lock()
+        self.writes = 0
+
+    def __getattr__(self, name):
+        attribute = getattr(self.__db, name)
+        if not callable(attribute) or not name.startswith(WRITE_METHODS_PREFIXES):
+            return attribute
+
+        def counted(*args, **kwargs):
+            with self.__lock:
+                self.writes += 1
+            return attribute(*args, **kwargs)
+
+        return counted
+
+
+def run(name, workers, function, service, db):
+    """
+    Runs a crawler method and prints its throughput
+    :param name: the name of the benchmark
+    :param workers: the number of crawl workers
+    :param function: the function that is measured
+    :param service: the replay service used by the crawler
+    :param db: the counting database driver used by the crawler
+    """
+    service.reset_counters()
+    db.writes = 0
+
+    start_time = time.perf_counter()
+    function()
+    db.flush()
+    elapsed = time.perf_counter() - start_time
+
+    counters = service.get_counters()
+    calls = sum(counters['calls'].values())
+    print("%-24s workers=%-3d %8.2fs %10.1f items/s %7d calls %8d writes %5d errors" % (
+        name, workers, elapsed, counters['items'] / elapsed if elapsed else 0, calls, db.writes,
+        counters['errors']))
+
+
+def main():
+    """
+    Measures the crawler throughput against recorded or synthetic youtube responses
+    """
+    parser = argparse.ArgumentParser(description="Offline benchmark of the youtube crawler")
+    parser.add_argument('--keyword', default="benchmark", help="the searched keyword")
+    parser.add_argument('--results', type=int, default=50, help="the number of search results")
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help="the number of crawl workers")
+    parser.add_argument('--latency', type=float, default=0.05, help="the duration of a request in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="the probability of a request to fail")
+    parser.add_argument('--seed', type=int, default=0, help="the seed of the synthetic data")
+    parser.add_argument('--max-comments', type=int, default=500, help="the maximum number of comments of a video")
+    parser.add_argument('--quota', type=int, default=10 ** 6, help="the daily quota of the crawler")
+    parser.add_argument('--buffered', action='store_true', help="queue the writes and send them in bulk")
+    parser.add_argument('--backend', choices=['mongodb', 'motor', 'sqlite'], default=None,
+                        help="the storage backend (STORAGE_BACKEND by default)")
+    parser.add_argument('--recordings', default=None, help="folder with recorded responses instead of synthetic data")
+    args = parser.parse_args()
+
+    if args.recordings:
+        source = RecordedSource(args.recordings)
+    else:
+        source = SyntheticSource(seed=args.seed, max_comments=args.max_comments)
+
+    for workers in args.workers:
+        storage = get_storage(BENCHMARK_DATABASE_NAME, backend=args.backend, buffered=args.buffered)
+        storage.drop_database()
+        db = CountingStorage(storage)
+        service = ReplayService(source, latency=args.latency, error_rate=args.error_rate, seed=args.seed)
+        crawler = YoutubeAPI(max_workers=workers, daily_quota=args.quota, service=service, db=db)
+
+        results = crawler.search(args.keyword, args.results)
+        if not results:
+            print("Search failed")
+            return
+
+        run("process_search_results", workers, lambda: crawler.process_search_results(results), service, db)
+        run("process_tokens", workers, lambda: crawler.process_tokens(args.results), service, db)
+        storage.close()
+
+    get_storage(BENCHMARK_DATABASE_NAME, backend=args.backend).drop_database()
+
+
+if __name__ == '__main__':
+    main()
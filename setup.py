@@ -16,7 +16,7 @@ setup(
     description="Determining the most influential users from the multimedia social network YouTube by creating a "
                 "graph with the most important users / channels.",
     url="https://github.com/alexgrigoras/influential_users",
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
     keywords='youtube influential users',
     install_requires=requirements,
     zip_safe=True,
@@ -0,0 +1,73 @@
+import pytest
+
+from influential_users.application.graph_format import CsrGraph
+
+EDGES = [
+    ('a', 'b', 1.0),
+    ('b', 'c', 2.0),
+    ('a', 'c', 0.5),
+    ('c', 'a', 1.5),
+]
+
+
+def edges_of(graph):
+    """
+    Returns the edges of a graph as a set of (source id, target id, weight)
+    """
+    edges = set()
+    for node in range(graph.number_of_nodes()):
+        targets, weights = graph.neighbors(node)
+        for target, weight in zip(targets.tolist(), weights.tolist()):
+            edges.add((graph.node_id(node), graph.node_id(target), weight))
+    return edges
+
+
+def test_from_edges():
+    graph = CsrGraph.from_edges(iter(EDGES))
+    assert graph.number_of_nodes() == 3
+    assert graph.number_of_edges() == 4
+    assert edges_of(graph) == set(EDGES)
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_load_round_trip(tmp_path, mmap):
+    path = str(tmp_path / 'graph')
+    assert not CsrGraph.exists(path)
+
+    CsrGraph.from_edges(EDGES).save(path)
+    assert CsrGraph.exists(path)
+
+    graph = CsrGraph.load(path, mmap=mmap)
+    assert graph.offsets.dtype.name == 'int32' and graph.targets.dtype.name == 'int32'
+    assert graph.weights.dtype.name == 'float32'
+    assert edges_of(graph) == set(EDGES)
+
+
+def test_to_networkx(tmp_path):
+    path = str(tmp_path / 'graph')
+    CsrGraph.from_edges(EDGES).save(path)
+    graph = CsrGraph.load(path)
+
+    directed = graph.to_networkx(directed=True)
+    assert directed['c']['a']['weight'] == 1.5
+    assert directed.number_of_edges() == 4
+
+    undirected = graph.to_networkx()
+    assert undirected['a']['c']['weight'] == 2.0  # both directions are summed
+    assert undirected.number_of_edges() == 3
+
+
+def test_repeated_edges_are_summed():
+    graph = CsrGraph.from_edges([('a', 'b', 1.0), ('a', 'b', 2.0)])
+    assert graph.number_of_edges() == 2
+    assert graph.to_networkx(directed=True)['a']['b']['weight'] == 3.0
+
+
+def test_empty_graph(tmp_path):
+    path = str(tmp_path / 'empty')
+    CsrGraph.from_edges([]).save(path)
+
+    graph = CsrGraph.load(path)
+    assert graph.number_of_nodes() == 0
+    assert graph.number_of_edges() == 0
+    assert graph.to_networkx().number_of_nodes() == 0
@@ -0,0 +1,101 @@
+import pytest
+
+from influential_users.application.id_batcher import IdBatcher
+
+
+class FakeFetch:
+    """
+    Fetch function that records the requested chunks and returns the upper case id of each id - the order of the
+    ids in a chunk is not defined, so the chunks are recorded as sets
+    """
+
+    def __init__(self, error=None):
+        self.chunks = []
+        self.error = error
+
+    def __call__(self, ids):
+        self.chunks.append(set(ids))
+        if self.error is not None:
+            raise self.error
+        return {item_id: item_id.upper() for item_id in ids}
+
+
+def test_full_chunks_are_requested_when_added():
+    fetch = FakeFetch()
+    batcher = IdBatcher(fetch, batch_size=3)
+
+    first = batcher.add(['a', 'b'])
+    assert fetch.chunks == []
+
+    second = batcher.add(['c', 'd'])
+    assert len(fetch.chunks) == 1 and len(fetch.chunks[0]) == 3 and {'a', 'b'} <= fetch.chunks[0]
+    assert first.result(timeout=1) == {'a': 'A', 'b': 'B'}
+    assert not second.done()
+
+    batcher.flush()
+    assert [len(chunk) for chunk in fetch.chunks] == [3, 1]
+    assert set.union(*fetch.chunks) == {'a', 'b', 'c', 'd'}
+    assert second.result(timeout=1) == {'c': 'C', 'd': 'D'}
+
+
+def test_shared_ids_are_requested_once():
+    fetch = FakeFetch()
+    batcher = IdBatcher(fetch, batch_size=50)
+
+    first = batcher.add(['a', 'b'])
+    second = batcher.add(['b', 'c'])
+    batcher.flush()
+
+    assert fetch.chunks == [{'a', 'b', 'c'}]
+    assert first.result(timeout=1) == {'a': 'A', 'b': 'B'}
+    assert second.result(timeout=1) == {'b': 'B', 'c': 'C'}
+
+
+def test_empty_lookup_is_resolved():
+    fetch = FakeFetch()
+    batcher = IdBatcher(fetch)
+
+    assert batcher.add([]).result(timeout=1) == {}
+    batcher.flush()
+    assert fetch.chunks == []
+
+
+def test_missing_ids_and_failed_requests():
+    batcher = IdBatcher(lambda ids: {'a': 1}, batch_size=2)
+    assert batcher.add(['a', 'b']).result(timeout=1) == {'a': 1}
+
+    batcher = IdBatcher(lambda ids: False, batch_size=2)
+    assert batcher.add(['a', 'b']).result(timeout=1) is False
+
+
+def test_exception_releases_the_waiting_futures():
+    error = RuntimeError("quota")
+    fetch = FakeFetch(error)
+    batcher = IdBatcher(fetch, batch_size=10)
+
+    first = batcher.add(['a'])
+    second = batcher.add(['a', 'b'])
+    with pytest.raises(RuntimeError):
+        batcher.flush()
+
+    assert fetch.chunks == [{'a', 'b'}]
+    assert first.exception(timeout=1) is error
+    assert second.exception(timeout=1) is error
+
+
+def test_exception_fails_the_next_chunks_and_the_ids_can_be_added_again():
+    error = RuntimeError("quota")
+    fetch = FakeFetch()
+    batcher = IdBatcher(fetch, batch_size=2)
+
+    first = batcher.add(['x'])
+    fetch.error = error
+    with pytest.raises(RuntimeError):
+        batcher.add(['a', 'b', 'c'])  # two chunks are requested - x and one of the new ids, then the other two
+    assert len(fetch.chunks) == 1 and 'x' in fetch.chunks[0]
+    assert first.exception(timeout=1) is error
+
+    fetch.error = None
+    retry = batcher.add(['a', 'b', 'c'])
+    batcher.flush()
+    assert retry.result(timeout=1) == {'a': 'A', 'b': 'B', 'c': 'C'}
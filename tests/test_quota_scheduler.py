@@ -0,0 +1,154 @@
+import pytest
+
+from influential_users.application import quota_scheduler
+from influential_users.application.key_pool import KeyPool
+from influential_users.application.quota_scheduler import (ENDPOINT_IDLE_SECONDS, QUOTA_PERIOD, QuotaExhaustedError,
+                                                           QuotaScheduler, TokenBucket)
+
+
+class FakeClock:
+    """
+    Replaces the time module of the scheduler, so the refill of the buckets is controlled by the tests
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(quota_scheduler, 'time', fake)
+    return fake
+
+
+def test_bucket_refill(clock):
+    bucket = TokenBucket(100, period=100)
+    bucket.consume(100)
+    assert bucket.available() == 0
+
+    clock.advance(50)
+    assert bucket.available() == pytest.approx(50)
+
+    clock.advance(1000)
+    assert bucket.available() == 100
+
+
+def test_exhaustion(clock):
+    scheduler = QuotaScheduler(daily_quota=200)
+    scheduler.consume('search')
+    scheduler.consume('search')  # over the share of search, the other endpoints are idle
+
+    assert scheduler.get_used()['search'] == 200
+    assert not scheduler.can_afford('channels')
+    assert scheduler.is_exhausted()
+    assert scheduler.get_affordable_token_types() == []
+    with pytest.raises(QuotaExhaustedError):
+        scheduler.consume('search')
+
+    scheduler.consume('search', force=True)  # a request that was already sent is charged anyway
+    assert scheduler.get_used()['search'] == 300
+
+
+def test_refill_after_exhaustion(clock):
+    scheduler = QuotaScheduler(daily_quota=100)
+    scheduler.consume('search')
+    assert scheduler.is_exhausted()
+
+    clock.advance(QUOTA_PERIOD)
+    assert scheduler.can_afford('search')
+    assert scheduler.get_used()['search'] == 100  # the used units are not reset
+
+
+def test_refund(clock):
+    scheduler = QuotaScheduler(daily_quota=100)
+    scheduler.consume('search')
+    scheduler.refund('search')
+
+    assert scheduler.get_used()['search'] == 0
+    scheduler.consume('search')
+
+
+def test_hard_endpoint_quota(clock):
+    scheduler = QuotaScheduler(daily_quota=1000, endpoint_quotas={'search': 100})
+    scheduler.consume('search')
+
+    assert not scheduler.can_afford('search')
+    assert scheduler.can_afford('channels')
+
+
+def test_shares_are_lent_by_idle_endpoints(clock):
+    scheduler = QuotaScheduler(daily_quota=1000)
+    scheduler.consume('videos')
+    for _ in range(100):  # the share of channels
+        scheduler.consume('channels')
+    assert not scheduler.can_afford('channels')
+
+    clock.advance(ENDPOINT_IDLE_SECONDS + 1)
+    assert scheduler.can_afford('channels')
+    scheduler.consume('channels')
+
+    scheduler.consume('videos')
+    assert not scheduler.can_afford('channels')
+
+
+def test_consume_all_charges_nothing_when_one_scheduler_is_exhausted(clock):
+    key = QuotaScheduler(daily_quota=100)
+    project = QuotaScheduler(daily_quota=1000)
+    QuotaScheduler.consume_all([key, project], 'search')
+
+    with pytest.raises(QuotaExhaustedError):
+        QuotaScheduler.consume_all([key, project], 'search')
+    assert project.get_used()['search'] == 100
+
+
+def test_priority():
+    assert QuotaScheduler.priority('video_comments') > QuotaScheduler.priority('search')
+    assert QuotaScheduler.priority('video_comments', engagement=1000) > QuotaScheduler.priority('video_comments')
+    assert QuotaScheduler.priority('unknown') == 0
+
+
+def test_key_pool_uses_the_key_with_the_most_quota_left(clock):
+    pool = KeyPool(['key-a', 'key-b'], daily_quota=100)
+
+    api_key = pool.acquire('search')
+    api_key.quota.consume('search')
+    pool.release(api_key)
+
+    other = pool.acquire('search')
+    assert other.key != api_key.key
+    other.quota.consume('search')
+    pool.release(other)
+
+    with pytest.raises(QuotaExhaustedError):
+        pool.acquire('search')
+    assert all(usage['used'] == 100 for usage in pool.get_usage().values())
+
+    clock.advance(QUOTA_PERIOD)
+    pool.release(pool.acquire('search'))
+
+
+def test_key_pool_skips_exhausted_and_busy_keys(clock):
+    pool = KeyPool(['key-a', 'key-b'], workers_per_key=1)
+
+    first = pool.acquire('channels')
+    second = pool.acquire('channels')
+    assert {first.key, second.key} == {'key-a', 'key-b'}
+    pool.release(first)
+    pool.release(second)
+
+    pool.mark_exhausted(first)
+    for _ in range(3):
+        api_key = pool.acquire('channels')
+        assert api_key is second
+        pool.release(api_key)
+
+    pool.mark_exhausted(second)
+    with pytest.raises(QuotaExhaustedError):
+        pool.acquire('channels')
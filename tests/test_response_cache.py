@@ -0,0 +1,151 @@
+import os
+
+import httplib2
+import pytest
+
+from influential_users.application import response_cache
+from influential_users.application.response_cache import CACHE_EXTENSION, DEFAULT_TTL, CachingHttp, ResponseCache
+
+VIDEOS_URI = 'https://www.googleapis.com/youtube/v3/videos?part=snippet&id=abc&key=secret'
+
+
+class FakeClock:
+    """
+    Replaces the time module of the cache, so the responses expire when the tests advance the clock
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeServer:
+    """
+    Replaces the request of httplib2.Http: records the headers of each request and returns the queued responses
+    """
+
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def __call__(self, uri, method="GET", body=None, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(response_cache, 'time', fake)
+    return fake
+
+
+@pytest.fixture
+def server(monkeypatch):
+    fake = FakeServer()
+    monkeypatch.setattr(httplib2.Http, 'request', fake)
+    return fake
+
+
+def test_key_ignores_the_developer_key_and_the_parameter_order():
+    same = 'https://www.googleapis.com/youtube/v3/videos?id=abc&part=snippet&key=other'
+    assert ResponseCache.key(VIDEOS_URI) == ResponseCache.key(same)
+    assert ResponseCache.key(VIDEOS_URI) != ResponseCache.key(VIDEOS_URI.replace('abc', 'xyz'))
+
+
+def test_ttl_of_the_endpoint(tmp_path):
+    cache = ResponseCache(str(tmp_path), ttls={'videos': 60})
+    assert cache.ttl(VIDEOS_URI) == 60
+    assert cache.ttl('https://www.googleapis.com/youtube/v3/search?q=x') == DEFAULT_TTL
+
+
+def test_responses_expire_after_the_ttl(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), ttls={'videos': 60})
+    key = cache.key(VIDEOS_URI)
+    assert not cache.is_fresh(VIDEOS_URI)
+
+    cache.set(key, {'etag': 'v1'}, b'content')
+    assert cache.is_fresh(VIDEOS_URI)
+    assert cache.get(key)['content'] == b'content'
+
+    clock.advance(60)
+    assert not cache.is_fresh(VIDEOS_URI)
+    assert cache.get(key)['content'] == b'content'  # expired responses are kept for revalidation
+
+
+def test_entries_in_the_folder_are_loaded(tmp_path, clock):
+    cache = ResponseCache(str(tmp_path), ttls={'videos': 60})
+    key = cache.key(VIDEOS_URI)
+    cache.set(key, {}, b'content')
+
+    reopened = ResponseCache(str(tmp_path), ttls={'videos': 60})
+    assert not reopened.is_fresh(VIDEOS_URI)  # only the index is loaded
+    assert reopened.get(key)['content'] == b'content'
+    assert reopened.is_fresh(VIDEOS_URI)
+
+
+def test_least_recently_used_responses_are_evicted(tmp_path, clock):
+    probe = ResponseCache(str(tmp_path / 'probe'))
+    probe.set('probe', {}, b'x' * 100)
+    size = os.path.getsize(str(tmp_path / 'probe' / ('probe' + CACHE_EXTENSION)))
+
+    folder = tmp_path / 'cache'
+    cache = ResponseCache(str(folder), max_bytes=2 * size + size // 2)
+    cache.set('a', {}, b'a' * 100)
+    cache.set('b', {}, b'b' * 100)
+    assert cache.get('a') is not None  # b is now the least recently used
+
+    cache.set('c', {}, b'c' * 100)
+    assert cache.get('b') is None
+    assert cache.get('a')['content'] == b'a' * 100
+    assert cache.get('c')['content'] == b'c' * 100
+    assert sorted(os.listdir(str(folder))) == ['a' + CACHE_EXTENSION, 'c' + CACHE_EXTENSION]
+
+
+def test_responses_larger_than_the_cache_are_not_stored(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=100)
+    cache.set('a', {}, b'a' * 1000)
+    assert cache.get('a') is None
+
+
+def test_expired_response_is_refreshed_by_304(tmp_path, clock, server):
+    cache = ResponseCache(str(tmp_path), ttls={'videos': 60})
+    http = CachingHttp(cache)
+
+    server.responses.append((httplib2.Response({'status': '200', 'etag': '"v1"'}), b'content'))
+    response, content = http.request(VIDEOS_URI)
+    assert (response.status, content, http.from_cache) == (200, b'content', False)
+
+    response, content = http.request(VIDEOS_URI)
+    assert (response.status, content, http.from_cache) == (200, b'content', True)
+    assert len(server.requests) == 1
+
+    clock.advance(60)
+    server.responses.append((httplib2.Response({'status': '304'}), b''))
+    response, content = http.request(VIDEOS_URI)
+    assert server.requests[-1]['if-none-match'] == '"v1"'
+    assert (response.status, content, http.from_cache) == (200, b'content', False)
+    assert cache.is_fresh(VIDEOS_URI)
+
+    http.request(VIDEOS_URI)
+    assert http.from_cache
+    assert len(server.requests) == 2
+
+
+def test_changed_response_replaces_the_cached_one(tmp_path, clock, server):
+    cache = ResponseCache(str(tmp_path), ttls={'videos': 60})
+    http = CachingHttp(cache)
+
+    server.responses.append((httplib2.Response({'status': '200', 'etag': '"v1"'}), b'old'))
+    http.request(VIDEOS_URI)
+    clock.advance(60)
+    server.responses.append((httplib2.Response({'status': '200', 'etag': '"v2"'}), b'new'))
+    assert http.request(VIDEOS_URI)[1] == b'new'
+
+    assert cache.get(cache.key(VIDEOS_URI))['content'] == b'new'
+    assert cache.get(cache.key(VIDEOS_URI))['headers']['etag'] == '"v2"'
@@ -0,0 +1,56 @@
+from influential_users.application.seen_filter import BloomFilter, SeenFilter
+
+
+def test_exact_set():
+    seen = SeenFilter(exact_limit=10)
+    assert seen.add('a')
+    assert not seen.add('a')
+    assert 'a' in seen and 'b' not in seen
+    assert len(seen) == 1 and seen.is_exact()
+
+    seen.discard('a')
+    assert 'a' not in seen
+    assert seen.add('a')
+
+
+def test_switch_to_bloom_keeps_the_ids():
+    seen = SeenFilter(exact_limit=100, capacity=1000)
+    ids = ['id-' + str(i) for i in range(101)]
+    for key in ids[:100]:
+        assert seen.add(key)
+    assert seen.is_exact()
+
+    assert seen.add(ids[100])
+    assert not seen.is_exact()
+    assert len(seen) == 101
+    assert all(key in seen for key in ids)
+    assert not any(seen.add(key) for key in ids)
+
+
+def test_no_false_negatives_while_the_blooms_grow():
+    seen = SeenFilter(exact_limit=10, capacity=100, error_rate=0.01)
+    ids = ['id-' + str(i) for i in range(5000)]  # more than the capacity of the first bloom filters
+    added = sum(seen.add(key) for key in ids)
+
+    assert all(key in seen for key in ids)
+    assert added >= len(ids) * 0.98  # a false positive rejects a new id - the hashes are deterministic
+
+    false_positives = sum(('new-' + str(i)) in seen for i in range(10000))
+    assert false_positives <= 10000 * 0.02
+
+
+def test_discard_after_the_switch_keeps_the_id():
+    seen = SeenFilter(exact_limit=1, capacity=100)
+    seen.add('a')
+    seen.add('b')
+    seen.discard('a')  # a bloom filter cannot remove an id, a positive is confirmed by the storage
+    assert 'a' in seen
+
+
+def test_bloom_filter_error_rate():
+    bloom = BloomFilter(capacity=1000, error_rate=0.01)
+    for i in range(1000):
+        bloom.add('id-' + str(i))
+
+    assert all(('id-' + str(i)) in bloom for i in range(1000))
+    assert sum(('new-' + str(i)) in bloom for i in range(10000)) <= 10000 * 0.02
@@ -0,0 +1,137 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from influential_users.application.sqlite_db import SQLiteDB
+from influential_users.application.storage import TOKEN_DEAD, TOKEN_LEASED, TOKEN_PENDING
+
+CHANNELS = [
+    {'_id': 'c1', 'title': 'one', 'subscribers': 10, 'country': 'RO', 'tags': ['music'],
+     'publishedAt': datetime(2020, 1, 1), 'statistics': {'views': 100}},
+    {'_id': 'c2', 'title': 'two', 'subscribers': 20, 'country': 'US', 'tags': ['news'],
+     'publishedAt': datetime(2021, 1, 1), 'statistics': {'views': 5}},
+    {'_id': 'c3', 'title': 'three', 'subscribers': 30, 'country': None},
+    {'_id': 'c4', 'title': 'four'},
+]
+
+
+@pytest.fixture
+def db(tmp_path):
+    storage = SQLiteDB(path=str(tmp_path / 'test.sqlite3'))
+    yield storage
+    storage.close()
+
+
+@pytest.fixture
+def channels(db):
+    for channel in CHANNELS:
+        assert db.insert_channel(channel)
+    return db
+
+
+@pytest.mark.parametrize('query, expected', [
+    ({}, ['c1', 'c2', 'c3', 'c4']),
+    ({'_id': 'c2'}, ['c2']),
+    ({'title': 'one'}, ['c1']),
+    ({'subscribers': {'$eq': 20}}, ['c2']),
+    ({'subscribers': {'$ne': 20}}, ['c1', 'c3', 'c4']),
+    ({'subscribers': {'$gt': 10}}, ['c2', 'c3']),
+    ({'subscribers': {'$gte': 10, '$lt': 30}}, ['c1', 'c2']),
+    ({'subscribers': {'$lte': 20}}, ['c1', 'c2']),
+    ({'_id': {'$in': ['c1', 'c3', 'c9']}}, ['c1', 'c3']),
+    ({'country': {'$in': ['RO', None]}}, ['c1', 'c3', 'c4']),
+    ({'country': {'$nin': ['RO']}}, ['c2', 'c3', 'c4']),
+    ({'country': {'$nin': ['RO', None]}}, ['c2']),
+    ({'country': None}, ['c3', 'c4']),
+    ({'country': {'$ne': None}}, ['c1', 'c2']),
+    ({'country': {'$exists': True}}, ['c1', 'c2', 'c3']),
+    ({'country': {'$exists': False}}, ['c4']),
+    ({'statistics.views': {'$gt': 10}}, ['c1']),
+    ({'tags': ['news']}, ['c2']),
+    ({'publishedAt': {'$gte': datetime(2020, 6, 1)}}, ['c2']),
+    ({'$or': [{'title': 'one'}, {'subscribers': 30}]}, ['c1', 'c3']),
+    ({'$and': [{'subscribers': {'$gt': 10}}, {'$or': [{'country': 'US'}, {'title': 'three'}]}]}, ['c2', 'c3']),
+])
+def test_mongo_filters(channels, query, expected):
+    assert sorted(channel['_id'] for channel in channels.get_channel(query)) == expected
+
+
+def test_projection_and_dates(channels):
+    channel = next(channels.get_channel({'_id': 'c1'}, {'title': 1, 'publishedAt': 1}))
+    assert channel == {'_id': 'c1', 'title': 'one', 'publishedAt': datetime(2020, 1, 1)}
+
+
+def test_unsupported_operator(channels):
+    with pytest.raises(ValueError):
+        list(channels.get_channel({'title': {'$regex': 'o'}}))
+
+
+def test_duplicate_insert(db):
+    assert db.insert_channel({'_id': 'c1', 'title': 'one'})
+    assert not db.insert_channel({'_id': 'c1', 'title': 'other'})
+    assert db.is_known('channels', 'c1')
+    assert next(db.get_channel({'_id': 'c1'}))['title'] == 'one'
+
+
+def get_token(db, token_id):
+    return next(db.get_tokens({'_id': token_id}))
+
+
+def test_tokens_are_leased_by_priority(db):
+    db.insert_token({'_id': 't1', 'type': 'search', 'priority': 1})
+    db.insert_token({'_id': 't2', 'type': 'search', 'priority': 5})
+    db.insert_token({'_id': 't3', 'type': 'video_comments', 'priority': 9})
+
+    token = db.lease_token('w1', ['search'])
+    assert token['_id'] == 't2'
+    assert (token['state'], token['leaseOwner'], token['attempts']) == (TOKEN_LEASED, 'w1', 1)
+    assert token['leaseExpires'] > datetime.utcnow()
+
+    assert db.lease_token('w2', ['search'])['_id'] == 't1'
+    assert db.lease_token('w1', ['search']) is None
+    assert get_token(db, 't3')['state'] == TOKEN_PENDING
+
+
+def test_expired_lease_is_taken_over(db):
+    db.insert_token({'_id': 't1', 'type': 'search'})
+    db.lease_token('w1', ['search'], lease_seconds=-1)
+
+    token = db.lease_token('w2', ['search'])
+    assert (token['_id'], token['leaseOwner'], token['attempts']) == ('t1', 'w2', 2)
+
+    db.complete_token('t1', 'w1')  # the lease was lost, the token is kept
+    assert get_token(db, 't1')['leaseOwner'] == 'w2'
+    db.complete_token('t1', 'w2')
+    assert list(db.get_tokens()) == []
+
+
+def test_release_without_failure_does_not_count_the_attempt(db):
+    db.insert_token({'_id': 't1', 'type': 'search'})
+    db.lease_token('w1', ['search'])
+
+    db.release_token('t1', 'w2', failed=False)  # not the owner
+    assert get_token(db, 't1')['state'] == TOKEN_LEASED
+
+    db.release_token('t1', 'w1', failed=False)
+    token = get_token(db, 't1')
+    assert (token['state'], token['attempts']) == (TOKEN_PENDING, 0)
+    assert 'leaseOwner' not in token and 'leaseExpires' not in token
+
+
+def test_failed_token_becomes_dead(db):
+    db.insert_token({'_id': 't1', 'type': 'search'})
+    for attempt in range(1, 3):
+        assert db.lease_token('w1', ['search'], max_attempts=2)['attempts'] == attempt
+        db.release_token('t1', 'w1', max_attempts=2)
+
+    token = get_token(db, 't1')
+    assert (token['state'], token['attempts']) == (TOKEN_DEAD, 2)
+    assert db.lease_token('w1', ['search'], max_attempts=2) is None
+
+
+def test_token_over_the_attempts_is_dead_when_leased(db):
+    db.insert_token({'_id': 't1', 'type': 'search', 'state': TOKEN_LEASED, 'attempts': 3, 'leaseOwner': 'w0',
+                     'leaseExpires': datetime.utcnow() - timedelta(minutes=1)})
+
+    assert db.lease_token('w1', ['search'], max_attempts=3) is None
+    assert get_token(db, 't1')['state'] == TOKEN_DEAD